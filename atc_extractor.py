@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Incremental ATC code extraction for Felleskatalogen pages
+Parses 'ATC-koder:' entries from text fed in chunks, so a page can be read from the socket
+piece by piece and the connection closed once the section holding the codes has ended
+instead of downloading, decoding and holding the whole page.
+"""
+
+import codecs
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import requests
+
+_LABEL = 'atc-koder:'
+# One complete entry: label, then the code list up to the next tag
+_ENTRY = re.compile(r'ATC-koder:\s*([^<]*)<', re.IGNORECASE)
+# Trailing entry at the end of the text, with no closing tag
+_TRAILING_ENTRY = re.compile(r'ATC-koder:\s*([^<]+)$', re.IGNORECASE)
+# ATC code at any level, as Felleskatalogen writes them ("J05A H01", "N02B", "A11C C05")
+_ATC_CODE = re.compile(r'\b[A-Z]\d{2}(?:[A-Z](?: ?[A-Z](?:\d{2})?)?)?\b')
+# End of a substance page's main content; every 'ATC-koder:' entry of the page comes before it
+PAGE_SECTION_END = '</main>'
+
+
+@dataclass
+class ExtractResult:
+    """ATC codes found on a page, in page order"""
+    codes: List[str] = field(default_factory=list)
+    term_found: bool = False
+    bytes_read: int = 0
+    closed_early: bool = False
+
+    def joined(self) -> str:
+        return ', '.join(self.codes)
+
+
+class AtcCodeExtractor:
+    """Incremental 'ATC-koder:' parser; feed() decoded text chunks, then close()
+
+    With section_end, the parser is done once that marker (matched case-insensitively)
+    follows the last entry seen; without it, the whole text is parsed.
+    """
+
+    def __init__(self, section_end: Optional[str] = None, term: Optional[str] = None):
+        self.section_end = section_end.lower() if section_end else None
+        self.term = term.lower() if term else None
+        self.term_found = self.term is None
+        self.section_ended = False
+        self.entries = 0
+        self._codes: dict = {}
+        self._buffer = ''
+        self._term_tail = ''
+        # Lowercased text after the last entry, kept short while the marker is not in it
+        self._after = ''
+
+    @property
+    def codes(self) -> List[str]:
+        return list(self._codes)
+
+    @property
+    def done(self) -> bool:
+        """Nothing more is needed from the rest of the page"""
+        return self.section_ended and self.term_found
+
+    def feed(self, text: str) -> bool:
+        """Parse another chunk; returns True once the extractor is done"""
+        if not self.term_found:
+            window = self._term_tail + text.lower()
+            self.term_found = self.term in window
+            self._term_tail = window[-(len(self.term) - 1):] if len(self.term) > 1 else ''
+        self._buffer += text
+        end = 0
+        for match in _ENTRY.finditer(self._buffer):
+            self._add(match.group(1))
+            end = match.end()
+        rest = self._buffer[end:]
+        if self.section_end and self.entries and not self.section_ended:
+            after = rest.lower() if end else self._after + text.lower()
+            self.section_ended = self.section_end in after
+            self._after = after[-(len(self.section_end) - 1):] if len(self.section_end) > 1 else ''
+        if self.done:
+            self._buffer = ''
+            return True
+        label_at = rest.lower().rfind(_LABEL)
+        # Keep an unfinished entry, or just enough text for a label split across chunks
+        self._buffer = rest[label_at:] if label_at >= 0 else rest[-(len(_LABEL) - 1):]
+        return False
+
+    def close(self) -> List[str]:
+        match = _TRAILING_ENTRY.search(self._buffer)
+        if match and not self.done:
+            self._add(match.group(1))
+        self._buffer = ''
+        return self.codes
+
+    def _add(self, entry: str):
+        self.entries += 1
+        for code in _ATC_CODE.findall(entry):
+            self._codes.setdefault(code, None)
+
+
+def extract_atc_codes(html_content: str, section_end: Optional[str] = None) -> List[str]:
+    """ATC codes from a page already in memory, in page order without duplicates"""
+    extractor = AtcCodeExtractor(section_end=section_end)
+    extractor.feed(html_content)
+    return extractor.close()
+
+
+def stream_atc_codes(response: requests.Response, section_end: Optional[str] = PAGE_SECTION_END,
+                     term: Optional[str] = None, drain: bool = False, chunk_size: int = 8192) -> ExtractResult:
+    """Extract ATC codes while reading a streamed response
+
+    With section_end the connection is closed as soon as that marker follows the entries
+    (and the term, if given, has been seen); a page without the marker is read to the end.
+    With drain the rest of the body is still read, without parsing, e.g. so a caching
+    transport can store the complete page.
+    """
+    extractor = AtcCodeExtractor(section_end=section_end, term=term)
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    result = ExtractResult()
+    try:
+        chunks = response.iter_content(chunk_size=chunk_size)
+        for chunk in chunks:
+            result.bytes_read += len(chunk)
+            if extractor.feed(decoder.decode(chunk)):
+                if drain:
+                    for rest in chunks:
+                        result.bytes_read += len(rest)
+                else:
+                    result.closed_early = True
+                break
+        else:
+            extractor.feed(decoder.decode(b'', final=True))
+    finally:
+        response.close()
+    result.codes = extractor.close()
+    result.term_found = extractor.term_found
+    return result
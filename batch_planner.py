@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Batch planner for the medicinal product mapper
+Normalizes and deduplicates substance names before any network work, groups them by
+shared Snowstorm substance concepts, and fans the results back out to every input row
+"""
+
+import contextvars
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+
+import profiling
+from upstream_client import PriorityExecutor
+
+if TYPE_CHECKING:
+    from improved_medicinal_product_mapper import MedicinalProduct, XMLMedicinalProductMapper
+
+
+@dataclass
+class BatchPlan:
+    """The unique lookups behind a list of input rows"""
+    rows: List[Tuple[Optional[str], str]]
+    names: Dict[str, str]
+    concept_groups: Dict[str, List[str]] = field(default_factory=dict)
+
+    @property
+    def unique_count(self) -> int:
+        return len(self.names)
+
+
+class BatchPlanner:
+    """Plans and runs the network work for a batch: one lookup per unique substance,
+    one only-product query per unique substance concept"""
+
+    def __init__(self, mapper: 'XMLMedicinalProductMapper', max_workers: int = 8):
+        self.mapper = mapper
+        self.max_workers = max_workers
+
+    def plan(self, substance_names: List[Optional[str]]) -> BatchPlan:
+        """Normalize names with _normalize_name and collapse duplicates (no network)"""
+        rows: List[Tuple[Optional[str], str]] = []
+        names: Dict[str, str] = {}
+        for raw in substance_names:
+            key = self.mapper._normalize_name(raw)
+            rows.append((raw, key))
+            if key and key not in names:
+                names[key] = raw.strip()
+        return BatchPlan(rows=rows, names=names)
+
+    def execute(self, plan: BatchPlan,
+                on_result: Optional[Callable[[str, Dict[str, Any]], None]] = None) -> Dict[str, Dict[str, Any]]:
+        """Map every unique substance; returns results keyed by normalized name
+
+        on_result(key, result) is called from the worker threads as each substance completes.
+        """
+        if not plan.names:
+            return {}
+        keys = list(plan.names)
+        # ATC lookups are independent of Snowstorm, so start them all straight away
+        # Pool tasks run in copies of the caller's context (request priority, active profile)
+        context = contextvars.copy_context()
+
+        def in_context(func: Callable, *args):
+            return context.copy().run(profiling.call_in_task, func, *args)
+
+        atc_executor = self.mapper._get_atc_executor()
+        atc_futures = {key: atc_executor.submit(in_context, self.mapper._atc_codes, plan.names[key]) for key in keys}
+        cached = {key: self.mapper._cached('snomed', key, plan.names[key]) for key in keys}
+        pending = [key for key in keys if cached[key][0] is None]
+        with PriorityExecutor(max_workers=self.max_workers, thread_name_prefix='batch-plan') as pool:
+            resolved = dict(zip(pending, pool.map(lambda name: in_context(self._resolve_substance, name),
+                                                  [plan.names[key] for key in pending])))
+            # Substances resolving to the same concept share one only-product query
+            for key in pending:
+                for sub in resolved[key][0][:5]:
+                    group = plan.concept_groups.setdefault(sub['conceptId'], [])
+                    if key not in group:
+                        group.append(key)
+            concepts = list(plan.concept_groups)
+            products = dict(zip(concepts, pool.map(
+                lambda concept_id: in_context(self._products_for_concept, concept_id), concepts)))
+            results = dict(zip(keys, pool.map(
+                lambda key: in_context(self._complete, key, plan.names[key], cached[key], resolved.get(key),
+                                       products, atc_futures[key], on_result), keys)))
+        return results
+
+    def fan_out(self, plan: BatchPlan, mapped: Dict[str, Dict[str, Any]]) -> Dict[Optional[str], Dict[str, Any]]:
+        """Results keyed by each original substance string, as the XML output expects"""
+        return dict(self.fan_out_rows(plan, mapped))
+
+    def fan_out_rows(self, plan: BatchPlan,
+                     mapped: Dict[str, Dict[str, Any]]) -> List[Tuple[Optional[str], Dict[str, Any]]]:
+        """(original substance string, result) for every input row, in input order, duplicates included"""
+        return [(raw, mapped[key] if key in mapped else self._empty_result()) for raw, key in plan.rows]
+
+    def _resolve_substance(self, substance_name: str) -> Tuple[List[Dict[str, Any]], bool]:
+        self.mapper._last_degraded = False
+        candidates = self.mapper._find_substance_concepts(substance_name)
+        return candidates, self.mapper._last_degraded
+
+    def _products_for_concept(self, concept_id: str) -> Tuple[List['MedicinalProduct'], bool]:
+        self.mapper._last_degraded = False
+        products = self.mapper._find_only_product_for_substance(concept_id)
+        return products, self.mapper._last_degraded
+
+    def _complete(self, key: str, substance_name: str, cached: Tuple[Optional[Dict[str, Any]], Optional[float]],
+                  resolved: Optional[Tuple[List[Dict[str, Any]], bool]],
+                  products: Dict[str, Tuple[List['MedicinalProduct'], bool]], atc_future: Future,
+                  on_result: Optional[Callable[[str, Dict[str, Any]], None]]) -> Dict[str, Any]:
+        result = self._finish(key, substance_name, cached, resolved, products)
+        self.mapper._add_atc(result, *atc_future.result())
+        if on_result is not None:
+            on_result(key, result)
+        return result
+
+    def _finish(self, key: str, substance_name: str, cached: Tuple[Optional[Dict[str, Any]], Optional[float]],
+                resolved: Optional[Tuple[List[Dict[str, Any]], bool]],
+                products: Dict[str, Tuple[List['MedicinalProduct'], bool]]) -> Dict[str, Any]:
+        mapper = self.mapper
+        mapper._last_stale_age = cached[1]
+        if cached[0] is not None:
+            product = mapper._product_from_cache(cached[0])
+        else:
+            candidates, degraded = resolved
+            top = [sub['conceptId'] for sub in candidates[:5]]
+            mapper._last_candidates = []
+            mapper._last_confidence = None
+            mapper._last_degraded = degraded or any(products[cid][1] for cid in top)
+            product = mapper._select_medicinal_product(substance_name, candidates,
+                                                       {cid: products[cid][0] for cid in top})
+            mapper._store_snomed(key, product)
+        return mapper._build_result(product, substance_name)
+
+    def _empty_result(self) -> Dict[str, Any]:
+        self.mapper._last_degraded = False
+        self.mapper._last_stale_age = None
+        result = self.mapper._build_result(None, '')
+        result['atc_codes'] = 'ATC code not found'
+        return result
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Prebuilt, read-only snapshot of mapping results
+Built once from a warm-up corpus and shipped with the deployment, so a cold start answers
+common substances without touching Snowstorm or Felleskatalogen.
+
+File layout (little endian):
+    header   MAGIC, format (u32), metadata length (u32), entry count (u32)
+    metadata UTF-8 JSON (version, built_at, terminology head, corpus size)
+    index    entry count x (key offset, key length, value offset, value length), u32 each,
+             sorted by key so lookups are a binary search over the mapped file
+    data     UTF-8 keys ("namespace\\0normalized name") and JSON values
+"""
+
+import calendar
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+DEFAULT_CACHE_SNAPSHOT = 'Indexes/cache_snapshot.bin'
+
+MAGIC = b'MPSNAP\x00\x00'
+FORMAT = 1
+_HEADER = struct.Struct('<8sIII')
+_ENTRY = struct.Struct('<IIII')
+
+
+def _entry_key(namespace: str, key: str) -> bytes:
+    return f"{namespace}\x00{key}".encode('utf-8')
+
+
+def write_snapshot(path: str, entries: Iterable[Tuple[str, str, Any]],
+                   metadata: Optional[Dict[str, Any]] = None) -> int:
+    """Write (namespace, key, value) entries to a snapshot file atomically; returns the entry count"""
+    records = sorted((_entry_key(namespace, key), json.dumps(value, ensure_ascii=False,
+                                                             separators=(',', ':')).encode('utf-8'))
+                     for namespace, key, value in entries)
+    meta = {'format': FORMAT, 'built_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), **(metadata or {})}
+    meta_bytes = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+
+    data_start = _HEADER.size + len(meta_bytes) + _ENTRY.size * len(records)
+    index = bytearray()
+    data = bytearray()
+    for key, value in records:
+        key_offset = data_start + len(data)
+        data += key
+        value_offset = data_start + len(data)
+        data += value
+        index += _ENTRY.pack(key_offset, len(key), value_offset, len(value))
+
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(_HEADER.pack(MAGIC, FORMAT, len(meta_bytes), len(records)))
+            file.write(meta_bytes)
+            file.write(index)
+            file.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return len(records)
+
+
+class CacheSnapshot:
+    """Read-only view of a snapshot file; the file is memory-mapped on first use"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.metadata: Dict[str, Any] = {}
+        self._mmap: Optional[mmap.mmap] = None
+        self._count = 0
+        self._index_start = 0
+        self._built_at: Optional[float] = None
+        self._opened = False
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0}
+
+    def _open(self) -> bool:
+        with self._lock:
+            if self._opened:
+                return self._mmap is not None
+            self._opened = True
+            if not os.path.exists(self.path):
+                return False
+            try:
+                with open(self.path, 'rb') as file:
+                    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, file_format, meta_length, count = _HEADER.unpack_from(mapped, 0)
+                if magic != MAGIC or file_format != FORMAT:
+                    print(f"Warning: Ignoring cache snapshot '{self.path}' (format {file_format}, expected {FORMAT})")
+                    mapped.close()
+                    return False
+                self.metadata = json.loads(mapped[_HEADER.size:_HEADER.size + meta_length].decode('utf-8'))
+            except Exception as e:
+                print(f"Warning: Could not open cache snapshot '{self.path}': {e}")
+                return False
+            try:
+                self._built_at = calendar.timegm(time.strptime(self.metadata['built_at'], '%Y-%m-%dT%H:%M:%SZ'))
+            except (KeyError, ValueError):
+                self._built_at = None
+            self._index_start = _HEADER.size + meta_length
+            self._count = count
+            self._mmap = mapped
+            return True
+
+    def _key_at(self, position: int) -> Tuple[bytes, int, int]:
+        key_offset, key_length, value_offset, value_length = _ENTRY.unpack_from(
+            self._mmap, self._index_start + position * _ENTRY.size)
+        return self._mmap[key_offset:key_offset + key_length], value_offset, value_length
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        """Snapshot value for a normalized name, or None"""
+        if not key or not self._open():
+            return None
+        wanted = _entry_key(namespace, key)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key_at(middle)[0] < wanted:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count:
+            found, value_offset, value_length = self._key_at(low)
+            if found == wanted:
+                self._counters['hits'] += 1
+                return json.loads(self._mmap[value_offset:value_offset + value_length].decode('utf-8'))
+        self._counters['misses'] += 1
+        return None
+
+    def __len__(self) -> int:
+        return self._count if self._open() else 0
+
+    def age(self) -> float:
+        """Seconds since the snapshot was built"""
+        if not self._open() or self._built_at is None:
+            return 0.0
+        return max(0.0, time.time() - self._built_at)
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Mapped file size; the pages are file-backed, so the OS can drop them under pressure"""
+        with self._lock:
+            return {'entries': self._count, 'bytes': len(self._mmap) if self._mmap is not None else 0}
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            self._opened = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'path': self.path,
+            'loaded': self._mmap is not None,
+            'entries': self._count,
+            'version': self.metadata.get('version'),
+            'built_at': self.metadata.get('built_at'),
+            **self._counters
+        }
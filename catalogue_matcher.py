@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Batch matching of substance names against a local product catalogue
+Both sides are normalized like the mapper's lookups and broken into character trigrams.
+For each chunk of queries, the shared-trigram counts against the catalogue terms come
+from one pass over an inverted index. numpy does this for many queries at once when
+installed (pip install numpy), in blocks of bounded size, and counts only the terms that
+share a trigram when those are few; without it the same counts are summed in Python, with
+the same results, only slower. The best candidates per query are then rescored exactly
+with match_score, which the mapper uses for its own candidates, so the scores can be
+compared directly.
+"""
+
+import heapq
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# FSN and PT wording shared by most products; it says nothing about the substance
+_BOILERPLATE = re.compile(r"^product containing (?:only |precisely )?|\s*\((?:medicinal product|clinical drug|substance)\)$"
+                          r"|-containing product$")
+# Among candidates with the same trigram coverage, shorter terms rank first
+_LENGTH_PENALTY = 1e-5
+# Most (query, term) count cells a dense block may hold (about 16 MB as int64)
+_DENSE_CELLS = 1 << 21
+# Count sparsely when the shared-trigram cells are fewer than 1/_SPARSE_RATIO of the dense block
+_SPARSE_RATIO = 8
+
+
+def normalize_name(text: str) -> str:
+    """Lowercase, collapse whitespace and fold ø/å/æ (the mapper's cache key rules)"""
+    if not text:
+        return ''
+    t = text.strip().lower()
+    t = re.sub(r"\s+", " ", t)
+    t = t.replace('ø', 'o').replace('å', 'a').replace('æ', 'ae')
+    return t
+
+
+def match_score(fsn: str, pt: str, substance_name: str) -> int:
+    """Match score of a product for a substance name"""
+    fsn = fsn.lower()
+    pt = pt.lower()
+    substance_lower = substance_name.lower()
+
+    score = 0
+
+    # Highest priority: "Product containing only [substance]"
+    if f"product containing only {substance_lower}" in fsn:
+        score += 100
+    elif f"product containing only {substance_lower}" in pt:
+        score += 100
+
+    # High priority: "Product containing only [substance] (medicinal product)"
+    elif f"product containing only {substance_lower}" in fsn and "(medicinal product)" in fsn:
+        score += 90
+
+    # Medium priority: Contains the substance name
+    elif substance_lower in fsn:
+        score += 50
+
+    # Lower priority: Partial matches
+    elif any(word in fsn for word in substance_lower.split()):
+        score += 25
+
+    return score
+
+
+def _trigrams(text: str) -> set:
+    padded = f" {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)} if text else set()
+
+
+@dataclass
+class CatalogueMatch:
+    """One catalogue product matched to a query name"""
+    concept_id: str
+    fsn: str
+    pt: str
+    score: int
+    similarity: float
+
+
+class CatalogueMatcher:
+    """Inverted trigram index over a catalogue of products (conceptId -> (fsn, pt, ...))"""
+
+    def __init__(self, products: Dict[str, Sequence[str]]):
+        self.concept_ids: List[str] = []
+        self.terms: List[Tuple[str, str]] = []
+        # Each product is indexed by its FSN and its PT; a row is one of those terms
+        row_products: List[int] = []
+        row_lengths: List[int] = []
+        postings: Dict[str, List[int]] = {}
+        for concept_id, record in products.items():
+            fsn, pt = record[0], record[1]
+            product = len(self.concept_ids)
+            self.concept_ids.append(concept_id)
+            self.terms.append((fsn, pt))
+            for text in {_BOILERPLATE.sub('', normalize_name(fsn)), _BOILERPLATE.sub('', normalize_name(pt))}:
+                grams = _trigrams(text)
+                if not grams:
+                    continue
+                row = len(row_products)
+                row_products.append(product)
+                row_lengths.append(len(grams))
+                for gram in grams:
+                    postings.setdefault(gram, []).append(row)
+        self.vocabulary = {gram: position for position, gram in enumerate(postings)}
+        self.row_products = row_products
+        self.row_lengths = row_lengths
+        self.postings = list(postings.values())
+        if np is not None:
+            # CSR layout: the rows containing trigram t are indices[indptr[t]:indptr[t + 1]]
+            self._indptr = np.zeros(len(self.postings) + 1, dtype=np.int64)
+            np.cumsum([len(rows) for rows in self.postings], out=self._indptr[1:])
+            self._indices = np.fromiter((row for rows in self.postings for row in rows), dtype=np.int64,
+                                        count=int(self._indptr[-1]))
+            self._row_penalty = _LENGTH_PENALTY * np.asarray(row_lengths, dtype=np.float64)
+
+    @classmethod
+    def from_index(cls, index) -> 'CatalogueMatcher':
+        """Matcher over the products of an OnlyProductIndex"""
+        return cls(index.products)
+
+    def __len__(self) -> int:
+        return len(self.concept_ids)
+
+    def match(self, names: Sequence[str], top_k: int = 5, chunk_size: int = 128,
+              shortlist: Optional[int] = None) -> List[List[CatalogueMatch]]:
+        """Best top_k products for every name, ordered by match_score, then trigram coverage
+
+        shortlist is how many candidates per name are rescored exactly (default 8 * top_k, at least 32).
+        """
+        shortlist = shortlist or max(8 * top_k, 32)
+        # Names differing only in case get the same matches; each is looked up once
+        unique: Dict[str, int] = {}
+        for name in names:
+            unique.setdefault(name.lower(), len(unique))
+        queries = list(unique)
+        query_grams = [_trigrams(normalize_name(query)) for query in queries]
+        gram_ids = [[self.vocabulary[gram] for gram in grams if gram in self.vocabulary] for grams in query_grams]
+        query_lengths = [max(1, len(grams)) for grams in query_grams]
+
+        results: List[List[CatalogueMatch]] = []
+        for start in range(0, len(queries), chunk_size):
+            end = min(start + chunk_size, len(queries))
+            if np is not None:
+                candidates = self._candidates_vectorized(gram_ids[start:end], query_lengths[start:end], shortlist)
+            else:
+                candidates = [self._candidates(ids, length, shortlist)
+                              for ids, length in zip(gram_ids[start:end], query_lengths[start:end])]
+            for query, rows in zip(queries[start:end], candidates):
+                results.append(self._rescore(query, rows, top_k))
+        return [results[unique[name.lower()]] for name in names]
+
+    def _candidates(self, ids: List[int], length: int, shortlist: int) -> List[Tuple[float, int]]:
+        counts: Dict[int, int] = {}
+        for gram in ids:
+            for row in self.postings[gram]:
+                counts[row] = counts.get(row, 0) + 1
+        return heapq.nlargest(shortlist, ((count / length - _LENGTH_PENALTY * self.row_lengths[row], row)
+                                          for row, count in counts.items()))
+
+    def _candidates_vectorized(self, gram_ids: List[List[int]], lengths: List[int],
+                               shortlist: int) -> List[List[Tuple[float, int]]]:
+        rows_total = len(self.row_products)
+        if not rows_total:
+            return [[] for _ in gram_ids]
+        # Counting a block densely takes block x rows cells; keep that bounded whatever the catalogue size
+        block = max(1, _DENSE_CELLS // rows_total)
+        candidates: List[List[Tuple[float, int]]] = []
+        for start in range(0, len(gram_ids), block):
+            candidates.extend(self._block_candidates(gram_ids[start:start + block], lengths[start:start + block],
+                                                     shortlist, rows_total))
+        return candidates
+
+    def _block_candidates(self, gram_ids: List[List[int]], lengths: List[int], shortlist: int,
+                          rows_total: int) -> List[List[Tuple[float, int]]]:
+        grams = np.fromiter((gram for ids in gram_ids for gram in ids), dtype=np.int64)
+        owners = np.repeat(np.arange(len(gram_ids), dtype=np.int64), [len(ids) for ids in gram_ids])
+        # Gather every posting of every query trigram in one go, tagged with its query
+        starts = self._indptr[grams]
+        sizes = self._indptr[grams + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(sizes) + sizes, sizes) + np.arange(int(sizes.sum()), dtype=np.int64)
+        cells = self._indices[offsets] + np.repeat(owners, sizes) * rows_total
+        query_lengths = np.asarray(lengths, dtype=np.float64)
+        if len(cells) * _SPARSE_RATIO < len(gram_ids) * rows_total:
+            # Distinctive names share trigrams with few terms: count and rank only those cells
+            cells, counts = np.unique(cells, return_counts=True)
+            queries, rows = np.divmod(cells, rows_total)
+            similarity = counts / query_lengths[queries] - self._row_penalty[rows]
+            order = np.lexsort((-rows, -similarity, queries))
+            queries, rows, similarity = queries[order], rows[order], similarity[order]
+            bounds = np.searchsorted(queries, np.arange(len(gram_ids) + 1))
+            return [list(zip(similarity[first:min(last, first + shortlist)].tolist(),
+                             rows[first:min(last, first + shortlist)].tolist()))
+                    for first, last in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+        counts = np.bincount(cells, minlength=len(gram_ids) * rows_total).reshape(len(gram_ids), rows_total)
+        similarity = counts / query_lengths[:, None] - self._row_penalty[None, :]
+        keep = min(shortlist, rows_total)
+        best = np.argpartition(-similarity, keep - 1, axis=1)[:, :keep]
+        candidates = []
+        for query, rows in enumerate(best):
+            rows = rows[counts[query, rows] > 0]
+            candidates.append([(float(similarity[query, row]), int(row)) for row in rows])
+        return candidates
+
+    def _rescore(self, query: str, rows: List[Tuple[float, int]], top_k: int) -> List[CatalogueMatch]:
+        coverage: Dict[int, float] = {}
+        for similarity, row in rows:
+            product = self.row_products[row]
+            coverage[product] = max(coverage.get(product, -1.0), similarity + _LENGTH_PENALTY * self.row_lengths[row])
+        matches = []
+        for product, similarity in coverage.items():
+            fsn, pt = self.terms[product]
+            matches.append(CatalogueMatch(concept_id=self.concept_ids[product], fsn=fsn, pt=pt,
+                                          score=match_score(fsn, pt, query), similarity=round(similarity, 4)))
+        matches.sort(key=lambda match: (-match.score, -match.similarity, len(match.fsn), match.concept_id))
+        return matches[:top_k]
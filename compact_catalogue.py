@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Compact in-memory storage for large terminology catalogues
+A medicinal product catalogue held as a dict of tuples of str costs several hundred bytes
+per product, most of it object headers and copies of the same few values. Here products
+are stored column-wise instead: concept ids as 64-bit integers in a sorted array, FSNs and
+PTs as UTF-8 in one byte buffer, and the repeated values (definition status, effective
+time, FSN semantic tag) as small codes into a pool holding each value once. Records are
+rebuilt on access, so callers still see conceptId -> (fsn, pt, definitionStatus, effectiveTime).
+
+    python test_compact_catalogue.py benchmark [products]   compares the two layouts
+"""
+
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from collections.abc import MutableMapping
+from dataclasses import fields
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# New concept ids are collected here and merged into the sorted arrays in batches
+_MERGE_AT = 1024
+
+
+def with_slots(cls):
+    """Recreate a dataclass with __slots__ (dataclass(slots=True) needs Python 3.10)"""
+    names = tuple(f.name for f in fields(cls))
+    namespace = {key: value for key, value in cls.__dict__.items()
+                 if key not in names and key not in ('__dict__', '__weakref__')}
+    namespace['__slots__'] = names
+    slotted = type(cls)(cls.__name__, cls.__bases__, namespace)
+    slotted.__qualname__ = cls.__qualname__
+    return slotted
+
+
+def intern(value):
+    """sys.intern for strings; anything else (None) is returned as is"""
+    return sys.intern(value) if type(value) is str else value
+
+
+def concept_int(concept_id: str) -> int:
+    """SNOMED CT concept id as an integer (ids are digits without leading zeros, so this round-trips)"""
+    if not concept_id.isdigit() or (concept_id[0] == '0' and len(concept_id) > 1):
+        raise ValueError(f"Not a SNOMED CT concept id: {concept_id!r}")
+    return int(concept_id)
+
+
+def _lookup_key(concept_id: object) -> Optional[int]:
+    try:
+        return concept_int(concept_id) if isinstance(concept_id, str) else None
+    except ValueError:
+        return None
+
+
+def split_semantic_tag(fsn: str) -> Tuple[str, str]:
+    """'Product containing only x (medicinal product)' -> ('Product containing only x', ' (medicinal product)')"""
+    if fsn.endswith(')') and ' (' in fsn:
+        cut = fsn.rindex(' (')
+        return fsn[:cut], fsn[cut:]
+    return fsn, ''
+
+
+class StringPool:
+    """Each distinct value stored once, referenced by its position"""
+
+    def __init__(self):
+        self.values: List[str] = []
+        self._codes: Dict[str, int] = {}
+
+    def code(self, value: str) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(sys.intern(value))
+        return code
+
+    def __getitem__(self, code: int) -> str:
+        return self.values[code]
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def nbytes(self) -> int:
+        return sys.getsizeof(self.values) + sys.getsizeof(self._codes) + sum(sys.getsizeof(v) for v in self.values)
+
+
+class ProductCatalogue(MutableMapping):
+    """conceptId -> (fsn, pt, definitionStatus, effectiveTime), stored column-wise"""
+
+    def __init__(self, products: Optional[Iterable] = None):
+        self.pool = StringPool()
+        # Lookups run beside delta syncs; the id and row arrays must be read as a consistent pair
+        self._lock = threading.RLock()
+        self._reset()
+        if products:
+            self.update(products)
+
+    def _reset(self):
+        # Sorted concept ids and the row each one's columns are in
+        self._ids = array('q')
+        self._rows = array('q')
+        # Ids added since the last merge into the sorted arrays
+        self._pending: Dict[int, int] = {}
+        # Columns, one entry per row: FSN body and PT as UTF-8 in _text, the rest as pool codes
+        self._text = bytearray()
+        self._offsets = array('Q')
+        self._fsn_lengths = array('L')
+        self._pt_lengths = array('L')
+        self._tags = array('H')
+        self._statuses = array('H')
+        self._effective_times = array('H')
+        # Rows left behind by overwrites and deletes, reclaimed by _compact
+        self._dead = 0
+
+    def _find(self, key: int) -> int:
+        """Row of a concept id, or -1"""
+        row = self._pending.get(key)
+        if row is not None:
+            return row
+        i = bisect_left(self._ids, key)
+        return self._rows[i] if i < len(self._ids) and self._ids[i] == key else -1
+
+    def _merge(self):
+        if not self._pending:
+            return
+        pairs = sorted(list(zip(self._ids, self._rows)) + list(self._pending.items()))
+        self._ids = array('q', (key for key, _ in pairs))
+        self._rows = array('q', (row for _, row in pairs))
+        self._pending = {}
+
+    def _append_row(self, record) -> int:
+        fsn, pt, definition_status, effective_time = record
+        body, tag = split_semantic_tag(fsn or '')
+        fsn_bytes = body.encode('utf-8')
+        pt_bytes = (pt or '').encode('utf-8')
+        self._offsets.append(len(self._text))
+        self._text += fsn_bytes
+        self._text += pt_bytes
+        self._fsn_lengths.append(len(fsn_bytes))
+        self._pt_lengths.append(len(pt_bytes))
+        self._tags.append(self.pool.code(tag))
+        self._statuses.append(self.pool.code(definition_status or ''))
+        self._effective_times.append(self.pool.code(effective_time or ''))
+        return len(self._offsets) - 1
+
+    def _record(self, row: int) -> Tuple[str, str, str, str]:
+        start = self._offsets[row]
+        middle = start + self._fsn_lengths[row]
+        end = middle + self._pt_lengths[row]
+        return (self._text[start:middle].decode('utf-8') + self.pool[self._tags[row]],
+                self._text[middle:end].decode('utf-8'),
+                self.pool[self._statuses[row]],
+                self.pool[self._effective_times[row]])
+
+    def __getitem__(self, concept_id: str) -> Tuple[str, str, str, str]:
+        key = _lookup_key(concept_id)
+        with self._lock:
+            row = self._find(key) if key is not None else -1
+            if row < 0:
+                raise KeyError(concept_id)
+            return self._record(row)
+
+    def __contains__(self, concept_id: object) -> bool:
+        key = _lookup_key(concept_id)
+        with self._lock:
+            return key is not None and self._find(key) >= 0
+
+    def __setitem__(self, concept_id: str, record):
+        key = concept_int(concept_id)
+        with self._lock:
+            row = self._append_row(record)
+            if key in self._pending:
+                self._pending[key] = row
+                self._dead += 1
+            else:
+                i = bisect_left(self._ids, key)
+                if i < len(self._ids) and self._ids[i] == key:
+                    self._rows[i] = row
+                    self._dead += 1
+                else:
+                    self._pending[key] = row
+                    if len(self._pending) >= _MERGE_AT:
+                        self._merge()
+            self._compact_if_wasteful()
+
+    def __delitem__(self, concept_id: str):
+        key = _lookup_key(concept_id)
+        with self._lock:
+            if key is not None and key in self._pending:
+                del self._pending[key]
+            else:
+                i = bisect_left(self._ids, key) if key is not None else len(self._ids)
+                if i >= len(self._ids) or self._ids[i] != key:
+                    raise KeyError(concept_id)
+                del self._ids[i]
+                del self._rows[i]
+            self._dead += 1
+            self._compact_if_wasteful()
+
+    def _compact_if_wasteful(self):
+        # Overwrites (every delta sync updates products) and deletes leave rows behind
+        if self._dead > max(_MERGE_AT, len(self)):
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the columns without the rows no id points to any more"""
+        self._merge()
+        records = [(key, self._record(row)) for key, row in zip(self._ids, self._rows)]
+        self._reset()
+        for key, record in records:
+            self._ids.append(key)
+            self._rows.append(self._append_row(record))
+
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            self._merge()
+            return iter([str(key) for key in self._ids])
+
+    def items(self) -> List[Tuple[str, Tuple[str, str, str, str]]]:
+        """(conceptId, record) pairs in concept id order, decoded in one pass"""
+        with self._lock:
+            self._merge()
+            return [(str(key), self._record(row)) for key, row in zip(self._ids, self._rows)]
+
+    def __len__(self) -> int:
+        return len(self._ids) + len(self._pending)
+
+    def nbytes(self) -> int:
+        """Bytes held by the columns, the sorted ids and the value pool"""
+        arrays = (self._ids, self._rows, self._offsets, self._fsn_lengths, self._pt_lengths, self._tags,
+                  self._statuses, self._effective_times)
+        return (sum(sys.getsizeof(column) for column in arrays) + sys.getsizeof(self._text)
+                + sys.getsizeof(self._pending) + self.pool.nbytes())
+
+
+class SubstanceLinks(MutableMapping):
+    """Substance conceptId -> product conceptIds, with integer ids in arrays"""
+
+    def __init__(self, links: Optional[Dict[str, List[str]]] = None):
+        self._links: Dict[int, array] = {}
+        for substance_id, product_ids in (links or {}).items():
+            self[substance_id] = product_ids
+
+    def __getitem__(self, substance_id: str) -> List[str]:
+        products = self._links.get(_lookup_key(substance_id))
+        if products is None:
+            raise KeyError(substance_id)
+        return [str(product) for product in products]
+
+    def __setitem__(self, substance_id: str, product_ids: List[str]):
+        self._links[concept_int(substance_id)] = array('q', (concept_int(product) for product in product_ids))
+
+    def __delitem__(self, substance_id: str):
+        if self._links.pop(_lookup_key(substance_id), None) is None:
+            raise KeyError(substance_id)
+
+    def __iter__(self) -> Iterator[str]:
+        return (str(key) for key in self._links)
+
+    def __len__(self) -> int:
+        return len(self._links)
+
+    def link(self, substance_id: str, product_id: str):
+        """Add a product to a substance (once)"""
+        products = self._links.setdefault(concept_int(substance_id), array('q'))
+        product = concept_int(product_id)
+        if product not in products:
+            products.append(product)
+
+    def unlink(self, substance_id: str, product_id: str):
+        """Remove a product from a substance; a substance left without products is dropped"""
+        key = concept_int(substance_id)
+        products = self._links.get(key)
+        if products is None:
+            return
+        product = concept_int(product_id)
+        if product in products:
+            products.remove(product)
+        if not products:
+            del self._links[key]
+
+    def nbytes(self) -> int:
+        return sys.getsizeof(self._links) + sum(sys.getsizeof(key) + sys.getsizeof(products)
+                                                for key, products in self._links.items())
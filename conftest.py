@@ -0,0 +1,12 @@
+#!/usr/bin/env python3
+"""
+Shared pytest setup: state the mapper can share between processes lives in each test's tmp_path
+"""
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def isolated_shared_state(tmp_path, monkeypatch):
+    monkeypatch.setenv('RATE_LIMIT_STATE', str(tmp_path / 'rate_limit.sqlite'))
+    monkeypatch.setenv('HTTP_CACHE_DIR', str(tmp_path / 'http'))
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Local negative index for Felleskatalogen ATC lookups
+Substances with no Felleskatalogen page (drug classes, very new agents) otherwise cost two
+HTTP calls before falling back. Known misses come from the history of lookups that found
+nothing and skip both calls. The names listed in the substance register, saved as a set,
+answer the second call (the register search) for names it does not list; the direct page is
+still probed. Both expire so newly added substances get picked up again.
+"""
+
+import html
+import json
+import re
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Optional, Set
+from urllib.parse import unquote
+
+from memory_budget import estimate_entries_size
+
+DEFAULT_MISS_INDEX = os.path.join('Indexes', 'felleskatalogen_misses.json')
+
+
+# One register entry: a link to a substance page, with the substance name as its text
+_ENTRY = re.compile(r'<a\s[^>]*href="[^"]*substansregister/([^"/?#]+)"[^>]*>(.*?)</a>', re.IGNORECASE | re.DOTALL)
+_TAG = re.compile(r'<[^>]+>')
+# Parts of an entry that are names on their own: "Vitamin D (kolekalsiferol)", "Abakavir/lamivudin"
+_PARTS = re.compile(r'[()/,;]')
+
+
+def _key(name: str) -> str:
+    return ' '.join(name.lower().split())
+
+
+def register_names(register_html: str) -> Set[str]:
+    """Normalized names a register search would find: every entry's text and page slug,
+    their bracketed and slash-separated parts, and the words of each"""
+    names: Set[str] = set()
+    for slug, text in _ENTRY.findall(register_html):
+        for entry in (html.unescape(_TAG.sub(' ', text)), unquote(html.unescape(slug))):
+            for part in [entry, *_PARTS.split(entry), *entry.split()]:
+                key = _key(_PARTS.sub(' ', part))
+                if key:
+                    names.add(key)
+    return names
+
+
+class KnownMissIndex:
+    """Exact set of substance names known to have no Felleskatalogen ATC codes"""
+
+    FORMAT = 3
+
+    def __init__(self, path: str = DEFAULT_MISS_INDEX, max_age: float = 30 * 86400.0, save_interval: float = 60.0):
+        self.path = path
+        self.max_age = max_age
+        self.save_interval = save_interval
+        # Register snapshot: the normalized names it lists (see register_names)
+        self.register_names: Set[str] = set()
+        self.register_built_at: Optional[float] = None
+        # Miss history: name -> time of the lookup that found nothing
+        self.misses: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = time.time()
+        self._counters = {'skipped_lookups': 0, 'skipped_searches': 0, 'recorded_misses': 0}
+
+    def is_known_miss(self, substance_name: str) -> bool:
+        """True when a Felleskatalogen lookup recently came back empty"""
+        key = _key(substance_name)
+        if not key:
+            return False
+        with self._lock:
+            known = time.time() - self.misses.get(key, float('-inf')) <= self.max_age
+            if known:
+                self._counters['skipped_lookups'] += 1
+        return known
+
+    def register_lacks(self, substance_name: str) -> bool:
+        """True when a register search for the name would find nothing (the saved register does not list it)
+
+        Only stands in for the register search; whether the substance has a page of its own
+        is for the direct page request to tell.
+        """
+        key = _key(substance_name)
+        if not key:
+            return False
+        with self._lock:
+            if self.register_built_at is None or time.time() - self.register_built_at > self.max_age:
+                return False
+            lacks = key not in self.register_names
+            if lacks:
+                self._counters['skipped_searches'] += 1
+        return lacks
+
+    def record_miss(self, substance_name: str):
+        """Remember a lookup that reached Felleskatalogen and found nothing"""
+        key = _key(substance_name)
+        if not key:
+            return
+        with self._lock:
+            self.misses[key] = time.time()
+            self._counters['recorded_misses'] += 1
+            self._dirty = True
+            due = time.time() - self._saved_at >= self.save_interval
+        if due:
+            self.flush()
+
+    def forget(self, substance_name: str):
+        with self._lock:
+            if self.misses.pop(_key(substance_name), None) is not None:
+                self._dirty = True
+
+    def update_register(self, register_html: str):
+        """Rebuild the register part from the full substansregister/ page"""
+        names = register_names(register_html)
+        with self._lock:
+            self.register_names = names
+            self.register_built_at = time.time()
+            self._dirty = True
+
+    def flush(self):
+        """Save when there are unsaved changes"""
+        if self._dirty:
+            self.save()
+
+    def save(self, path: Optional[str] = None):
+        """Write the index atomically"""
+        path = path or self.path
+        with self._lock:
+            now = time.time()
+            data = {
+                'format': self.FORMAT,
+                'register_built_at': self.register_built_at,
+                'register_names': sorted(self.register_names),
+                'misses': {name: at for name, at in self.misses.items() if now - at <= self.max_age}
+            }
+            self._dirty = False
+            self._saved_at = now
+        directory = os.path.dirname(path) or '.'
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump(data, file, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Warning: Could not save Felleskatalogen miss index '{path}': {e}")
+
+    def load_saved(self) -> bool:
+        """Merge the saved index into this one; False when there is none (or it has an unknown format)"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not load Felleskatalogen miss index '{self.path}': {e}")
+            return False
+        if data.get('format') != self.FORMAT:
+            print(f"Warning: Ignoring Felleskatalogen miss index '{self.path}' with unknown format {data.get('format')}")
+            return False
+        with self._lock:
+            if self.register_built_at is None or (data.get('register_built_at') or 0) > self.register_built_at:
+                self.register_names = set(data.get('register_names', []))
+                self.register_built_at = data.get('register_built_at')
+            for name, at in data.get('misses', {}).items():
+                self.misses[name] = max(at, self.misses.get(name, at))
+        return True
+
+    def memory_usage(self) -> Dict[str, int]:
+        with self._lock:
+            misses = estimate_entries_size(self.misses, self.misses.items(), len(self.misses))
+            names = estimate_entries_size(self.register_names, iter(self.register_names), len(self.register_names))
+            return {'entries': len(self.misses) + len(self.register_names), 'bytes': names + misses}
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                'register_names': len(self.register_names),
+                'register_built_at': self.register_built_at,
+                'misses': len(self.misses),
+                **self._counters
+            }
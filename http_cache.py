@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+On-disk HTTP cache for the mapper's requests session
+Honors Cache-Control (max-age, no-cache, no-store) and Expires for freshness, and revalidates
+stale pages with If-None-Match / If-Modified-Since so an unchanged page costs a 304.
+Responses carry X-Cache (HIT, REVALIDATED, MISS) and X-Body-Digest, so callers can skip
+re-parsing a body they have already seen.
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+DEFAULT_HTTP_CACHE_DIR = os.path.join('Output', '.http_cache')
+
+_MAX_AGE = re.compile(r'max-age=(\d+)')
+_TRANSFER_HEADERS = ('content-length', 'content-encoding', 'transfer-encoding', 'connection')
+
+
+def _cache_control(headers: Dict[str, str]) -> str:
+    return (headers.get('Cache-Control') or '').lower()
+
+
+def freshness_lifetime(headers: Dict[str, str]) -> float:
+    """Seconds a stored response may be reused without revalidation (0 when it must be revalidated)"""
+    directives = _cache_control(headers)
+    if 'no-cache' in directives or 'no-store' in directives:
+        return 0.0
+    match = _MAX_AGE.search(directives)
+    if match:
+        return float(match.group(1))
+    if headers.get('Expires') and headers.get('Date'):
+        try:
+            return max(0.0, (parsedate_to_datetime(headers['Expires'])
+                             - parsedate_to_datetime(headers['Date'])).total_seconds())
+        except (TypeError, ValueError):
+            return 0.0
+    return 0.0
+
+
+class DiskHttpCache:
+    """Stored 200 responses, one metadata file and one body file per URL"""
+
+    def __init__(self, directory: str = DEFAULT_HTTP_CACHE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.counters = {'hits': 0, 'revalidated': 0, 'misses': 0, 'stored': 0}
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def lookup(self, url: str) -> Optional[Dict[str, Any]]:
+        """Stored entry (metadata plus body), or None"""
+        path = self._path(url)
+        try:
+            with open(path + '.json', 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+            with open(path + '.body', 'rb') as file:
+                entry['body'] = file.read()
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get('url') == url else None
+
+    def is_fresh(self, url: str) -> bool:
+        entry = self.lookup(url)
+        return entry is not None and self._fresh(entry)
+
+    @staticmethod
+    def _fresh(entry: Dict[str, Any]) -> bool:
+        return time.time() - entry['stored_at'] < freshness_lifetime(CaseInsensitiveDict(entry['headers']))
+
+    def store(self, url: str, headers: Dict[str, str], body: bytes) -> Dict[str, Any]:
+        # The body is stored decoded, so transfer headers no longer apply
+        headers = {k: v for k, v in headers.items() if k.lower() not in _TRANSFER_HEADERS}
+        entry = {'url': url, 'headers': headers, 'stored_at': time.time(),
+                 'digest': hashlib.sha256(body).hexdigest()}
+        self._write(self._path(url) + '.body', body)
+        self._write(self._path(url) + '.json', json.dumps(entry).encode('utf-8'))
+        self.counters['stored'] += 1
+        return dict(entry, body=body)
+
+    def touch(self, entry: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+        """Refresh a stored entry after a 304, merging the updated headers"""
+        entry = dict(entry)
+        entry['headers'] = {**entry['headers'], **{k: v for k, v in headers.items()
+                                                   if k.lower() not in _TRANSFER_HEADERS}}
+        entry['stored_at'] = time.time()
+        meta = {k: v for k, v in entry.items() if k != 'body'}
+        self._write(self._path(entry['url']) + '.json', json.dumps(meta).encode('utf-8'))
+        return entry
+
+    def _write(self, path: str, data: bytes):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {'directory': self.directory, **self.counters}
+
+
+class CachingAdapter(HTTPAdapter):
+    """Transport adapter that answers GETs from a DiskHttpCache when allowed and revalidates otherwise"""
+
+    def __init__(self, cache: DiskHttpCache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        if request.method != 'GET':
+            return super().send(request, **kwargs)
+        entry = self.cache.lookup(request.url)
+        if entry is not None and self.cache._fresh(entry):
+            self.cache.counters['hits'] += 1
+            return self._from_entry(request, entry, 'HIT')
+        if entry is not None:
+            stored_headers = CaseInsensitiveDict(entry['headers'])
+            if stored_headers.get('ETag'):
+                request.headers['If-None-Match'] = stored_headers['ETag']
+            if stored_headers.get('Last-Modified'):
+                request.headers['If-Modified-Since'] = stored_headers['Last-Modified']
+
+        response = super().send(request, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            self.cache.counters['revalidated'] += 1
+            response.close()
+            return self._from_entry(request, self.cache.touch(entry, response.headers), 'REVALIDATED')
+        self.cache.counters['misses'] += 1
+        response.headers['X-Cache'] = 'MISS'
+        if response.status_code == 200 and 'no-store' not in _cache_control(response.headers):
+            if kwargs.get('stream'):
+                # Stored only if the caller reads the body to the end
+                headers = dict(response.headers)
+                response.raw = _TeeReader(response.raw, lambda body: self.cache.store(request.url, headers, body))
+                response.headers['X-Cache'] = 'MISS-STORING'
+            else:
+                stored = self.cache.store(request.url, response.headers, response.content)
+                response.headers['X-Body-Digest'] = stored['digest']
+        return response
+
+    @staticmethod
+    def _from_entry(request: requests.PreparedRequest, entry: Dict[str, Any], outcome: str) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.url = request.url
+        response.request = request
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.headers['X-Cache'] = outcome
+        response.headers['X-Body-Digest'] = entry['digest']
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = entry['body']
+        return response
+
+
+class _TeeReader:
+    """Wraps a streamed raw response and hands the complete decoded body to a callback at EOF"""
+
+    def __init__(self, raw, on_complete):
+        self._raw = raw
+        self._on_complete = on_complete
+        self._chunks: list = []
+
+    def stream(self, amt: int = 65536, decode_content: Optional[bool] = None):
+        for chunk in self._raw.stream(amt, decode_content=True):
+            if self._chunks is not None:
+                self._chunks.append(chunk)
+            yield chunk
+        self._finish()
+
+    def read(self, amt: Optional[int] = None, **kwargs) -> bytes:
+        data = self._raw.read(amt, decode_content=True)
+        if data and self._chunks is not None:
+            self._chunks.append(data)
+        if not data or amt is None:
+            self._finish()
+        return data
+
+    def _finish(self):
+        if self._chunks is not None:
+            body, self._chunks = b''.join(self._chunks), None
+            try:
+                self._on_complete(body)
+            except OSError as e:
+                print(f"Warning: Could not store response in HTTP cache: {e}")
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
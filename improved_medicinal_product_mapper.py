@@ -6,13 +6,47 @@ Accepts XML input and generates XML output with SNOMED CT and ATC codes
 
 import requests
 import json
+import os
 import sys
+import tempfile
 import xml.etree.ElementTree as ET
-import re
-from typing import Dict, List, Optional, Any, Tuple
-from dataclasses import dataclass
+import contextvars
+import glob
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Any, Tuple
+from dataclasses import asdict, dataclass
+from urllib.parse import urlparse
 
+from atc_extractor import PAGE_SECTION_END, ExtractResult, extract_atc_codes, stream_atc_codes
+from batch_planner import BatchPlanner
+from cache_snapshot import DEFAULT_CACHE_SNAPSHOT, CacheSnapshot, write_snapshot
+from catalogue_matcher import CatalogueMatch, CatalogueMatcher, match_score, normalize_name
+from compact_catalogue import intern, with_slots
+from felleskatalogen_index import DEFAULT_MISS_INDEX, KnownMissIndex
+from http_cache import CachingAdapter, DiskHttpCache
+from lookup_cache import LookupCache, SqliteCacheStore
+from memory_budget import MemoryBudget, MemoryTier, estimate_entries_size, start_tracing, top_allocations
+from mapping_journal import MappingJournal, journal_path_for
+import profiling
+import tracing
+from previous_output import PreviousMapping, PreviousOutput, find_previous_output, format_mapped_at
+import replay_archive
+from replay_archive import DEFAULT_REPLAY_ARCHIVE, ReplayArchive
+from terminology_index import DEFAULT_ONLY_PRODUCT_MAP, OnlyProductIndex
+from upstream_client import (ConcurrencyLimiters, PriorityExecutor, ResilientClient, TokenBucket, UpstreamUnavailable,
+                             route_of)
 
+
+# Only-products of one substance concept, without dose-form specific products
+_ONLY_PRODUCT_ECL = ("< 763158003 |Medicinal product| : 127489000 |Has active ingredient| = << {} "
+                     "MINUS (* : 411116001 |Has manufactured dose form| = *)")
+
+
+@with_slots
 @dataclass
 class MedicinalProduct:
     """Represents a medicinal product from the API response"""
@@ -23,7 +57,13 @@ class MedicinalProduct:
     definitionStatus: str
     effectiveTime: str
 
+    def __post_init__(self):
+        # A handful of distinct values shared by every product; keep one copy of each
+        self.definitionStatus = intern(self.definitionStatus)
+        self.effectiveTime = intern(self.effectiveTime)
 
+
+@with_slots
 @dataclass
 class MedicationData:
     """Represents medication data from XML input"""
@@ -35,16 +75,77 @@ class MedicationData:
     ref_1_advice: Optional[str] = None
 
 
+class _PerThread:
+    """Mapper attribute kept per thread, so concurrent lookups don't overwrite each other's context"""
+    
+    def __init__(self, default: Callable[[], Any]):
+        self.default = default
+    
+    def __set_name__(self, owner, name):
+        self.name = name
+    
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        state = obj._thread_state
+        if not hasattr(state, self.name):
+            setattr(state, self.name, self.default())
+        return getattr(state, self.name)
+    
+    def __set__(self, obj, value):
+        setattr(obj._thread_state, self.name, value)
+
+
 class XMLMedicinalProductMapper:
     """XML-based mapper with SNOMED CT and ATC code lookup"""
     
-    def __init__(self, base_url: str = "http://dailybuild.terminologi.helsedirektoratet.no"):
+    # Debug helpers for the last decision context of the calling thread
+    _last_candidates = _PerThread(list)
+    _last_confidence = _PerThread(lambda: None)
+    _last_degraded = _PerThread(lambda: False)
+    _last_stale_age = _PerThread(lambda: None)
+    
+    def __init__(self, base_url: str = "http://dailybuild.terminologi.helsedirektoratet.no",
+                 felleskatalogen_url: str = "https://www.felleskatalogen.no/medisin/substansregister/"):
         self.base_url = base_url.rstrip('/')
+        self.felleskatalogen_url = felleskatalogen_url.rstrip('/') + '/'
         self.session = requests.Session()
         self.session.headers.update({
             'Accept': 'application/json',
             'User-Agent': 'XML-Medicinal-Product-Mapper/1.0'
         })
+        # Adaptive in-flight limits per upstream host; Felleskatalogen is a public site, so start low
+        # Interactive requests go first; BULK_MIN_SHARE of the slots stays reserved for waiting bulk work
+        self.limiters = ConcurrencyLimiters(host_overrides={
+            urlparse(self.felleskatalogen_url).netloc: {'initial_limit': 2, 'max_limit': 8}
+        }, bulk_min_share=float(os.environ.get('BULK_MIN_SHARE', 0.2)))
+        # Felleskatalogen pages rarely change: with HTTP_CACHE_DIR set, keep them on disk and
+        # revalidate with ETag/Last-Modified
+        self.http_cache = self._open_http_cache(os.environ.get('HTTP_CACHE_DIR', ''))
+        if self.http_cache is not None:
+            self.session.mount(self.felleskatalogen_url, CachingAdapter(self.http_cache))
+        # REPLAY_MODE=record saves upstream answers to REPLAY_ARCHIVE and replay answers from it with no
+        # network; in record and fallback mode the archive also answers when an upstream fails
+        self.replay_mode = (os.environ.get('REPLAY_MODE') or 'off').lower()
+        self.replay_archive = self._open_replay_archive(
+            self.replay_mode, os.environ.get('REPLAY_ARCHIVE', DEFAULT_REPLAY_ARCHIVE))
+        if self.replay_archive is None:
+            self.replay_mode = 'off'
+        elif self.replay_mode in ('record', 'replay'):
+            replay_archive.install(self.session, self.replay_archive, self.replay_mode)
+        # ATC codes already extracted per (page URL, body digest); unchanged pages are not parsed again
+        self._extracted_atc: 'OrderedDict[Tuple[str, str], str]' = OrderedDict()
+        self._extracted_lock = threading.Lock()
+        self._transfer = {'pages': 0, 'bytes_read': 0, 'closed_early': 0}
+        # Request rate towards felleskatalogen.no, shared by all threads and worker processes
+        self.felleskatalogen_rate = TokenBucket.from_env('FELLESKATALOGEN', default_rate=2.0, default_burst=5)
+        # Request rate towards Snowstorm, shared the same way (matters when batch workers run in parallel)
+        self.snowstorm_rate = TokenBucket.from_env('SNOWSTORM', default_rate=20.0, default_burst=40)
+        # Snowstorm calls go through hedging, retries and a circuit breaker
+        # (replayed answers are not rate limited: they never reach Snowstorm)
+        self.snowstorm = ResilientClient(self.session, name='snowstorm', limiters=self.limiters,
+                                         rate_limit=None if self.replay_mode == 'replay' else self.snowstorm_rate,
+                                         archive=self.replay_archive)
         # Language preference: Norwegian then English for Snowstorm description matching
         self.accept_language = 'nb-x-sct,en-x-sct'
         # Aliases to improve recall across languages/terms
@@ -54,19 +155,282 @@ class XMLMedicinalProductMapper:
             'oksytocin': ['oxytocin'],
             'cetylpyridin': ['cetylpyridinium'],
         }
-        # Debug helpers for last decision context
-        self._last_candidates: List[Dict[str, Any]] = []
-        self._last_confidence: Optional[int] = None
+        # Pre-built substance -> only-product map; turns the per-substance ECL query into a dict lookup
+        self.only_product_map_path = os.environ.get('ONLY_PRODUCT_MAP', DEFAULT_ONLY_PRODUCT_MAP)
+        self._only_product_index: Optional[OnlyProductIndex] = None
+        self._catalogue_matcher: Optional[Tuple[Tuple, CatalogueMatcher]] = None
+        self._indexes_ready = threading.Event()
+        # Mapping results per normalized substance name
+        # Expired entries are served at once (marked with their age) and refreshed in the background,
+        # until they are LOOKUP_CACHE_MAX_STALE seconds past the TTL; after that the lookup blocks
+        # LOOKUP_CACHE_DB adds a persistent SQLite tier shared by every process that points at it
+        self.lookup_cache = LookupCache(ttl=float(os.environ.get('LOOKUP_CACHE_TTL', 86400)),
+                                        max_stale=float(os.environ.get('LOOKUP_CACHE_MAX_STALE', 604800)),
+                                        store=self._open_cache_store(os.environ.get('LOOKUP_CACHE_DB', '')))
+        # Prebuilt read-only results shipped with the deployment; mapped lazily on the first lookup
+        self.cache_snapshot_path = os.environ.get('CACHE_SNAPSHOT', DEFAULT_CACHE_SNAPSHOT)
+        self.cache_snapshot: Optional[CacheSnapshot] = CacheSnapshot(self.cache_snapshot_path)
+        # Substances known to have no Felleskatalogen page go straight to the fallback table
+        self.felleskatalogen_misses = KnownMissIndex(os.environ.get('FELLESKATALOGEN_MISS_INDEX', DEFAULT_MISS_INDEX))
+        # Concepts inactivated since the snapshot was built; snapshot answers pointing at them are skipped.
+        # Saved next to the only-product map, so a restart does not serve them again
+        self._retired_concepts: set = set()
+        self._thread_state = threading.local()
+        # ATC lookups run beside the SNOMED lookup of the same substance
+        self._atc_executor: Optional[PriorityExecutor] = None
+        self._refresh_executor: Optional[ThreadPoolExecutor] = None
+        self._refreshing: set = set()
+        self._executor_lock = threading.Lock()
+        # Memory per structure; MEMORY_BUDGET_MB caps their total, trimming the evictable tiers in this order
+        # (cheapest to rebuild first) whenever the total exceeds it
+        self.memory_budget = MemoryBudget([
+            MemoryTier('extracted_atc_memo', self._extracted_memory_usage, self._evict_extracted),
+            MemoryTier('snowstorm_responses', self.snowstorm.cache_memory_usage, self.snowstorm.evict_cached),
+            MemoryTier('lookup_cache', self.lookup_cache.memory_usage, self.lookup_cache.evict_oldest),
+            MemoryTier('only_product_index', self._index_memory_usage),
+            MemoryTier('felleskatalogen_misses', self.felleskatalogen_misses.memory_usage),
+            MemoryTier('cache_snapshot_mmap', self._snapshot_memory_usage)
+        ], limit_bytes=int(float(os.environ.get('MEMORY_BUDGET_MB') or 0) * 1024 * 1024))
+        # MEMORY_TRACE=1 records allocation sites (slow; for diagnosis), listed by get_metrics
+        if os.environ.get('MEMORY_TRACE'):
+            start_tracing()
+        # Local indexes are opened in the background so construction returns straight away
+        threading.Thread(target=self._open_indexes, name='open-indexes', daemon=True).start()
+    
+    @staticmethod
+    def _open_cache_store(path: str) -> Optional[SqliteCacheStore]:
+        if not path:
+            return None
+        try:
+            return SqliteCacheStore(path)
+        except Exception as e:
+            print(f"Warning: Persistent lookup cache disabled, could not open '{path}': {e}")
+            return None
+    
+    @staticmethod
+    def _open_http_cache(directory: str) -> Optional[DiskHttpCache]:
+        if not directory:
+            return None
+        try:
+            return DiskHttpCache(directory)
+        except OSError as e:
+            print(f"Warning: HTTP cache disabled, could not use '{directory}': {e}")
+            return None
+    
+    @staticmethod
+    def _open_replay_archive(mode: str, path: str) -> Optional[ReplayArchive]:
+        if mode == 'off':
+            return None
+        if mode not in replay_archive.MODES:
+            print(f"Warning: Unknown REPLAY_MODE '{mode}'; use record, replay or fallback")
+            return None
+        try:
+            return ReplayArchive(path)
+        except Exception as e:
+            print(f"Warning: Replay archive disabled, could not open '{path}': {e}")
+            return None
+    
+    def _open_indexes(self):
+        try:
+            index = OnlyProductIndex.load(self.only_product_map_path)
+            if not self._indexes_ready.is_set():
+                self._only_product_index = index
+            if self.cache_snapshot is not None:
+                len(self.cache_snapshot)
+                self._retired_concepts |= self._load_retired_concepts(self.only_product_map_path)
+            self.felleskatalogen_misses.load_saved()
+        except Exception as e:
+            print(f"Warning: Could not open local indexes: {e}")
+        finally:
+            self._indexes_ready.set()
+    
+    def _snapshot_version(self) -> Optional[str]:
+        snapshot = self.cache_snapshot
+        if snapshot is None or not len(snapshot):
+            return None
+        return snapshot.metadata.get('version')
+    
+    def _load_retired_concepts(self, map_path: str) -> set:
+        """Retired concepts saved by an earlier sync, if they were recorded against the current snapshot"""
+        path = _retired_concepts_path(map_path)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return set()
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not load retired concepts '{path}': {e}")
+            return set()
+        if data.get('snapshot_version') != self._snapshot_version():
+            return set()
+        return set(data.get('concepts', []))
+    
+    def _save_retired_concepts(self, map_path: str):
+        path = _retired_concepts_path(map_path)
+        directory = os.path.dirname(path) or '.'
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump({'snapshot_version': self._snapshot_version(),
+                           'concepts': sorted(self._retired_concepts)}, file)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Warning: Could not save retired concepts '{path}': {e}")
+    
+    def _extracted_memory_usage(self) -> Dict[str, int]:
+        with self._extracted_lock:
+            return {'entries': len(self._extracted_atc),
+                    'bytes': estimate_entries_size(self._extracted_atc, self._extracted_atc.items(),
+                                                   len(self._extracted_atc))}
+    
+    def _evict_extracted(self, count: int) -> int:
+        with self._extracted_lock:
+            count = min(count, len(self._extracted_atc))
+            for _ in range(count):
+                self._extracted_atc.popitem(last=False)
+        return count
+    
+    def _index_memory_usage(self) -> Dict[str, int]:
+        # Not through the property: metrics must not wait for the index to finish loading
+        index = self._only_product_index
+        return index.memory_usage() if index is not None else {'entries': 0, 'bytes': 0}
+    
+    def _snapshot_memory_usage(self) -> Dict[str, int]:
+        snapshot = self.cache_snapshot
+        return snapshot.memory_usage() if snapshot is not None else {'entries': 0, 'bytes': 0}
+    
+    @property
+    def only_product_index(self) -> Optional[OnlyProductIndex]:
+        """The only-product map; the first lookups wait for the background load"""
+        self._indexes_ready.wait()
+        return self._only_product_index
+    
+    @only_product_index.setter
+    def only_product_index(self, index: Optional[OnlyProductIndex]):
+        self._only_product_index = index
+        self._indexes_ready.set()
     
     def find_medicinal_product_for_substance(self, substance_name: str) -> Optional[MedicinalProduct]:
         """Find the medicinal product Concept ID using multiple search strategies"""
+        with tracing.span('mapper.find_medicinal_product', substance=substance_name) as span:
+            key = self._normalize_name(substance_name)
+            cached, stale_age = self._cached('snomed', key, substance_name)
+            if cached is not None:
+                product = self._product_from_cache(cached)
+                self._last_stale_age = stale_age
+            else:
+                product = self._lookup_medicinal_product(substance_name)
+                self._store_snomed(key, product)
+                self._last_stale_age = None
+            span.set_attributes(found=product is not None, concept_id=product.conceptId if product else None,
+                                degraded=self._last_degraded)
+            return product
+    
+    def _lookup_medicinal_product(self, substance_name: str) -> Optional[MedicinalProduct]:
+        """Uncached lookup behind find_medicinal_product_for_substance"""
         # Two-step ontology search: Ingredient -> Only product
         self._last_candidates = []
         self._last_confidence = None
+        self._last_degraded = False
         substance_candidates = self._find_substance_concepts(substance_name)
+        products_by_concept = {
+            sub['conceptId']: self._find_only_product_for_substance(sub['conceptId'])
+            for sub in substance_candidates[:5]
+        }
+        return self._select_medicinal_product(substance_name, substance_candidates, products_by_concept)
+    
+    def _cached(self, namespace: str, key: str, substance_name: str) -> Tuple[Optional[Any], Optional[float]]:
+        """Cached result from the lookup cache, else from the prebuilt snapshot, with its age when stale.
+        A stale answer schedules a background refresh; answers past the hard staleness limit are not served.
+
+        Snapshot answers do not age with the lookup cache's TTL: they hold for the terminology
+        release the snapshot was built from, and are stale (never expired) once the local
+        only-product map has been synced to a newer one.
+        """
+        with tracing.span('cache.lookup', **{'cache.namespace': namespace, 'substance': substance_name}) as span:
+            entry = self.lookup_cache.get_entry(namespace, key)
+            if entry is None and self.cache_snapshot is not None:
+                # The retired concepts saved by earlier syncs are loaded with the indexes
+                self._indexes_ready.wait()
+                value = self.cache_snapshot.get(namespace, key)
+                if value is not None and not (namespace == 'snomed' and self._retired_concepts
+                                              and _mentions_concepts(value, self._retired_concepts)):
+                    span.set_attribute('cache.source', 'snapshot')
+                    if not self._snapshot_outdated():
+                        span.set_attribute('cache.status', 'hit')
+                        return value, None
+                    span.set_attribute('cache.status', 'stale')
+                    self._schedule_refresh(namespace, key, substance_name)
+                    return value, self.cache_snapshot.age()
+            if entry is None or not self.lookup_cache.servable(entry[1]):
+                span.set_attribute('cache.status', 'miss' if entry is None else 'expired')
+                return None, None
+            value, age = entry
+            span.set_attributes(**{'cache.source': 'memory', 'cache.age_seconds': round(age)})
+            if not self.lookup_cache.is_stale(age):
+                span.set_attribute('cache.status', 'hit')
+                return value, None
+            span.set_attribute('cache.status', 'stale')
+            self._schedule_refresh(namespace, key, substance_name)
+            return value, age
+    
+    def _snapshot_outdated(self) -> bool:
+        """Whether the snapshot predates the terminology release the only-product map is synced to
+        (daily-build changes in between are covered by the retired concepts)"""
+        index = self._only_product_index
+        built_for = self.cache_snapshot.metadata.get('effective_time') if self.cache_snapshot else None
+        if index is None or not index.effective_time or not built_for:
+            return False
+        return str(built_for) < str(index.effective_time)
+    
+    def _schedule_refresh(self, namespace: str, key: str, substance_name: str):
+        """Refresh a stale entry in the background; one refresh per entry at a time"""
+        with self._executor_lock:
+            if (namespace, key) in self._refreshing:
+                return
+            self._refreshing.add((namespace, key))
+            if self._refresh_executor is None:
+                self._refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='cache-refresh')
+            executor = self._refresh_executor
+        executor.submit(self._refresh_entry, namespace, key, substance_name)
+    
+    def _refresh_entry(self, namespace: str, key: str, substance_name: str):
+        try:
+            if namespace == 'snomed':
+                self._store_snomed(key, self._lookup_medicinal_product(substance_name))
+            else:
+                atc_codes, complete = self._fetch_atc_codes(substance_name)
+                if complete:
+                    self.lookup_cache.put('atc', key, atc_codes)
+        except Exception as e:
+            print(f"Warning: Background refresh of '{substance_name}' failed: {e}")
+        finally:
+            with self._executor_lock:
+                self._refreshing.discard((namespace, key))
+    
+    def _store_snomed(self, key: str, product: Optional[MedicinalProduct]):
+        """Cache a SNOMED CT decision with its context; degraded answers are not cached"""
+        self.memory_budget.maybe_enforce()
+        if key and not self._last_degraded:
+            self.lookup_cache.put('snomed', key, {
+                'product': asdict(product) if product else None,
+                'confidence': self._last_confidence,
+                'candidates': self._last_candidates
+            })
+    
+    def _product_from_cache(self, cached: Dict[str, Any]) -> Optional[MedicinalProduct]:
+        self._last_confidence = cached['confidence']
+        self._last_candidates = cached['candidates']
+        self._last_degraded = False
+        return MedicinalProduct(**cached['product']) if cached['product'] else None
+    
+    def _select_medicinal_product(self, substance_name: str, substance_candidates: List[Dict[str, Any]],
+                                  products_by_concept: Dict[str, List[MedicinalProduct]]) -> Optional[MedicinalProduct]:
+        """Rank the only-products of the substance candidates, falling back to term-based strategies"""
         ranked: List[Tuple[MedicinalProduct, int]] = []
         for sub in substance_candidates[:5]:
-            products = self._find_only_product_for_substance(sub['conceptId'])
+            products = products_by_concept.get(sub['conceptId'], [])
             for p in products:
                 score = 0
                 # FSN pattern bonus
@@ -93,7 +457,10 @@ class XMLMedicinalProductMapper:
 
         # Fallback to prior term-based strategies
         for strat in (self._search_with_strategy_1, self._search_with_strategy_2, self._search_with_strategy_3):
-            product = strat(substance_name)
+            with tracing.span('mapper.strategy', strategy=strat.__name__.rsplit('_', 1)[-1],
+                              substance=substance_name) as span:
+                product = strat(substance_name)
+                span.set_attributes(found=product is not None, concept_id=product.conceptId if product else None)
             if product:
                 self._last_confidence = self._calculate_match_score(product, substance_name)
                 self._last_candidates = [{
@@ -105,6 +472,82 @@ class XMLMedicinalProductMapper:
                 return product
         return None
     
+    def map_substance(self, substance_name: str) -> Dict[str, Any]:
+        """Map one substance to SNOMED CT and ATC, running both lookups at the same time"""
+        # The copied context carries the caller's request priority to the ATC thread
+        atc_future = self._get_atc_executor().submit(contextvars.copy_context().run, profiling.call_in_task,
+                                                     self._atc_codes, substance_name)
+        try:
+            medicinal_product = self.find_medicinal_product_for_substance(substance_name)
+            result = self._build_result(medicinal_product, substance_name)
+        finally:
+            result_atc, atc_stale_age = atc_future.result()
+        self._add_atc(result, result_atc, atc_stale_age)
+        return result
+    
+    def _add_atc(self, result: Dict[str, Any], atc_codes: str, stale_age: Optional[float]):
+        result['atc_codes'] = atc_codes
+        if stale_age is not None:
+            result['stale_seconds']['atc'] = round(stale_age)
+    
+    def map_substance_names(self, substance_names: List[str],
+                            max_workers: int = 8) -> List[Tuple[str, Dict[str, Any]]]:
+        """Map a plain list of names; returns (name, result) per input position, in input order
+
+        Names equal after normalization are looked up only once; empty names get a not-found result.
+        """
+        planner = BatchPlanner(self, max_workers=max_workers)
+        plan = planner.plan(substance_names)
+        return planner.fan_out_rows(plan, planner.execute(plan))
+    
+    def compact_result(self, substance_name: str, result: Dict[str, Any]) -> Dict[str, Any]:
+        """Compact per-name record for bulk responses"""
+        return {
+            'substance': substance_name,
+            'snomed_ct': result['conceptId'] if result.get('found') else 'SNOMED CT not found',
+            'atc_codes': result.get('atc_codes', 'ATC code not found'),
+            'found': result.get('found', False),
+            'match_type': result.get('match_type', 'Not found')
+        }
+    
+    def _build_result(self, medicinal_product: Optional[MedicinalProduct], substance_name: str) -> Dict[str, Any]:
+        """Result entry for one substance, including this thread's decision context"""
+        if medicinal_product:
+            result = {
+                'found': True,
+                'conceptId': medicinal_product.conceptId,
+                'fsn': medicinal_product.fsn,
+                'pt': medicinal_product.pt,
+                'status': medicinal_product.definitionStatus,
+                'effectiveTime': medicinal_product.effectiveTime,
+                'match_type': self._classify_match(medicinal_product, substance_name),
+                'confidence': self._last_confidence,
+                'candidates': self._last_candidates
+            }
+        else:
+            result = {
+                'found': False,
+                'conceptId': None,
+                'fsn': None,
+                'pt': None,
+                'status': None,
+                'effectiveTime': None,
+                'match_type': 'Not found',
+                'confidence': None,
+                'candidates': []
+            }
+        result['degraded'] = self._last_degraded
+        # Age of any cached answers that were served past their TTL while a refresh runs
+        result['stale_seconds'] = {} if self._last_stale_age is None else {'snomed': round(self._last_stale_age)}
+        return result
+    
+    def _get_atc_executor(self) -> PriorityExecutor:
+        with self._executor_lock:
+            if self._atc_executor is None:
+                # Shared by batches and single lookups; interactive lookups start first
+                self._atc_executor = PriorityExecutor(max_workers=8, thread_name_prefix='atc-lookup')
+            return self._atc_executor
+    
     def _search_with_strategy_1(self, substance_name: str) -> Optional[MedicinalProduct]:
         """Strategy 1: Search for exact 'Product containing only [substance]'"""
         search_terms = [
@@ -156,16 +599,18 @@ class XMLMedicinalProductMapper:
         return None
 
     def _normalize_name(self, text: str) -> str:
-        if not text:
-            return ''
-        t = text.strip().lower()
-        t = re.sub(r"\s+", " ", t)
-        t = t.replace('ø', 'o').replace('å', 'a').replace('æ', 'ae')
-        return t
+        return normalize_name(text)
 
     def _find_substance_concepts(self, substance_name: str, limit: int = 20) -> List[Dict[str, Any]]:
-        url = f"{self.base_url}/snowstorm/snomed-ct/MAIN%2FSNOMEDCT-NO/concepts"
         ecl_substance = "<< 105590001 |Substance|"
+        with tracing.span('snowstorm.find_substance_concepts', substance=substance_name,
+                          **{'ecl.shape': ecl_substance}) as span:
+            concepts = self._query_substance_concepts(substance_name, ecl_substance, limit)
+            span.set_attributes(**{'result.count': len(concepts), 'degraded': self._last_degraded})
+            return concepts
+
+    def _query_substance_concepts(self, substance_name: str, ecl_substance: str, limit: int) -> List[Dict[str, Any]]:
+        url = f"{self.base_url}/snowstorm/snomed-ct/MAIN%2FSNOMEDCT-NO/concepts"
         concepts: Dict[str, Dict[str, Any]] = {}
         for term in self._get_substance_variations(substance_name):
             params = {
@@ -177,9 +622,7 @@ class XMLMedicinalProductMapper:
                 'acceptLanguage': self.accept_language
             }
             try:
-                r = self.session.get(url, params=params)
-                r.raise_for_status()
-                data = r.json()
+                data = self.snowstorm.get_json(url, params=params)
                 for item in data.get('items', []):
                     cid = item.get('conceptId')
                     if not cid:
@@ -195,17 +638,29 @@ class XMLMedicinalProductMapper:
                     prev = concepts.get(cid)
                     if not prev or score > prev['score']:
                         concepts[cid] = {'conceptId': cid, 'fsn': fsn, 'pt': pt, 'score': score}
+            except UpstreamUnavailable:
+                self._last_degraded = True
+                continue
             except Exception as e:
                 print(f"Error finding substance '{term}': {e}")
                 continue
         return sorted(concepts.values(), key=lambda x: x['score'], reverse=True)
 
     def _find_only_product_for_substance(self, substance_concept_id: str, limit: int = 50) -> List[MedicinalProduct]:
+        with tracing.span('snowstorm.find_only_products', substance_concept_id=substance_concept_id,
+                          **{'ecl.shape': _ONLY_PRODUCT_ECL}) as span:
+            if self.only_product_index is not None:
+                records = self.only_product_index.products_for_substance(substance_concept_id)
+                if records is not None:
+                    span.set_attributes(**{'source': 'only_product_index', 'result.count': min(len(records), limit)})
+                    return [MedicinalProduct(**record) for record in records[:limit]]
+            products = self._query_only_products(substance_concept_id, limit)
+            span.set_attributes(**{'source': 'snowstorm', 'result.count': len(products)})
+            return products
+
+    def _query_only_products(self, substance_concept_id: str, limit: int) -> List[MedicinalProduct]:
         url = f"{self.base_url}/snowstorm/snomed-ct/MAIN%2FSNOMEDCT-NO/concepts"
-        ecl = (
-            "< 763158003 |Medicinal product| : 127489000 |Has active ingredient| = << {} "
-            "MINUS (* : 411116001 |Has manufactured dose form| = *)"
-        ).format(substance_concept_id)
+        ecl = _ONLY_PRODUCT_ECL.format(substance_concept_id)
         params = {
             'activeFilter': 'true',
             'ecl': ecl,
@@ -214,9 +669,7 @@ class XMLMedicinalProductMapper:
             'acceptLanguage': self.accept_language
         }
         try:
-            r = self.session.get(url, params=params)
-            r.raise_for_status()
-            items = r.json().get('items', [])
+            items = self.snowstorm.get_json(url, params=params).get('items', [])
             products: List[MedicinalProduct] = []
             for item in items:
                 products.append(MedicinalProduct(
@@ -228,6 +681,9 @@ class XMLMedicinalProductMapper:
                     effectiveTime=item.get('effectiveTime', '')
                 ))
             return products
+        except UpstreamUnavailable:
+            self._last_degraded = True
+            return []
         except Exception as e:
             print(f"Error ECL for substance {substance_concept_id}: {e}")
             return []
@@ -249,10 +705,7 @@ class XMLMedicinalProductMapper:
         }
         
         try:
-            response = self.session.get(url, params=params)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = self.snowstorm.get_json(url, params=params)
             products = []
             
             for item in data.get('items', []):
@@ -268,6 +721,9 @@ class XMLMedicinalProductMapper:
             
             return products
             
+        except UpstreamUnavailable:
+            self._last_degraded = True
+            return []
         except Exception as e:
             print(f"Error searching for '{search_term}': {e}")
             return []
@@ -282,32 +738,8 @@ class XMLMedicinalProductMapper:
         return exact_pattern in fsn
     
     def _calculate_match_score(self, product: MedicinalProduct, substance_name: str) -> int:
-        """Calculate a match score for a product"""
-        fsn = product.fsn.lower()
-        pt = product.pt.lower()
-        substance_lower = substance_name.lower()
-        
-        score = 0
-        
-        # Highest priority: "Product containing only [substance]"
-        if f"product containing only {substance_lower}" in fsn:
-            score += 100
-        elif f"product containing only {substance_lower}" in pt:
-            score += 100
-        
-        # High priority: "Product containing only [substance] (medicinal product)"
-        elif f"product containing only {substance_lower}" in fsn and "(medicinal product)" in fsn:
-            score += 90
-        
-        # Medium priority: Contains the substance name
-        elif substance_lower in fsn:
-            score += 50
-        
-        # Lower priority: Partial matches
-        elif any(word in fsn for word in substance_lower.split()):
-            score += 25
-        
-        return score
+        """Calculate a match score for a product (shared with the batch catalogue matcher)"""
+        return match_score(product.fsn, product.pt, substance_name)
     
     def _is_good_match(self, product: MedicinalProduct, substance_name: str) -> bool:
         """Check if this is a good match for the substance"""
@@ -340,62 +772,147 @@ class XMLMedicinalProductMapper:
     
     def get_atc_codes_from_felleskatalogen(self, substance_name: str) -> str:
         """Get ATC codes from Felleskatalogen website"""
+        return self._atc_codes(substance_name)[0]
+    
+    def _atc_codes(self, substance_name: str) -> Tuple[str, Optional[float]]:
+        """ATC codes with the age of the cached answer when it was served stale"""
+        key = self._normalize_name(substance_name)
+        cached, stale_age = self._cached('atc', key, substance_name)
+        if cached is not None:
+            return cached, stale_age
+        with tracing.span('felleskatalogen.fetch_atc', substance=substance_name) as span:
+            atc_codes, complete = self._fetch_atc_codes(substance_name)
+            span.set_attributes(atc_codes=atc_codes, complete=complete)
+        if key and complete:
+            self.lookup_cache.put('atc', key, atc_codes)
+            self.memory_budget.maybe_enforce()
+        return atc_codes, None
+    
+    def _fetch_atc_codes(self, substance_name: str) -> Tuple[str, bool]:
+        """Uncached ATC lookup; the flag is False when Felleskatalogen could not be reached"""
+        if self.felleskatalogen_misses.is_known_miss(substance_name):
+            tracing.current().set_attribute('felleskatalogen.known_miss', True)
+            return self._get_fallback_atc_codes(substance_name), True
         try:
             # Search for the substance on Felleskatalogen
-            search_url = "https://www.felleskatalogen.no/medisin/substansregister/"
+            search_url = self.felleskatalogen_url
             
             # Try to find the substance page directly
-            substance_url = f"https://www.felleskatalogen.no/medisin/substansregister/{substance_name.lower()}"
+            substance_url = f"{self.felleskatalogen_url}{substance_name.lower()}"
             
-            response = self.session.get(substance_url, timeout=10)
+            response = self._felleskatalogen_get(substance_url, stream=True)
             
             if response.status_code == 200:
-                atc_codes = self._extract_atc_codes_from_html(response.text, substance_name)
+                atc_codes = self._extract_page_atc_codes(response, substance_name)
                 if atc_codes:
-                    return atc_codes
+                    return atc_codes, True
+            response.close()
+            
+            # The saved register answers the search for names it does not mention
+            if response.status_code in (200, 404) and self.felleskatalogen_misses.register_lacks(substance_name):
+                tracing.current().set_attribute('felleskatalogen.register_lacks', True)
+                return self._get_fallback_atc_codes(substance_name), True
             
             # If direct URL doesn't work, try searching
-            search_response = self.session.get(search_url, timeout=10)
+            search_response = self._felleskatalogen_get(search_url, stream=True)
             if search_response.status_code == 200:
-                # Look for the substance in the search results
-                atc_codes = self._search_substance_in_html(search_response.text, substance_name)
+                # Look for the substance in the search results, reading the register page in chunks
+                if search_response.headers.get('X-Body-Digest'):
+                    atc_codes = self._search_substance_in_html(search_response.text, substance_name)
+                else:
+                    found = self._record_transfer(stream_atc_codes(search_response, section_end=None,
+                                                                   term=substance_name.lower()))
+                    atc_codes = found.joined() if found.term_found else ""
                 if atc_codes:
-                    return atc_codes
+                    return atc_codes, True
+            search_response.close()
+            
+            # Both pages answered without codes: remember the miss so the next lookup skips them
+            if search_response.status_code == 200 and response.status_code in (200, 404):
+                self.felleskatalogen_misses.record_miss(substance_name)
             
             # Fallback to predefined ATC codes
             fallback_codes = self._get_fallback_atc_codes(substance_name)
-            return fallback_codes
+            return fallback_codes, search_response.status_code == 200
             
         except Exception as e:
             print(f"Warning: Could not fetch ATC codes for '{substance_name}': {e}")
             fallback_codes = self._get_fallback_atc_codes(substance_name)
-            return fallback_codes
+            return fallback_codes, False
+    
+    def _felleskatalogen_get(self, url: str, stream: bool = False) -> requests.Response:
+        """GET a Felleskatalogen page within the shared rate limit and the host's concurrency limit
+        (with stream, the limiter slot covers the response headers; the body is read by the caller)"""
+        with tracing.span('felleskatalogen.request', **{'http.url': url}) as span:
+            if self.replay_mode == 'replay' or (self.http_cache is not None and self.http_cache.is_fresh(url)):
+                # Answered from the archive or from disk; nothing goes over the network
+                response = self.session.get(url, timeout=10)
+            else:
+                try:
+                    with self.limiters.for_url(url).slot(route=route_of(url)) as outcome:
+                        # Taken inside the slot so interactive lookups are not queued behind bulk reservations
+                        self.felleskatalogen_rate.acquire()
+                        outcome['started'] = time.monotonic()
+                        response = self.session.get(url, timeout=10, stream=stream)
+                        outcome['status'] = response.status_code
+                        profiling.record_upstream(url, time.monotonic() - outcome['started'])
+                except requests.RequestException:
+                    response = self._archived_page(url)
+                    if response is None:
+                        raise
+                else:
+                    if response.status_code >= 500 or response.status_code == 429:
+                        archived = self._archived_page(url)
+                        if archived is not None:
+                            response.close()
+                            response = archived
+            span.set_attributes(**{'http.status_code': response.status_code,
+                                   'cache.status': response.headers.get('X-Cache'),
+                                   'replay.status': response.headers.get('X-Replay')})
+            return response
+    
+    def _archived_page(self, url: str) -> Optional[requests.Response]:
+        """Recorded answer for a Felleskatalogen page that could not be fetched, when there is an archive"""
+        if self.replay_archive is None:
+            return None
+        return self.replay_archive.fallback_response(self.session.prepare_request(requests.Request('GET', url)))
+    
+    def _extract_page_atc_codes(self, response: requests.Response, substance_name: str) -> str:
+        """ATC codes of a page, parsed only when its body differs from the last time it was seen"""
+        digest = response.headers.get('X-Body-Digest')
+        if not digest:
+            # Read from the network: stop once the section with the ATC entries has ended, unless the
+            # page is being cached, in which case it is read to the end once so later lookups cost a 304
+            storing = response.headers.get('X-Cache') == 'MISS-STORING'
+            return self._record_transfer(stream_atc_codes(response, drain=storing)).joined()
+        memo_key = (response.url, digest)
+        with self._extracted_lock:
+            if memo_key in self._extracted_atc:
+                self._extracted_atc.move_to_end(memo_key)
+                return self._extracted_atc[memo_key]
+        atc_codes = self._extract_atc_codes_from_html(response.text, substance_name)
+        with self._extracted_lock:
+            self._extracted_atc[memo_key] = atc_codes
+            while len(self._extracted_atc) > 1024:
+                self._extracted_atc.popitem(last=False)
+        return atc_codes
+    
+    def _record_transfer(self, result: ExtractResult) -> ExtractResult:
+        with self._extracted_lock:
+            self._transfer['pages'] += 1
+            self._transfer['bytes_read'] += result.bytes_read
+            self._transfer['closed_early'] += int(result.closed_early)
+        return result
     
     def _extract_atc_codes_from_html(self, html_content: str, substance_name: str) -> str:
-        """Extract ATC codes from HTML content"""
-        atc_codes = []
-        
-        # Look for ATC-koder pattern in the HTML
-        atc_pattern = r'ATC-koder:\s*([^<]+)'
-        matches = re.findall(atc_pattern, html_content, re.IGNORECASE)
-        
-        for match in matches:
-            # Split by comma and clean up each code
-            codes = [code.strip() for code in match.split(',')]
-            atc_codes.extend(codes)
-        
-        # Remove duplicates and empty strings
-        atc_codes = list(set([code for code in atc_codes if code]))
-        
-        if atc_codes:
-            return ', '.join(atc_codes)
-        return ""
+        """Extract the ATC codes of a substance page (all its 'ATC-koder:' entries, in page order)"""
+        return ', '.join(extract_atc_codes(html_content, section_end=PAGE_SECTION_END))
     
     def _search_substance_in_html(self, html_content: str, substance_name: str) -> str:
         """Search for substance in HTML content and extract ATC codes"""
         # Look for the substance name in the HTML
         if substance_name.lower() in html_content.lower():
-            return self._extract_atc_codes_from_html(html_content, substance_name)
+            return ', '.join(extract_atc_codes(html_content))
         return ""
     
     def _get_fallback_atc_codes(self, substance_name: str) -> str:
@@ -435,14 +952,23 @@ class XMLMedicinalProductMapper:
             root = ET.fromstring(xml_content)
             
             medications = []
+            # Advice texts and references repeat across the rows of an export. Share one copy of
+            # each within this parse rather than sys.intern-ing client text for the process lifetime
+            shared: Dict[str, str] = {}
+
+            def text(tag: str, default: Optional[str]) -> Optional[str]:
+                elem = medication_elem.find(tag)
+                value = elem.text if elem is not None else default
+                return shared.setdefault(value, value) if value is not None else None
+
             for medication_elem in root.findall('.//Medication'):
                 medication = MedicationData(
-                    sub_id=medication_elem.find('sub_id').text if medication_elem.find('sub_id') is not None else '',
-                    substance=medication_elem.find('substance').text if medication_elem.find('substance') is not None else '',
-                    advice=medication_elem.find('advice').text if medication_elem.find('advice') is not None else '',
-                    ref_1_id=medication_elem.find('ref_1_id').text if medication_elem.find('ref_1_id') is not None else None,
-                    ref_1_name=medication_elem.find('ref_1_name').text if medication_elem.find('ref_1_name') is not None else None,
-                    ref_1_advice=medication_elem.find('ref_1_advice').text if medication_elem.find('ref_1_advice') is not None else None
+                    sub_id=text('sub_id', ''),
+                    substance=text('substance', ''),
+                    advice=text('advice', ''),
+                    ref_1_id=text('ref_1_id', None),
+                    ref_1_name=text('ref_1_name', None),
+                    ref_1_advice=text('ref_1_advice', None)
                 )
                 medications.append(medication)
             
@@ -460,6 +986,7 @@ class XMLMedicinalProductMapper:
         # Create XML structure
         root = ET.Element('XML-File')
         root.set('xmlns:xsi', 'http://www.w3.org/2001/XMLSchema-instance')
+        now = time.time()
         
         for medication in medications:
             medication_elem = ET.SubElement(root, 'Medication')
@@ -467,9 +994,11 @@ class XMLMedicinalProductMapper:
             # Get SNOMED CT and ATC codes
             substance_name = medication.substance
             result = results.get(substance_name, {})
+            # When the row was last looked up; incremental runs remap rows once this gets too old
+            medication_elem.set('mapped_at', format_mapped_at(result.get('mapped_at') or now))
             
             snomed_ct = result.get('conceptId', 'SNOMED CT not found') if result.get('found') else 'SNOMED CT not found'
-            atc_code = self.get_atc_codes_from_felleskatalogen(substance_name)
+            atc_code = result['atc_codes'] if 'atc_codes' in result else self.get_atc_codes_from_felleskatalogen(substance_name)
             
             # Add SNOMED CT and ATC codes
             snomed_elem = ET.SubElement(medication_elem, 'snomed_ct')
@@ -593,8 +1122,15 @@ class XMLMedicinalProductMapper:
             self._output_number_counter += 1
             return self._output_number_counter
     
-    def map_medications_from_xml(self, xml_content: str, max_medications: int = 10) -> Tuple[List[MedicationData], Dict[str, Dict]]:
-        """Map medications from XML input to medicinal products"""
+    def map_medications_from_xml(self, xml_content: str, max_medications: int = 10,
+                                 journal: Optional[MappingJournal] = None,
+                                 previous: Optional[PreviousOutput] = None) -> Tuple[List[MedicationData], Dict[str, Dict]]:
+        """Map medications from XML input to medicinal products
+
+        With a journal, rows already in it are taken from it and every newly mapped row is
+        appended as soon as it completes. With a previous output, unchanged rows mapped within
+        its max_age reuse their previous snomed_ct and atc values.
+        """
         # Parse XML input
         medications = self.parse_xml_input(xml_content)
         
@@ -605,39 +1141,57 @@ class XMLMedicinalProductMapper:
         if len(medications) > max_medications:
             medications = medications[:max_medications]
         
-        # Map each substance to medicinal products
-        results = {}
-        for medication in medications:
-            substance_name = medication.substance
-            
-            medicinal_product = self.find_medicinal_product_for_substance(substance_name)
+        results: Dict[str, Dict] = {}
+        pending = medications
+        on_result = None
+        if journal is not None or previous is not None:
+            journaled = journal.load() if journal is not None else {}
+            pending = []
+            for medication in medications:
+                result = journal.resume(medication.sub_id, medication.substance, journaled) if journal else None
+                if result is None and previous is not None:
+                    reused = previous.reuse(medication.sub_id, medication.substance)
+                    result = self._reused_result(reused) if reused is not None else None
+                if result is not None:
+                    results[medication.substance] = result
+                else:
+                    pending.append(medication)
+        if journal is not None:
+            rows_by_key: Dict[str, List[MedicationData]] = {}
+            for medication in pending:
+                rows_by_key.setdefault(self._normalize_name(medication.substance), []).append(medication)
             
-            if medicinal_product:
-                results[substance_name] = {
-                    'found': True,
-                    'conceptId': medicinal_product.conceptId,
-                    'fsn': medicinal_product.fsn,
-                    'pt': medicinal_product.pt,
-                    'status': medicinal_product.definitionStatus,
-                    'effectiveTime': medicinal_product.effectiveTime,
-                    'match_type': self._classify_match(medicinal_product, substance_name)
-                }
-            else:
-                results[substance_name] = {
-                    'found': False,
-                    'conceptId': None,
-                    'fsn': None,
-                    'pt': None,
-                    'status': None,
-                    'effectiveTime': None,
-                    'match_type': 'Not found'
-                }
-            
-            # Look up ATC codes (silently)
-            atc_codes = self.get_atc_codes_from_felleskatalogen(substance_name)
+            def on_result(key: str, result: Dict[str, Any]):
+                for medication in rows_by_key.get(key, []):
+                    journal.record(medication.sub_id, medication.substance, result)
+        
+        # Plan first: duplicates and spelling variants collapse to one lookup per unique substance
+        planner = BatchPlanner(self)
+        plan = planner.plan([medication.substance for medication in pending])
+        with tracing.span('mapper.map_batch', rows=len(medications), pending=len(pending), unique=plan.unique_count):
+            results.update(planner.fan_out(plan, planner.execute(plan, on_result)))
         
         return medications, results
     
+    def _reused_result(self, mapping: PreviousMapping) -> Dict[str, Any]:
+        """Result entry for a row carried over from a previous output"""
+        found = mapping.snomed_ct != 'SNOMED CT not found'
+        return {
+            'found': found,
+            'conceptId': mapping.snomed_ct if found else None,
+            'fsn': None,
+            'pt': None,
+            'status': None,
+            'effectiveTime': None,
+            'match_type': 'Reused from previous output' if found else 'Not found',
+            'confidence': None,
+            'candidates': [],
+            'degraded': False,
+            'stale_seconds': {},
+            'atc_codes': mapping.atc,
+            'mapped_at': mapping.mapped_at
+        }
+    
     def _classify_match(self, product: MedicinalProduct, substance_name: str) -> str:
         """Classify the type of match"""
         if self._is_exact_only_match(product, substance_name):
@@ -651,6 +1205,107 @@ class XMLMedicinalProductMapper:
             else:
                 return "Low priority match"
     
+    def match_catalogue(self, substance_names: List[str], top_k: int = 5) -> Dict[str, List[CatalogueMatch]]:
+        """Best products of the local only-product map for every name, in one pass and without upstream
+        calls; scores are those of _calculate_match_score"""
+        index = self.only_product_index
+        if index is None:
+            return {name: [] for name in substance_names}
+        with self._executor_lock:
+            # Built once per index version; a refresh or a sync that changed it builds a new one
+            version = (index, index.head_timestamp, len(index.products))
+            if self._catalogue_matcher is None or self._catalogue_matcher[0] != version:
+                self._catalogue_matcher = (version, CatalogueMatcher.from_index(index))
+            matcher = self._catalogue_matcher[1]
+        return dict(zip(substance_names, matcher.match(substance_names, top_k=top_k)))
+    
+    def refresh_only_product_index(self, path: Optional[str] = None) -> OnlyProductIndex:
+        """Rebuild the only-product map from Snowstorm in one bulk export, save it and start using it"""
+        index = OnlyProductIndex.build(self.snowstorm, self.base_url, accept_language=self.accept_language)
+        index.save(path or self.only_product_map_path)
+        self.only_product_index = index
+        return index
+    
+    def sync_terminology(self, path: Optional[str] = None) -> Dict[str, Any]:
+        """Apply Snowstorm changes since the last sync to the local index and the lookup cache"""
+        path = path or self.only_product_map_path
+        if self.only_product_index is None:
+            index = self.refresh_only_product_index(path)
+            self.lookup_cache.clear()
+            return {'full_rebuild': True, 'products': len(index.products), 'substances': len(index)}
+        report = self.only_product_index.sync(self.snowstorm, self.base_url, accept_language=self.accept_language)
+        invalidated = 0
+        if not report.up_to_date:
+            self.only_product_index.save(path)
+            removed = set(report.removed)
+            if removed:
+                self._retired_concepts |= removed
+                self._save_retired_concepts(path)
+                invalidated = self.lookup_cache.invalidate_where(
+                    lambda namespace, key, value: namespace == 'snomed' and _mentions_concepts(value, removed))
+                self.snowstorm.invalidate_cached(
+                    lambda data: isinstance(data, dict) and any(
+                        isinstance(item, dict) and item.get('conceptId') in removed for item in data.get('items', [])))
+        return {
+            'full_rebuild': False,
+            'up_to_date': report.up_to_date,
+            'changed': report.changed,
+            'updated': report.updated,
+            'added': report.added,
+            'removed': len(report.removed),
+            'skipped': report.skipped,
+            'invalidated_mappings': invalidated,
+            'head_timestamp': report.head_timestamp,
+            'effective_time': report.effective_time,
+            'seconds': round(report.seconds, 2)
+        }
+    
+    def build_cache_snapshot(self, substance_names: List[str], path: Optional[str] = None) -> Dict[str, Any]:
+        """Resolve a warm-up corpus against the live upstreams and write it as a read-only snapshot"""
+        path = path or self.cache_snapshot_path
+        # Resolve everything fresh rather than copying answers from the snapshot being replaced
+        self.cache_snapshot = None
+        results = self.map_substance_names(substance_names)
+        keys = {self._normalize_name(name) for name, _ in results} - {''}
+        entries = [entry for entry in self.lookup_cache.export() if entry[1] in keys]
+        index = self.only_product_index
+        count = write_snapshot(path, entries, metadata={
+            'version': time.strftime('%Y%m%d%H%M%S', time.gmtime()),
+            'base_url': self.base_url,
+            'head_timestamp': index.head_timestamp if index else None,
+            'effective_time': index.effective_time if index else None,
+            'substances': len(keys)
+        })
+        self.cache_snapshot = CacheSnapshot(path)
+        self._retired_concepts = set()
+        degraded = len({self._normalize_name(name) for name, result in results if result.get('degraded')})
+        return {'path': path, 'entries': count, 'substances': len(keys), 'degraded_skipped': degraded}
+    
+    def refresh_felleskatalogen_index(self) -> KnownMissIndex:
+        """Rebuild the negative index from the full substance register page and save it"""
+        response = self._felleskatalogen_get(self.felleskatalogen_url)
+        response.raise_for_status()
+        self.felleskatalogen_misses.update_register(response.text)
+        self.felleskatalogen_misses.save()
+        return self.felleskatalogen_misses
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """Upstream health and counters for monitoring"""
+        return {
+            'lookup_cache': self.lookup_cache.snapshot(),
+            'cache_snapshot': self.cache_snapshot.snapshot() if self.cache_snapshot else None,
+            'snowstorm': self.snowstorm.metrics(),
+            'concurrency_limits': self.limiters.snapshot(),
+            'felleskatalogen_rate_limit': self.felleskatalogen_rate.snapshot(),
+            'snowstorm_rate_limit': self.snowstorm_rate.snapshot(),
+            'felleskatalogen_misses': self.felleskatalogen_misses.snapshot(),
+            'http_cache': self.http_cache.snapshot() if self.http_cache else None,
+            'felleskatalogen_transfer': dict(self._transfer),
+            'replay': dict(self.replay_archive.snapshot(), mode=self.replay_mode) if self.replay_archive else None,
+            'memory': self.memory_budget.snapshot(),
+            **({'top_allocations': top_allocations()} if tracemalloc.is_tracing() else {})
+        }
+    
     def print_summary(self, results: Dict[str, Dict]):
         """Print a summary of the mapping results"""
         print("\n" + "=" * 80)
@@ -678,16 +1333,295 @@ class XMLMedicinalProductMapper:
                     print(f"   {substance_name}")
 
 
+def _retired_concepts_path(map_path: str) -> str:
+    return os.path.join(os.path.dirname(map_path) or '.', 'retired_concepts.json')
+
+
+def _mentions_concepts(cached: Dict[str, Any], concept_ids: set) -> bool:
+    """Whether a cached SNOMED CT decision points at any of the given concepts"""
+    product = cached.get('product')
+    if product and product['conceptId'] in concept_ids:
+        return True
+    return any(candidate['conceptId'] in concept_ids for candidate in cached.get('candidates', []))
+
+
+def map_names_cli(mapper: XMLMedicinalProductMapper, args: List[str]):
+    """--names mode: map a JSON array of substance names and print compact JSON results"""
+    if not args:
+        print("❌ Please provide a JSON file or a JSON array of names after --names")
+        sys.exit(1)
+    source = args[0]
+    try:
+        if os.path.isfile(source):
+            with open(source, 'r', encoding='utf-8') as file:
+                names = json.load(file)
+        else:
+            names = json.loads(source)
+    except (OSError, ValueError) as e:
+        print(f"❌ Could not read names: {e}")
+        sys.exit(1)
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        print("❌ Names must be a JSON array of strings")
+        sys.exit(1)
+    
+    results = mapper.map_substance_names(names)
+    mapper.felleskatalogen_misses.flush()
+    records = [mapper.compact_result(name, result) for name, result in results]
+    found = sum(1 for record in records if record['found'])
+    print(json.dumps({
+        'results': records,
+        'summary': {
+            'total': len(names),
+            'unique': len({mapper._normalize_name(name) for name in names} - {''}),
+            'found': found,
+            'not_found': len(records) - found
+        }
+    }, ensure_ascii=False))
+
+
+# One mapper per batch worker process, reused for every file that process maps
+_worker_mapper: Optional[XMLMedicinalProductMapper] = None
+
+
+def _init_batch_worker(cache_db: str, rate_limit_state: str):
+    os.environ['LOOKUP_CACHE_DB'] = cache_db
+    os.environ['RATE_LIMIT_STATE'] = rate_limit_state
+
+
+def _map_xml_file(job: Tuple[str, str, int, str, str, bool]) -> Dict[str, Any]:
+    """Batch worker: map one XML file and write its output; returns a per-file summary"""
+    global _worker_mapper
+    input_path, output_path, max_medications, base_url, felleskatalogen_url, resume = job
+    start = time.monotonic()
+    try:
+        if _worker_mapper is None:
+            _worker_mapper = XMLMedicinalProductMapper(base_url=base_url, felleskatalogen_url=felleskatalogen_url)
+        mapper = _worker_mapper
+        with open(input_path, 'r', encoding='utf-8') as file:
+            xml_content = file.read()
+        journal = MappingJournal(journal_path_for(input_path))
+        if not resume:
+            journal.reset()
+        try:
+            medications, results = mapper.map_medications_from_xml(xml_content, max_medications, journal)
+        finally:
+            journal.close()
+        if not medications:
+            return {'input': input_path, 'error': 'No medications to process'}
+        output_xml = mapper.generate_xml_output(medications, results)
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        with open(output_path, 'w', encoding='utf-8') as file:
+            file.write(output_xml)
+        journal.reset()
+        mapper.felleskatalogen_misses.flush()
+        found = sum(1 for result in results.values() if result['found'])
+        return {
+            'input': input_path,
+            'output': output_path,
+            'medications': len(medications),
+            'found': found,
+            'not_found': len(results) - found,
+            'resumed': journal.snapshot()['resumed'],
+            'seconds': round(time.monotonic() - start, 2)
+        }
+    except Exception as e:
+        return {'input': input_path, 'error': str(e)}
+
+
+def expand_xml_inputs(patterns: List[str]) -> List[str]:
+    """XML files named by directories (all *.xml inside) and glob patterns, sorted, without duplicates"""
+    paths: List[str] = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = glob.glob(os.path.join(pattern, '*.xml'))
+        else:
+            matches = glob.glob(pattern)
+        paths.extend(sorted(path for path in matches if os.path.isfile(path)))
+    return list(dict.fromkeys(paths))
+
+
+def map_xml_batch(mapper: XMLMedicinalProductMapper, input_paths: List[str], workers: int = 0,
+                  max_medications: int = 10, resume: bool = False) -> List[Dict[str, Any]]:
+    """Map many XML files in a process pool; outputs are named with generate_output_filename.
+
+    Workers share lookups through the persistent cache (LOOKUP_CACHE_DB, defaulting to
+    Output/.lookup_cache.sqlite) and the upstream budget through the rate-limit state
+    (RATE_LIMIT_STATE, defaulting to Output/.rate_limit.sqlite).
+    Each file is journaled while it is mapped; with resume, journaled rows are not looked up again.
+    """
+    if not input_paths:
+        return []
+    cache_db = os.environ.get('LOOKUP_CACHE_DB') or os.path.join('Output', '.lookup_cache.sqlite')
+    rate_limit_state = os.environ.get('RATE_LIMIT_STATE') or os.path.join('Output', '.rate_limit.sqlite')
+    os.makedirs(os.path.dirname(rate_limit_state) or '.', exist_ok=True)
+    # Output names are assigned here, in input order, so workers never race for a number
+    jobs = [(path, mapper.generate_output_filename(path), max_medications, mapper.base_url,
+             mapper.felleskatalogen_url, resume)
+            for path in input_paths]
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker,
+                             initargs=(cache_db, rate_limit_state)) as pool:
+        return list(pool.map(_map_xml_file, jobs))
+
+
+def map_batch_cli(mapper: XMLMedicinalProductMapper, args: List[str]):
+    """--xml-dir mode: <directory | glob>... [--workers N] [--max-medications N] [--resume]"""
+    args = list(args)
+    resume = '--resume' in args
+    if resume:
+        args.remove('--resume')
+    options = {'--workers': 0, '--max-medications': 10}
+    for option in options:
+        if option in args:
+            position = args.index(option)
+            options[option] = int(args[position + 1])
+            del args[position:position + 2]
+    input_paths = expand_xml_inputs(args)
+    if not input_paths:
+        print("❌ No XML files found. Provide a directory or a glob pattern after --xml-dir")
+        sys.exit(1)
+    
+    print(f"📁 Mapping {len(input_paths)} XML files")
+    start = time.monotonic()
+    summaries = map_xml_batch(mapper, input_paths, options['--workers'], options['--max-medications'], resume)
+    for summary in summaries:
+        if 'error' in summary:
+            print(f"   ❌ {summary['input']}: {summary['error']}")
+        else:
+            resumed = f", {summary['resumed']} resumed" if summary['resumed'] else ''
+            print(f"   ✅ {summary['input']} -> {summary['output']} "
+                  f"({summary['found']}/{summary['medications']} found{resumed}, {summary['seconds']}s)")
+    
+    done = [summary for summary in summaries if 'error' not in summary]
+    medications = sum(summary['medications'] for summary in done)
+    found = sum(summary['found'] for summary in done)
+    print("\n" + "=" * 80)
+    print("XML BATCH SUMMARY")
+    print("=" * 80)
+    print(f"📄 Files: {len(done)} mapped, {len(summaries) - len(done)} failed")
+    print(f"📊 Total medications: {medications}")
+    print(f"✅ Found: {found}")
+    print(f"❌ Not found: {medications - found}")
+    if medications:
+        print(f"📈 Success rate: {(found / medications) * 100:.1f}%")
+    print(f"⏱️  Wall-clock time: {time.monotonic() - start:.1f}s")
+    if len(done) < len(summaries):
+        sys.exit(1)
+
+
+def load_warmup_corpus(mapper: XMLMedicinalProductMapper, paths: List[str], top_n: int = 500) -> List[str]:
+    """Substance names from XML input files and JSON name lists (most frequent first, first top_n kept)"""
+    names: List[str] = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as file:
+            content = file.read()
+        if path.lower().endswith('.json'):
+            names.extend(name for name in json.loads(content)[:top_n] if isinstance(name, str))
+        else:
+            names.extend(medication.substance for medication in mapper.parse_xml_input(content))
+    return names
+
+
+def build_snapshot_cli(mapper: XMLMedicinalProductMapper, args: List[str]):
+    """--build-snapshot mode: [output_file] [--top-n N] [corpus files (.xml / .json)...]"""
+    args = list(args)
+    top_n = 500
+    if '--top-n' in args:
+        position = args.index('--top-n')
+        top_n = int(args[position + 1])
+        del args[position:position + 2]
+    path = args.pop(0) if args and args[0].endswith('.bin') else mapper.cache_snapshot_path
+    corpus = args or ['Testsett/testsett.xml']
+    try:
+        names = load_warmup_corpus(mapper, corpus, top_n)
+    except (OSError, ValueError) as e:
+        print(f"❌ Could not read warm-up corpus: {e}")
+        sys.exit(1)
+    print(f"🔄 Resolving {len(names)} warm-up names from {', '.join(corpus)}")
+    print(json.dumps(mapper.build_cache_snapshot(names, path), indent=2))
+
+
 def main():
-    """Main function"""
+    """Main function; --profile saves a profile of the run, --trace-memory lists where memory went"""
+    if '--trace-memory' not in sys.argv[1:]:
+        run_profiled()
+        return
+    sys.argv.remove('--trace-memory')
+    start_tracing()
+    baseline = tracemalloc.take_snapshot()
+    try:
+        run_profiled()
+    finally:
+        print("\n🧠 Largest memory growth by source line:")
+        for site in top_allocations(limit=15, baseline=baseline):
+            print(f"   {site['growth_kib']:>10.1f} KiB  {site['location']} ({site['blocks']} blocks)")
+
+
+def run_profiled():
+    """run_cli, with a profile of the run when --profile is given"""
+    if '--profile' not in sys.argv[1:]:
+        run_cli()
+        return
+    sys.argv.remove('--profile')
+    label = 'cli_' + sys.argv[1].lstrip('-') if len(sys.argv) > 1 else 'cli'
+    profile = None
+    try:
+        with profiling.profiled(label) as profile:
+            run_cli()
+    finally:
+        # Also reached when the command ends with sys.exit
+        if profile is not None and profile.path:
+            print(f"\n⏱️  Profile saved to '{profile.path}' (JSON summary beside it)")
+
+
+def run_cli():
+    """Run the command given on the command line"""
     if len(sys.argv) < 2:
-        print("Usage: python improved_medicinal_product_mapper.py --xml <xml_file>")
+        print("Usage: python improved_medicinal_product_mapper.py --xml <xml_file> [--resume] [--previous [output_file]] [--max-age-days N]")
         print("   OR: python improved_medicinal_product_mapper.py --xml-content <xml_content>")
         print("   OR: python improved_medicinal_product_mapper.py --test (uses Testsett/test_medications.xml)")
+        print("   OR: python improved_medicinal_product_mapper.py --xml-dir <directory | glob>... [--workers N] [--max-medications N] [--resume]")
+        print("   OR: python improved_medicinal_product_mapper.py --names <json_file | json_array>")
+        print("   OR: python improved_medicinal_product_mapper.py --build-only-product-map [output_file]")
+        print("   OR: python improved_medicinal_product_mapper.py --sync-terminology [map_file]")
+        print("   OR: python improved_medicinal_product_mapper.py --build-felleskatalogen-index")
+        print("   OR: python improved_medicinal_product_mapper.py --build-snapshot [snapshot.bin] [--top-n N] [corpus ...]")
+        print("   Add --profile to any of these to save a profile of the run, --trace-memory to list memory use")
         sys.exit(1)
     
     mapper = XMLMedicinalProductMapper()
     
+    if sys.argv[1] == "--xml-dir":
+        map_batch_cli(mapper, sys.argv[2:])
+        return
+    
+    if sys.argv[1] == "--names":
+        map_names_cli(mapper, sys.argv[2:])
+        return
+    
+    if sys.argv[1] == "--build-only-product-map":
+        path = sys.argv[2] if len(sys.argv) > 2 else mapper.only_product_map_path
+        print(f"🔄 Building only-product map from {mapper.base_url}")
+        index = mapper.refresh_only_product_index(path)
+        print(f"💾 Saved {len(index.products)} products for {len(index)} substances to '{path}'")
+        return
+    
+    if sys.argv[1] == "--build-snapshot":
+        build_snapshot_cli(mapper, sys.argv[2:])
+        return
+    
+    if sys.argv[1] == "--build-felleskatalogen-index":
+        print(f"🔄 Reading the substance register at {mapper.felleskatalogen_url}")
+        index = mapper.refresh_felleskatalogen_index()
+        print(f"💾 Saved the substance register ({len(index.register_names)} names) to '{index.path}'")
+        return
+    
+    if sys.argv[1] == "--sync-terminology":
+        path = sys.argv[2] if len(sys.argv) > 2 else None
+        print(json.dumps(mapper.sync_terminology(path), indent=2))
+        return
+    
+    resume = '--resume' in sys.argv[2:]
     if sys.argv[1] == "--xml":
         if len(sys.argv) < 3:
             print("❌ Please provide an XML filename after --xml")
@@ -734,12 +1668,46 @@ def main():
         print("❌ Invalid option. Use --xml, --xml-content, or --test")
         sys.exit(1)
     
+    # Incremental run: unchanged rows reuse the previous output (the latest for this input by default)
+    previous = None
+    if '--previous' in sys.argv[2:]:
+        position = sys.argv.index('--previous')
+        following = sys.argv[position + 1:position + 2]
+        previous_path = following[0] if following and not following[0].startswith('--') else find_previous_output(filename)
+        max_age_days = 30.0
+        if '--max-age-days' in sys.argv[2:]:
+            max_age_days = float(sys.argv[sys.argv.index('--max-age-days') + 1])
+        if previous_path is None:
+            print(f"⚠️  No previous output found for '{filename}'; mapping every row")
+        else:
+            try:
+                previous = PreviousOutput.load(previous_path, max_age_days * 86400)
+                print(f"♻️  Reusing unchanged rows mapped within {max_age_days:g} days from '{previous_path}'")
+            except (OSError, ET.ParseError) as e:
+                print(f"⚠️  Could not read previous output '{previous_path}': {e}; mapping every row")
+    
+    # Checkpoint journal: completed rows survive a crash and are skipped with --resume
+    journal = MappingJournal(journal_path_for(filename))
+    if resume:
+        print(f"♻️  Resuming from journal '{journal.path}'")
+    else:
+        journal.reset()
+    
     # Map medications from XML
-    medications, results = mapper.map_medications_from_xml(xml_content)
+    try:
+        medications, results = mapper.map_medications_from_xml(xml_content, journal=journal, previous=previous)
+    finally:
+        journal.close()
     
     if not medications:
         print("❌ No medications to process")
         sys.exit(1)
+    if resume:
+        print(f"♻️  {journal.snapshot()['resumed']} of {len(medications)} rows taken from the journal")
+    if previous is not None:
+        counts = previous.snapshot()
+        print(f"♻️  {counts['reused']} rows reused, {counts['changed']} new or changed, "
+              f"{counts['expired']} remapped because their mapping was too old")
     
     # Print summary
     mapper.print_summary(results)
@@ -756,6 +1724,8 @@ def main():
     
     with open(output_filename, 'w', encoding='utf-8') as file:
         file.write(output_xml)
+    journal.reset()
+    mapper.felleskatalogen_misses.flush()
     
     print(f"\n💾 XML output saved to: '{output_filename}'")
     print(f"\n🎉 XML mapping complete! Check the generated XML file for your results.")
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+JSON encoding and decoding for the mapper and the MCP server
+Uses orjson when it is installed (pip install orjson) and the standard library otherwise.
+Output is UTF-8 text with non-ASCII characters kept as-is in both cases.
+"""
+
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+def dumps(data: Any, indent: bool = False) -> str:
+    """Serialize to a JSON string; compact separators unless indent is set (two spaces)"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0).decode('utf-8')
+        except TypeError:
+            # Types orjson refuses (e.g. integers beyond 64 bits) go through the standard library
+            pass
+    if indent:
+        return json.dumps(data, indent=2, ensure_ascii=False)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """Parse a JSON document from text or UTF-8 bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
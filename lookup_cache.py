@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Lookup cache for the medicinal product mapper
+Mapping results per namespace ('snomed', 'atc') and normalized substance name, with TTL and LRU eviction.
+Entries past the TTL can still be served as stale (while the caller refreshes them) until max_stale runs out.
+An optional SQLite store persists entries across restarts and shares them between worker processes.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from memory_budget import estimate_entries_size
+
+
+class SqliteCacheStore:
+    """Persistent second tier for LookupCache; safe to share between processes"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS entries (namespace TEXT NOT NULL, key TEXT NOT NULL, '
+                         'stored_at REAL NOT NULL, value TEXT NOT NULL, PRIMARY KEY (namespace, key))')
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread and process; connections must not cross a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, namespace: str, key: str) -> Optional[Tuple[float, Any]]:
+        row = self._connection().execute('SELECT stored_at, value FROM entries WHERE namespace = ? AND key = ?',
+                                         (namespace, key)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def put(self, namespace: str, key: str, stored_at: float, value: Any):
+        with self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                         (namespace, key, stored_at, json.dumps(value, ensure_ascii=False)))
+
+    def delete(self, keys: List[Tuple[str, str]]):
+        with self._connection() as conn:
+            conn.executemany('DELETE FROM entries WHERE namespace = ? AND key = ?', keys)
+
+    def items(self) -> Iterator[Tuple[str, str, float, Any]]:
+        for namespace, key, stored_at, value in self._connection().execute(
+                'SELECT namespace, key, stored_at, value FROM entries').fetchall():
+            yield namespace, key, stored_at, json.loads(value)
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM entries')
+
+    def __len__(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+
+class LookupCache:
+    """Thread-safe in-memory TTL + LRU cache of mapping results"""
+
+    def __init__(self, ttl: float = 86400.0, max_entries: int = 20000, max_stale: float = 604800.0,
+                 store: Optional[SqliteCacheStore] = None):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.max_entries = max_entries
+        self.store = store
+        self._entries: 'OrderedDict[Tuple[str, str], Tuple[float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'invalidated': 0}
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        """Cached value, or None when missing or expired"""
+        entry = self.get_entry(namespace, key)
+        return entry[0] if entry is not None and entry[1] <= self.ttl else None
+
+    def get_entry(self, namespace: str, key: str) -> Optional[Tuple[Any, float]]:
+        """(value, age in seconds) while the entry is fresh or within max_stale past the TTL, else None"""
+        if self.store is not None:
+            with self._lock:
+                in_memory = (namespace, key) in self._entries
+            if not in_memory:
+                # Entries written by other processes (or before a restart) come in with their original age
+                stored = self._store_call(self.store.get, namespace, key)
+                if stored is not None:
+                    with self._lock:
+                        self._entries.setdefault((namespace, key), stored)
+                        self._evict()
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            age = time.time() - entry[0] if entry is not None else 0.0
+            if entry is None or age > self.ttl + self.max_stale:
+                if entry is not None:
+                    del self._entries[(namespace, key)]
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end((namespace, key))
+            self._counters['hits' if age <= self.ttl else 'stale_hits'] += 1
+            return entry[1], age
+
+    def is_stale(self, age: float) -> bool:
+        return age > self.ttl
+
+    def servable(self, age: float) -> bool:
+        """Whether a value of this age may still be served (fresh or within max_stale)"""
+        return age <= self.ttl + self.max_stale
+
+    def put(self, namespace: str, key: str, value: Any):
+        stored_at = time.time()
+        with self._lock:
+            self._entries[(namespace, key)] = (stored_at, value)
+            self._entries.move_to_end((namespace, key))
+            self._evict()
+        if self.store is not None:
+            self._store_call(self.store.put, namespace, key, stored_at, value)
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def evict_oldest(self, count: int) -> int:
+        """Drop up to count least recently used entries from memory (the persistent store keeps them)"""
+        with self._lock:
+            count = min(count, len(self._entries))
+            for _ in range(count):
+                self._entries.popitem(last=False)
+        return count
+
+    def memory_usage(self) -> Dict[str, int]:
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': estimate_entries_size(self._entries, self._entries.items(), len(self._entries))}
+
+    def _store_call(self, method: Callable, *args) -> Any:
+        try:
+            return method(*args)
+        except sqlite3.Error as e:
+            print(f"Warning: Persistent lookup cache '{self.store.path}' unavailable: {e}")
+            return None
+
+    def invalidate(self, namespace: str, key: str):
+        with self._lock:
+            if self._entries.pop((namespace, key), None) is not None:
+                self._counters['invalidated'] += 1
+        if self.store is not None:
+            self._store_call(self.store.delete, [(namespace, key)])
+
+    def invalidate_where(self, predicate: Callable[[str, str, Any], bool]) -> int:
+        """Drop every entry for which predicate(namespace, key, value) is true; returns the count"""
+        with self._lock:
+            doomed = [k for k, (_, value) in self._entries.items() if predicate(k[0], k[1], value)]
+            for k in doomed:
+                del self._entries[k]
+        if self.store is not None:
+            stored = self._store_call(lambda: [(namespace, key) for namespace, key, _, value in self.store.items()
+                                               if predicate(namespace, key, value)]) or []
+            self._store_call(self.store.delete, stored)
+            doomed = list(set(doomed) | set(stored))
+        with self._lock:
+            self._counters['invalidated'] += len(doomed)
+        return len(doomed)
+
+    def export(self, namespace: Optional[str] = None) -> List[Tuple[str, str, Any]]:
+        """Unexpired (namespace, key, value) entries, e.g. for writing a cache snapshot"""
+        now = time.time()
+        with self._lock:
+            return [(k[0], k[1], value) for k, (stored_at, value) in self._entries.items()
+                    if now - stored_at <= self.ttl and (namespace is None or k[0] == namespace)]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.store is not None:
+            self._store_call(self.store.clear)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'entries': len(self._entries), 'ttl_seconds': self.ttl, 'max_stale_seconds': self.max_stale,
+                    'persistent_store': self.store.path if self.store else None, **self._counters}
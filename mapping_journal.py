@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Checkpoint journal for long XML mapping runs
+Completed rows are appended to a JSON Lines file as they finish, so a run that is killed
+partway through can be resumed with --resume: journaled rows are taken from the file and
+only the rest is looked up again.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import json_codec
+
+DEFAULT_JOURNAL_DIR = 'Output'
+
+
+def journal_path_for(input_filename: str, directory: str = DEFAULT_JOURNAL_DIR) -> str:
+    """Journal file for one input file (inputs with the same name in different folders get their own)"""
+    base_name = os.path.basename(input_filename)
+    name = base_name.rsplit('.', 1)[0] if '.' in base_name else base_name
+    digest = hashlib.sha1(os.path.abspath(input_filename).encode('utf-8')).hexdigest()[:8]
+    return os.path.join(directory, f".journal_{name}_{digest}.jsonl")
+
+
+class MappingJournal:
+    """Append-only record of mapped rows, keyed by (sub_id, substance)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+        self._counters = {'resumed': 0, 'recorded': 0, 'skipped_lines': 0}
+
+    def load(self) -> Dict[Tuple[str, str], Dict[str, Any]]:
+        """Journaled results; a line cut off by a crash is skipped"""
+        entries: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        try:
+            with open(self.path, 'rb') as file:
+                for line in file:
+                    try:
+                        record = json_codec.loads(line)
+                        result = record['result']
+                        result.setdefault('mapped_at', record.get('mapped_at'))
+                        entries[(record['sub_id'], record['substance'])] = result
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        self._counters['skipped_lines'] += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Warning: Could not read mapping journal '{self.path}': {e}")
+        return entries
+
+    def resume(self, sub_id: str, substance: str, entries: Dict[Tuple[str, str], Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Journaled result for a row, or None when the row (or its substance) is new"""
+        result = entries.get((sub_id, substance))
+        if result is not None:
+            self._counters['resumed'] += 1
+        return result
+
+    def record(self, sub_id: str, substance: str, result: Dict[str, Any]):
+        """Append one finished row and flush it to disk"""
+        line = json_codec.dumps({'sub_id': sub_id, 'substance': substance,
+                                 'mapped_at': round(time.time()), 'result': result})
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._open()
+                self._file.write(line.encode('utf-8') + b'\n')
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._counters['recorded'] += 1
+            except OSError as e:
+                print(f"Warning: Could not write mapping journal '{self.path}': {e}")
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._file = open(self.path, 'a+b')
+        # Terminate a line left unfinished by a crash so the next record starts cleanly
+        if self._file.seek(0, os.SEEK_END) > 0:
+            self._file.seek(-1, os.SEEK_END)
+            if self._file.read(1) != b'\n':
+                self._file.write(b'\n')
+
+    def reset(self):
+        """Delete the journal: before a run without --resume, and once a run's output is written"""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {'path': self.path, **self._counters}
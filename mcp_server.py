@@ -19,17 +19,121 @@ except ImportError:
         
         def run(self):
             print(f"MCP Server '{self.name}' ready (FastMCP not installed - testing mode)")
-from improved_medicinal_product_mapper import XMLMedicinalProductMapper
-import json
+from typing import TYPE_CHECKING, Any, Dict, List
+import os
+import threading
+
+import json_codec
+from profiling import sampled
+from tracing import traced
+
+if TYPE_CHECKING:
+    from improved_medicinal_product_mapper import XMLMedicinalProductMapper
 
 # Initialize FastMCP server
 server = FastMCP("Medicinal Product Mapper")
 
-# Initialize the mapper
-mapper = XMLMedicinalProductMapper()
+# The mapper (requests, HTTP pools, local indexes) is built on the first tool call, not at import
+_mapper = None
+_mapper_lock = threading.Lock()
+
+
+def get_mapper() -> 'XMLMedicinalProductMapper':
+    """The shared mapper, created on first use"""
+    global _mapper
+    if _mapper is None:
+        with _mapper_lock:
+            if _mapper is None:
+                from improved_medicinal_product_mapper import XMLMedicinalProductMapper
+                _mapper = XMLMedicinalProductMapper()
+    return _mapper
+
+
+# Tool responses are compact JSON; set MCP_JSON_INDENT=1 for indented output when debugging
+_INDENT = os.environ.get('MCP_JSON_INDENT', '') not in ('', '0')
+
+RESPONSE_FORMATS = ('full', 'json', 'xml', 'compact')
+
+
+def _interactive():
+    """Context for single-substance tools: their upstream requests go ahead of bulk work"""
+    from upstream_client import INTERACTIVE, request_priority
+    return request_priority(INTERACTIVE)
+
+
+def _dumps(data: Any) -> str:
+    return json_codec.dumps(data, indent=_INDENT)
+
+
+def __getattr__(name):
+    # Keeps `from mcp_server import mapper` working without building the mapper at import time
+    if name == 'mapper':
+        return get_mapper()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def build_xml_mapping_response(mapper: 'XMLMedicinalProductMapper', medications: list, results: Dict[str, Dict],
+                               response_format: str = 'full', include_candidates: bool = False,
+                               include_advice: bool = False) -> Dict[str, Any]:
+    """Response body for map_medications_from_xml in the requested format"""
+    found = sum(1 for result in results.values() if result['found'])
+    response_data: Dict[str, Any] = {
+        "success": True,
+        "summary": {
+            "total": len(medications),
+            "found": found,
+            "not_found": sum(1 for result in results.values() if not result['found']),
+            "success_rate": (found / len(medications)) * 100
+        }
+    }
+    if response_format in ('full', 'xml'):
+        response_data["xml_output"] = mapper.generate_xml_output(medications, results)
+    if response_format == 'xml':
+        return response_data
+    
+    response_data["medications"] = []
+    for medication in medications:
+        substance_name = medication.substance
+        result = results.get(substance_name, {})
+        atc_codes = result['atc_codes'] if 'atc_codes' in result else mapper.get_atc_codes_from_felleskatalogen(substance_name)
+        
+        if response_format == 'compact':
+            medication_data = {"sub_id": medication.sub_id,
+                               **mapper.compact_result(substance_name, dict(result, atc_codes=atc_codes))}
+        else:
+            medication_data = {
+                "sub_id": medication.sub_id,
+                "substance": substance_name,
+                "snomed_ct": result.get('conceptId', 'SNOMED CT not found') if result.get('found') else 'SNOMED CT not found',
+                "atc_codes": atc_codes,
+                "found": result.get('found', False),
+                "match_type": result.get('match_type', 'Not found'),
+                "confidence": result.get('confidence')
+            }
+            # Add reference data if present
+            if medication.ref_1_id:
+                medication_data["ref_1_id"] = medication.ref_1_id
+            if medication.ref_1_name:
+                medication_data["ref_1_name"] = medication.ref_1_name
+        
+        # Candidates and advice text are large; only included on request
+        if include_candidates:
+            medication_data["candidates"] = result.get('candidates', [])
+        if include_advice:
+            medication_data["advice"] = medication.advice
+            if medication.ref_1_advice:
+                medication_data["ref_1_advice"] = medication.ref_1_advice
+        
+        response_data["medications"].append(medication_data)
+    return response_data
+
 
 @server.tool()
-def map_medications_from_xml(xml_content: str, max_medications: int = 10) -> str:
+@traced
+@sampled
+def map_medications_from_xml(xml_content: str, max_medications: int = 10, response_format: str = 'full',
+                             include_candidates: bool = False, include_advice: bool = False,
+                             previous_xml_output: str = '', max_age_days: float = 30.0) -> str:
     """
     Map substance names to SNOMED CT Concept IDs and ATC codes from XML input.
     
@@ -43,12 +147,19 @@ def map_medications_from_xml(xml_content: str, max_medications: int = 10) -> str
         xml_content: XML content containing medication data with substance names.
                     Expected format: <XML><XML-File><Medication><substance>Name</substance>...</Medication></XML-File></XML>
         max_medications: Maximum number of medications to process (default: 10, max: 50)
+        response_format: "full" (XML output and medications array, default), "json" (medications
+                    array only), "xml" (XML output only) or "compact" (short medication records only)
+        include_candidates: Include the ranked alternative SNOMED CT candidates per medication
+        include_advice: Include the advice text from the input per medication
+        previous_xml_output: xml_output of an earlier run on the same export (optional). Rows with
+                    unchanged sub_id and substance mapped within max_age_days reuse its values
+        max_age_days: Age after which a previous mapping is looked up again (default: 30)
         
     Returns:
         JSON string with mapping results including:
         - success: boolean indicating if operation succeeded
-        - xml_output: Generated XML with SNOMED CT and ATC codes added
-        - medications: Array of medication objects with mapping results
+        - xml_output: Generated XML with SNOMED CT and ATC codes added (full and xml formats)
+        - medications: Array of medication objects with mapping results (full, json and compact formats)
         - summary: Statistics about mapping success rates
         
     Example:
@@ -57,15 +168,35 @@ def map_medications_from_xml(xml_content: str, max_medications: int = 10) -> str
         - ATC codes: "B01A C06, B01A C30, N02B A01, N02B E51"
     """
     try:
+        if response_format not in RESPONSE_FORMATS:
+            return _dumps({
+                "success": False,
+                "error": f"Unknown response_format '{response_format}'; use one of {', '.join(RESPONSE_FORMATS)}",
+                "medications": []
+            })
+        mapper = get_mapper()
         # Enforce maximum medication limit
         if max_medications > 50:
             max_medications = 50
         
+        previous = None
+        if previous_xml_output:
+            from xml.etree.ElementTree import ParseError
+            from previous_output import PreviousOutput
+            try:
+                previous = PreviousOutput.parse(previous_xml_output, max_age_days * 86400)
+            except ParseError as e:
+                return _dumps({
+                    "success": False,
+                    "error": f"Could not parse previous_xml_output: {e}",
+                    "medications": []
+                })
+        
         # Parse XML and map medications
-        medications, results = mapper.map_medications_from_xml(xml_content, max_medications)
+        medications, results = mapper.map_medications_from_xml(xml_content, max_medications, previous=previous)
         
         if not medications:
-            return json.dumps({
+            return _dumps({
                 "success": False,
                 "error": "No medications found in XML input",
                 "medications": [],
@@ -75,55 +206,13 @@ def map_medications_from_xml(xml_content: str, max_medications: int = 10) -> str
                     "not_found": 0,
                     "success_rate": 0.0
                 }
-            }, indent=2)
+            })
         
-        # Generate XML output
-        output_xml = mapper.generate_xml_output(medications, results)
-        
-        # Prepare response data
-        response_data = {
-            "success": True,
-            "xml_output": output_xml,
-            "medications": [],
-            "summary": {
-                "total": len(medications),
-                "found": sum(1 for result in results.values() if result['found']),
-                "not_found": sum(1 for result in results.values() if not result['found']),
-                "success_rate": (sum(1 for result in results.values() if result['found']) / len(medications)) * 100
-            }
-        }
-        
-        # Add medication details
-        for medication in medications:
-            substance_name = medication.substance
-            result = results.get(substance_name, {})
-            
-            medication_data = {
-                "sub_id": medication.sub_id,
-                "substance": substance_name,
-                "advice": medication.advice,
-                "snomed_ct": result.get('conceptId', 'SNOMED CT not found') if result.get('found') else 'SNOMED CT not found',
-                "atc_codes": mapper.get_atc_codes_from_felleskatalogen(substance_name),
-                "found": result.get('found', False),
-                "match_type": result.get('match_type', 'Not found'),
-                "confidence": getattr(mapper, '_last_confidence', None),
-                "candidates": getattr(mapper, '_last_candidates', [])
-            }
-            
-            # Add reference data if present
-            if medication.ref_1_id:
-                medication_data["ref_1_id"] = medication.ref_1_id
-            if medication.ref_1_name:
-                medication_data["ref_1_name"] = medication.ref_1_name
-            if medication.ref_1_advice:
-                medication_data["ref_1_advice"] = medication.ref_1_advice
-            
-            response_data["medications"].append(medication_data)
-        
-        return json.dumps(response_data, indent=2)
+        return _dumps(build_xml_mapping_response(mapper, medications, results, response_format,
+                                                 include_candidates, include_advice))
         
     except Exception as e:
-        return json.dumps({
+        return _dumps({
             "success": False,
             "error": f"Error processing XML: {str(e)}",
             "medications": [],
@@ -133,9 +222,60 @@ def map_medications_from_xml(xml_content: str, max_medications: int = 10) -> str
                 "not_found": 0,
                 "success_rate": 0.0
             }
-        }, indent=2)
+        })
 
 @server.tool()
+@traced
+@sampled
+def map_substance_list(substance_names: List[str]) -> str:
+    """
+    Map a plain list of substance names to SNOMED CT Concept IDs and ATC codes in one call.
+    
+    Names are deduplicated after normalization (case, whitespace, æ/ø/å), each unique name
+    is mapped once with concurrent lookups, and a compact record is returned for every
+    input position, in input order (duplicates included).
+    Use this instead of calling map_single_medication many times.
+    
+    Args:
+        substance_names: JSON array of substance names (up to 5000)
+        
+    Returns:
+        JSON string with:
+        - success: boolean indicating if operation succeeded
+        - results: Array of {substance, snomed_ct, atc_codes, found, match_type}, one per input name
+        - summary: Counts of total, unique, found and not found names
+    """
+    try:
+        mapper = get_mapper()
+        truncated = len(substance_names) > 5000
+        names = substance_names[:5000]
+        
+        results = mapper.map_substance_names(names)
+        records = [mapper.compact_result(name, result) for name, result in results]
+        found = sum(1 for record in records if record['found'])
+        
+        return _dumps({
+            "success": True,
+            "results": records,
+            "summary": {
+                "total": len(names),
+                "unique": len({mapper._normalize_name(name) for name in names} - {''}),
+                "found": found,
+                "not_found": len(records) - found,
+                "truncated": truncated
+            }
+        })
+        
+    except Exception as e:
+        return _dumps({
+            "success": False,
+            "error": f"Error mapping substance list: {str(e)}",
+            "results": []
+        })
+
+@server.tool()
+@traced
+@sampled
 def get_atc_codes(substance_name: str) -> str:
     """
     Get ATC codes for a specific substance from Felleskatalogen.
@@ -147,25 +287,29 @@ def get_atc_codes(substance_name: str) -> str:
         JSON string with ATC codes for the substance
     """
     try:
-        atc_codes = mapper.get_atc_codes_from_felleskatalogen(substance_name)
+        mapper = get_mapper()
+        with _interactive():
+            atc_codes = mapper.get_atc_codes_from_felleskatalogen(substance_name)
         
-        return json.dumps({
+        return _dumps({
             "success": True,
             "substance": substance_name,
             "atc_codes": atc_codes,
             "source": "Felleskatalogen (https://www.felleskatalogen.no/medisin/substansregister/)"
-        }, indent=2)
+        })
         
     except Exception as e:
-        return json.dumps({
+        return _dumps({
             "success": False,
             "substance": substance_name,
             "error": f"Error looking up ATC codes: {str(e)}",
             "atc_codes": "ATC code not found"
-        }, indent=2)
+        })
 
 @server.tool()
-def map_single_medication(substance_name: str) -> str:
+@traced
+@sampled
+def map_single_medication(substance_name: str, include_candidates: bool = False) -> str:
     """
     Map a single substance to SNOMED CT Concept ID and ATC codes.
     
@@ -174,36 +318,40 @@ def map_single_medication(substance_name: str) -> str:
     
     Args:
         substance_name: Name of the substance to map
+        include_candidates: Include the ranked alternative SNOMED CT candidates
         
     Returns:
         JSON string with mapping results for the single substance
     """
     try:
-        # Find SNOMED CT mapping
-        medicinal_product = mapper.find_medicinal_product_for_substance(substance_name)
-        
-        # Get ATC codes
-        atc_codes = mapper.get_atc_codes_from_felleskatalogen(substance_name)
+        mapper = get_mapper()
+        # SNOMED CT and ATC lookups run concurrently
+        with _interactive():
+            result = mapper.map_substance(substance_name)
         
-        if medicinal_product:
-            return json.dumps({
+        if result['found']:
+            response_data = {
                 "success": True,
                 "substance": substance_name,
                 "snomed_ct": {
-                    "concept_id": medicinal_product.conceptId,
-                    "fsn": medicinal_product.fsn,
-                    "pt": medicinal_product.pt,
-                    "status": medicinal_product.definitionStatus,
-                    "effective_time": medicinal_product.effectiveTime,
-                    "match_type": mapper._classify_match(medicinal_product, substance_name)
+                    "concept_id": result['conceptId'],
+                    "fsn": result['fsn'],
+                    "pt": result['pt'],
+                    "status": result['status'],
+                    "effective_time": result['effectiveTime'],
+                    "match_type": result['match_type']
                 },
-                "atc_codes": atc_codes,
+                "atc_codes": result['atc_codes'],
                 "found": True,
-                "confidence": getattr(mapper, '_last_confidence', None),
-                "candidates": getattr(mapper, '_last_candidates', [])
-            }, indent=2)
+                "confidence": result['confidence'],
+                "degraded": result['degraded'],
+                "stale_seconds": result['stale_seconds']
+            }
+            if include_candidates:
+                response_data["candidates"] = result['candidates']
+            return _dumps(response_data)
         else:
-            return json.dumps({
+            return _dumps({
                 "success": True,
                 "substance": substance_name,
                 "snomed_ct": {
@@ -214,23 +362,27 @@ def map_single_medication(substance_name: str) -> str:
                     "effective_time": None,
                     "match_type": "Not found"
                 },
-                "atc_codes": atc_codes,
+                "atc_codes": result['atc_codes'],
                 "found": False,
                 "confidence": None,
-                "candidates": []
-            }, indent=2)
+                "degraded": result['degraded'],
+                "stale_seconds": result['stale_seconds'],
+                **({"candidates": []} if include_candidates else {})
+            })
             
     except Exception as e:
-        return json.dumps({
+        return _dumps({
             "success": False,
             "substance": substance_name,
             "error": f"Error mapping substance: {str(e)}",
             "snomed_ct": {"concept_id": "Error", "match_type": "Error"},
             "atc_codes": "Error",
             "found": False
-        }, indent=2)
+        })
 
 @server.tool()
+@traced
+@sampled
 def get_snomed_concept_id(substance_name: str) -> str:
     """
     Get SNOMED CT Concept ID for a specific substance.
@@ -242,10 +394,12 @@ def get_snomed_concept_id(substance_name: str) -> str:
         JSON string with SNOMED CT Concept ID and details
     """
     try:
-        medicinal_product = mapper.find_medicinal_product_for_substance(substance_name)
+        mapper = get_mapper()
+        with _interactive():
+            medicinal_product = mapper.find_medicinal_product_for_substance(substance_name)
         
         if medicinal_product:
-            return json.dumps({
+            return _dumps({
                 "success": True,
                 "substance": substance_name,
                 "concept_id": medicinal_product.conceptId,
@@ -255,23 +409,41 @@ def get_snomed_concept_id(substance_name: str) -> str:
                 "effective_time": medicinal_product.effectiveTime,
                 "match_type": mapper._classify_match(medicinal_product, substance_name),
                 "source": "SNOMED CT Norwegian Edition"
-            }, indent=2)
+            })
         else:
-            return json.dumps({
+            return _dumps({
                 "success": False,
                 "substance": substance_name,
                 "concept_id": "SNOMED CT not found",
                 "error": "No medicinal product found for this substance",
-                "source": "SNOMED CT Norwegian Edition"
-            }, indent=2)
+                "source": "SNOMED CT Norwegian Edition",
+                "degraded": getattr(mapper, '_last_degraded', False)
+            })
             
     except Exception as e:
-        return json.dumps({
+        return _dumps({
             "success": False,
             "substance": substance_name,
             "error": f"Error looking up SNOMED CT Concept ID: {str(e)}",
             "concept_id": "SNOMED CT not found"
-        }, indent=2)
+        })
+
+@server.tool()
+@traced
+@sampled
+def get_server_metrics() -> str:
+    """
+    Get upstream health metrics for the mapper.
+    
+    Returns:
+        JSON string with circuit breaker state, latency percentiles and request counters
+        for the Snowstorm terminology server, plus the current adaptive concurrency
+        limit per upstream host
+    """
+    return _dumps({
+        "success": True,
+        "metrics": get_mapper().get_metrics()
+    })
 
 if __name__ == "__main__":
     server.run()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Memory accounting and a memory budget for the mapper's caches and indexes
+Each structure reports its entry count and an estimated size in bytes. With a budget set
+(MEMORY_BUDGET_MB), evictable tiers are trimmed in priority order, cheapest to rebuild
+first, whenever the total of all structures exceeds it; the report-only ones (indexes)
+count towards the budget but are never trimmed. tracemalloc helpers find where memory is allocated
+when the estimates are not enough.
+"""
+
+import itertools
+import math
+import sys
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass
+from types import ModuleType
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+# Entries measured per structure; the total is scaled up from the sample
+SAMPLE_SIZE = 200
+
+
+def deep_sizeof(obj: Any, seen: Optional[set] = None) -> int:
+    """Approximate bytes held by an object and everything it references (shared objects once)"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (type, ModuleType)) or callable(obj):
+        return size
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(vars(obj), seen)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_sizeof(getattr(obj, slot), seen) for slot in obj.__slots__ if hasattr(obj, slot))
+    return size
+
+
+def estimate_entries_size(container: Any, entries: Iterable[Any], count: int) -> int:
+    """Size of a container of count entries, measuring an evenly spread sample of them"""
+    if count == 0:
+        return sys.getsizeof(container)
+    step = max(1, count // SAMPLE_SIZE)
+    sample = list(itertools.islice(entries, 0, None, step))
+    measured = sum(deep_sizeof(entry) for entry in sample)
+    return sys.getsizeof(container) + int(measured / max(1, len(sample)) * count)
+
+
+@dataclass
+class MemoryTier:
+    """One structure under accounting
+
+    usage() returns {'entries': n, 'bytes': b}; evict(n) drops the n least recently used
+    entries and returns how many it dropped. Structures without evict are reported only.
+    """
+    name: str
+    usage: Callable[[], Dict[str, int]]
+    evict: Optional[Callable[[int], int]] = None
+
+
+class MemoryBudget:
+    """Keeps the total of all tiers within limit_bytes, trimming the evictable ones in the order they are listed"""
+
+    def __init__(self, tiers: List[MemoryTier], limit_bytes: int = 0, check_interval: float = 10.0,
+                 headroom: float = 0.9):
+        self.tiers = tiers
+        self.limit_bytes = limit_bytes
+        self.check_interval = check_interval
+        # Trim to this fraction of the limit, so a budget that is just exceeded is not trimmed on every check
+        self.headroom = headroom
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._evicted = {tier.name: 0 for tier in tiers}
+        self._counters = {'checks': 0, 'over_budget': 0}
+
+    def usage(self) -> Dict[str, Dict[str, int]]:
+        report = {}
+        for tier in self.tiers:
+            try:
+                report[tier.name] = tier.usage()
+            except Exception as e:
+                print(f"Warning: Could not measure '{tier.name}': {e}")
+        return report
+
+    def maybe_enforce(self):
+        """Enforce at most once per check_interval; cheap to call on every cache write"""
+        if self.limit_bytes <= 0 or time.monotonic() - self._checked_at < self.check_interval:
+            return
+        if self._lock.acquire(blocking=False):
+            try:
+                self._enforce()
+            finally:
+                self._lock.release()
+
+    def enforce(self) -> Dict[str, int]:
+        """Trim evictable tiers until the total is within the budget; returns entries evicted per tier"""
+        with self._lock:
+            return self._enforce()
+
+    def _enforce(self) -> Dict[str, int]:
+        self._checked_at = time.monotonic()
+        self._counters['checks'] += 1
+        evicted = {}
+        if self.limit_bytes <= 0:
+            return evicted
+        usage = self.usage()
+        total = sum(entry['bytes'] for entry in usage.values())
+        if total <= self.limit_bytes:
+            return evicted
+        self._counters['over_budget'] += 1
+        excess = total - int(self.limit_bytes * self.headroom)
+        for tier in self.tiers:
+            if excess <= 0:
+                break
+            current = usage.get(tier.name)
+            if tier.evict is None or not current or not current['entries']:
+                continue
+            per_entry = current['bytes'] / current['entries']
+            dropped = tier.evict(min(current['entries'], math.ceil(excess / per_entry)))
+            excess -= dropped * per_entry
+            evicted[tier.name] = dropped
+            self._evicted[tier.name] += dropped
+        return evicted
+
+    def snapshot(self) -> Dict[str, Any]:
+        usage = self.usage()
+        return {
+            'limit_bytes': self.limit_bytes or None,
+            'evictable_bytes': sum(usage[tier.name]['bytes'] for tier in self.tiers
+                                   if tier.evict is not None and tier.name in usage),
+            'total_bytes': sum(entry['bytes'] for entry in usage.values()),
+            'structures': {name: dict(entry, evicted=self._evicted[name]) for name, entry in usage.items()},
+            **self._counters
+        }
+
+
+def start_tracing(frames: int = 1):
+    """Start tracemalloc (slows allocations down; for diagnosis only)"""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+
+def top_allocations(limit: int = 15, baseline: Optional[tracemalloc.Snapshot] = None) -> List[Dict[str, Any]]:
+    """Largest allocation sites by source line, or the largest growth since baseline"""
+    if not tracemalloc.is_tracing():
+        return []
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    if baseline is not None:
+        stats = snapshot.compare_to(baseline, 'lineno')[:limit]
+        return [{'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                 'kib': round(stat.size / 1024, 1), 'growth_kib': round(stat.size_diff / 1024, 1),
+                 'blocks': stat.count} for stat in stats]
+    return [{'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+             'kib': round(stat.size / 1024, 1), 'blocks': stat.count}
+            for stat in snapshot.statistics('lineno')[:limit]]
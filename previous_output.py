@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Previous mapping output for incremental remaps
+A registry export changes only a little between runs. Rows of the new input that appear
+unchanged (same sub_id and substance) in the previous Output/output_*.xml, mapped recently
+enough, reuse its snomed_ct and atc values; only the rest is looked up again.
+"""
+
+import calendar
+import glob
+import os
+import time
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+MAPPED_AT_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def format_mapped_at(timestamp: float) -> str:
+    return time.strftime(MAPPED_AT_FORMAT, time.gmtime(timestamp))
+
+
+def parse_mapped_at(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(calendar.timegm(time.strptime(value, MAPPED_AT_FORMAT)))
+    except (TypeError, ValueError):
+        return None
+
+
+def find_previous_output(input_filename: str, directory: str = 'Output') -> Optional[str]:
+    """Most recently written output for an input file (Output/output_NN_<name>.xml), or None"""
+    base_name = os.path.basename(input_filename)
+    name = base_name.rsplit('.', 1)[0] if '.' in base_name else base_name
+    candidates = glob.glob(os.path.join(directory, f"output_[0-9]*_{glob.escape(name)}.xml"))
+    return max(candidates, key=os.path.getmtime) if candidates else None
+
+
+@dataclass
+class PreviousMapping:
+    """One row of a previous output file"""
+    snomed_ct: str
+    atc: str
+    mapped_at: float
+
+
+class PreviousOutput:
+    """Rows of a previous output keyed by (sub_id, substance), reusable while younger than max_age"""
+
+    def __init__(self, rows: Dict[Tuple[str, str], PreviousMapping], max_age: float = 30 * 86400.0):
+        self.rows = rows
+        self.max_age = max_age
+        self._counters = {'reused': 0, 'expired': 0, 'changed': 0}
+
+    @classmethod
+    def parse(cls, xml_content: str, max_age: float = 30 * 86400.0,
+              default_mapped_at: Optional[float] = None) -> 'PreviousOutput':
+        """Read an output document; rows without a mapped_at attribute get default_mapped_at"""
+        root = ET.fromstring(xml_content.encode('utf-8'))
+        rows: Dict[Tuple[str, str], PreviousMapping] = {}
+        for element in root.iter('Medication'):
+            mapped_at = parse_mapped_at(element.get('mapped_at'))
+            if mapped_at is None:
+                mapped_at = default_mapped_at
+            if mapped_at is None:
+                continue
+            rows[(element.findtext('sub_id') or '', element.findtext('substance') or '')] = PreviousMapping(
+                snomed_ct=element.findtext('snomed_ct') or 'SNOMED CT not found',
+                atc=element.findtext('atc') or 'ATC code not found',
+                mapped_at=mapped_at
+            )
+        return cls(rows, max_age)
+
+    @classmethod
+    def load(cls, path: str, max_age: float = 30 * 86400.0) -> 'PreviousOutput':
+        """Read an output file; files written before mapped_at existed count as mapped when last modified"""
+        with open(path, 'r', encoding='utf-8') as file:
+            xml_content = file.read()
+        return cls.parse(xml_content, max_age, default_mapped_at=os.path.getmtime(path))
+
+    def reuse(self, sub_id: str, substance: str) -> Optional[PreviousMapping]:
+        """Previous mapping for an unchanged, recently mapped row, or None when it must be looked up"""
+        mapping = self.rows.get((sub_id, substance))
+        if mapping is None:
+            self._counters['changed'] += 1
+            return None
+        if time.time() - mapping.mapped_at > self.max_age:
+            self._counters['expired'] += 1
+            return None
+        self._counters['reused'] += 1
+        return mapping
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def snapshot(self) -> Dict[str, int]:
+        return {'rows': len(self.rows), **self._counters}
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Opt-in profiling for CLI runs and MCP tool calls
+A profiled call is written to the profile directory as a cProfile/pstats file (open it with
+python -m pstats, snakeviz or similar) and a JSON summary with wall and CPU time, the
+slowest functions and the time spent per upstream endpoint. Work the call hands to thread
+pools through call_in_task is profiled on those threads too and merged into the same stats.
+
+Nothing is installed unless profiling is asked for: --profile on the CLI, or
+PROFILE_SAMPLE_RATE=N on the server to profile one tool call in N.
+"""
+
+import contextvars
+import functools
+import itertools
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from urllib.parse import urlparse
+
+import json_codec
+
+DEFAULT_PROFILE_DIR = os.path.join('Output', 'profiles')
+
+_current: contextvars.ContextVar = contextvars.ContextVar('call_profile', default=None)
+# cProfile cannot run two profilers at once reliably, so calls are profiled one at a time
+_busy = threading.Lock()
+_sequence = itertools.count(1)
+
+
+class CallProfile:
+    """Timings collected for one profiled call"""
+
+    def __init__(self, label: str):
+        self.label = label
+        self.started_at = time.time()
+        self.path: Optional[str] = None
+        self.upstream: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._thread = threading.get_ident()
+        # Profilers of pool tasks run for this call, merged into its stats when it ends
+        self._task_profilers: List[Any] = []
+        # CPU time of this call's pool tasks, each measured on its own thread
+        self.task_cpu_seconds = 0.0
+        self._closed = False
+
+    def record_upstream(self, url: str, seconds: float):
+        endpoint = urlparse(url)
+        key = f"{endpoint.netloc}{endpoint.path}"
+        with self._lock:
+            entry = self.upstream.setdefault(key, {'calls': 0, 'seconds': 0.0})
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+
+    def run_task(self, func: Callable, *args, **kwargs):
+        """Run func with a profiler of its own on this (pool) thread"""
+        import cProfile
+
+        if threading.get_ident() == self._thread:
+            return func(*args, **kwargs)
+        profiler: Optional[cProfile.Profile] = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ allows one profiler at a time, and the call's own already sees every thread
+            profiler = None
+        cpu_start = time.thread_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            cpu = time.thread_time() - cpu_start
+            if profiler is not None:
+                profiler.disable()
+            with self._lock:
+                if not self._closed:
+                    self.task_cpu_seconds += cpu
+                    if profiler is not None:
+                        self._task_profilers.append(profiler)
+
+    def close(self) -> List[Any]:
+        """Stop collecting task profilers; returns those collected"""
+        with self._lock:
+            self._closed = True
+            return list(self._task_profilers)
+
+
+def call_in_task(func: Callable, *args, **kwargs):
+    """Run func as part of the profiled call in this context, if any
+
+    Pool threads do not inherit the caller's profiler; submit work through this
+    (in a copy of the caller's context) to have it profiled as well.
+    """
+    profile = _current.get()
+    if profile is None:
+        return func(*args, **kwargs)
+    return profile.run_task(func, *args, **kwargs)
+
+
+def record_upstream(url: str, seconds: float):
+    """Attribute an upstream request to the profiled call in this context, if any"""
+    profile = _current.get()
+    if profile is not None:
+        profile.record_upstream(url, seconds)
+
+
+@contextmanager
+def profiled(label: str, directory: Optional[str] = None) -> Iterator[Optional[CallProfile]]:
+    """Profile the enclosed block and save it; yields None when another call is being profiled"""
+    if not _busy.acquire(blocking=False):
+        yield None
+        return
+    import cProfile
+
+    profile = CallProfile(label)
+    token = _current.set(profile)
+    profiler = cProfile.Profile()
+    wall_start = time.perf_counter()
+    # CPU time of this thread, plus that of the call's pool tasks: concurrent calls are not charged
+    cpu_start = time.thread_time()
+    profiler.enable()
+    try:
+        yield profile
+    finally:
+        profiler.disable()
+        wall = time.perf_counter() - wall_start
+        cpu = time.thread_time() - cpu_start
+        _current.reset(token)
+        try:
+            task_profilers = profile.close()
+            _save(profile, [profiler] + task_profilers, wall, cpu + profile.task_cpu_seconds,
+                  directory or os.environ.get('PROFILE_DIR') or DEFAULT_PROFILE_DIR)
+        finally:
+            _busy.release()
+
+
+def _save(profile: CallProfile, profilers: List[Any], wall: float, cpu: float, directory: str, top_n: int = 25):
+    import pstats
+
+    stamp = time.strftime('%Y%m%dT%H%M%S', time.localtime(profile.started_at))
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', profile.label)
+    base = os.path.join(directory, f"{stamp}_{name}_{os.getpid()}_{next(_sequence)}")
+    stats = pstats.Stats(profilers[0])
+    for task_profiler in profilers[1:]:
+        try:
+            stats.add(task_profiler)
+        except TypeError:
+            # A task that made no profiled calls
+            pass
+    functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top_n]
+    summary = {
+        'label': profile.label,
+        'started_at': profile.started_at,
+        'wall_seconds': round(wall, 4),
+        'cpu_seconds': round(cpu, 4),
+        'profiled_tasks': len(profilers) - 1,
+        'upstream_seconds': round(sum(entry['seconds'] for entry in profile.upstream.values()), 4),
+        'upstream': {key: {'calls': entry['calls'], 'seconds': round(entry['seconds'], 4)}
+                     for key, entry in sorted(profile.upstream.items(), key=lambda item: -item[1]['seconds'])},
+        'functions': [{
+            'function': f"{os.path.basename(filename)}:{line}({function})",
+            'calls': calls,
+            'own_seconds': round(own, 4),
+            'cumulative_seconds': round(cumulative, 4)
+        } for (filename, line, function), (_, calls, own, cumulative, _) in functions]
+    }
+    try:
+        os.makedirs(directory, exist_ok=True)
+        stats.dump_stats(base + '.prof')
+        with open(base + '.json', 'w', encoding='utf-8') as file:
+            file.write(json_codec.dumps(summary, indent=True))
+        profile.path = base + '.prof'
+    except OSError as e:
+        print(f"Warning: Could not save profile to '{directory}': {e}")
+
+
+def sampled(func: Callable) -> Callable:
+    """Profile one call in PROFILE_SAMPLE_RATE; returns func itself when sampling is off"""
+    try:
+        rate = int(os.environ.get('PROFILE_SAMPLE_RATE') or 0)
+    except ValueError:
+        print(f"Warning: Ignoring invalid PROFILE_SAMPLE_RATE={os.environ['PROFILE_SAMPLE_RATE']!r}")
+        rate = 0
+    if rate <= 0:
+        return func
+    calls = itertools.count()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if next(calls) % rate:
+            return func(*args, **kwargs)
+        with profiled(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
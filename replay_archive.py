@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Record/replay transport for the upstream services
+REPLAY_MODE selects how the mapper's session uses the archive at REPLAY_ARCHIVE:
+
+    record    requests go to the upstreams; every answer (below 500, except 429) is saved
+    replay    requests are answered from the archive only; nothing goes over the network
+    fallback  requests go to the upstreams; the archive is read only when they fail
+
+In record and fallback mode the archive is also a fallback tier: when an upstream is down
+(or its circuit is open), the recorded answer is served instead of failing the lookup.
+A replayed archive is a deterministic offline fixture: the same requests get the same
+answers, as fast as SQLite reads them.
+
+The archive is one SQLite table keyed by a 16-byte digest of the method, the URL (query
+parameters sorted) and the request body; bodies are stored zlib-compressed.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Union
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+DEFAULT_REPLAY_ARCHIVE = os.path.join('Output', 'replay_archive.sqlite')
+MODES = ('off', 'record', 'replay', 'fallback')
+
+# Answers worth replaying: 404 is a real answer (no such page), overload and server errors are not
+_NOT_RECORDED = {429}
+
+
+class ReplayMiss(requests.ConnectionError):
+    """Raised in replay mode for a request the archive has no answer to"""
+
+
+def request_key(method: str, url: str, body: Union[bytes, str, None] = None) -> bytes:
+    """Archive key of a request; parameter order does not matter"""
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    canonical = urlunsplit((parts.scheme, parts.netloc.lower(), parts.path, query, ''))
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return hashlib.sha256(f"{method.upper()} {canonical}\n".encode('utf-8') + (body or b'')).digest()[:16]
+
+
+@dataclass
+class RecordedResponse:
+    """One archived answer"""
+    status: int
+    content_type: str
+    body: bytes
+    recorded_at: float
+
+
+class ReplayArchive:
+    """Recorded request/response pairs in a SQLite file; safe to share between threads and processes"""
+
+    def __init__(self, path: str = DEFAULT_REPLAY_ARCHIVE):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counters = {'recorded': 0, 'replayed': 0, 'fallbacks': 0, 'misses': 0}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS exchanges (key BLOB PRIMARY KEY, method TEXT NOT NULL, '
+                         'url TEXT NOT NULL, status INTEGER NOT NULL, content_type TEXT NOT NULL, '
+                         'body BLOB NOT NULL, recorded_at REAL NOT NULL) WITHOUT ROWID')
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread and process; connections must not cross a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def record(self, method: str, url: str, body: Union[bytes, str, None], status: int, content_type: str,
+               content: bytes):
+        """Save (or replace) the answer to a request"""
+        with self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO exchanges VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (request_key(method, url, body), method.upper(), url, status, content_type or '',
+                          zlib.compress(content), time.time()))
+        self.count('recorded')
+
+    def lookup(self, method: str, url: str, body: Union[bytes, str, None] = None) -> Optional[RecordedResponse]:
+        row = self._connection().execute(
+            'SELECT status, content_type, body, recorded_at FROM exchanges WHERE key = ?',
+            (request_key(method, url, body),)).fetchone()
+        if row is None:
+            return None
+        return RecordedResponse(status=row[0], content_type=row[1], body=zlib.decompress(row[2]), recorded_at=row[3])
+
+    def lookup_request(self, method: str, url: str, params: Optional[Dict[str, Any]] = None,
+                       payload: Any = None) -> Optional[RecordedResponse]:
+        """Archived answer for a request given as the session would send it"""
+        prepared = requests.Request(method, url, params=params, json=payload).prepare()
+        return self.lookup(method, prepared.url, prepared.body)
+
+    def fallback_response(self, request: requests.PreparedRequest) -> Optional[requests.Response]:
+        """Archived answer to a request whose upstream failed, or None"""
+        try:
+            recorded = self.lookup(request.method, request.url, request.body)
+        except sqlite3.Error as e:
+            print(f"Warning: Replay archive '{self.path}' unavailable: {e}")
+            return None
+        if recorded is None:
+            return None
+        self.count('fallbacks')
+        return build_response(request, recorded, 'FALLBACK')
+
+    def count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def __len__(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM exchanges').fetchone()[0]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+        try:
+            entries = len(self)
+        except sqlite3.Error:
+            entries = None
+        return {'path': self.path, 'entries': entries, **counters}
+
+
+def build_response(request: requests.PreparedRequest, recorded: RecordedResponse, outcome: str) -> requests.Response:
+    """requests.Response for an archived answer, marked X-Replay: <outcome>"""
+    response = requests.Response()
+    response.status_code = recorded.status
+    response.reason = 'OK' if recorded.status < 400 else 'Replayed'
+    response.url = request.url
+    response.request = request
+    response.headers = CaseInsensitiveDict({'X-Replay': outcome,
+                                            'X-Body-Digest': hashlib.sha256(recorded.body).hexdigest()})
+    if recorded.content_type:
+        response.headers['Content-Type'] = recorded.content_type
+    response.encoding = get_encoding_from_headers(response.headers)
+    response._content = recorded.body
+    return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """Transport adapter that records what the wrapped adapter answers, or replays it from the archive"""
+
+    def __init__(self, archive: ReplayArchive, mode: str, inner: BaseAdapter):
+        super().__init__()
+        self.archive = archive
+        self.mode = mode
+        self.inner = inner
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        if self.mode == 'replay':
+            try:
+                recorded = self.archive.lookup(request.method, request.url, request.body)
+            except sqlite3.Error as e:
+                raise ReplayMiss(f"Replay archive '{self.archive.path}' unavailable: {e}", request=request)
+            if recorded is None:
+                self.archive.count('misses')
+                raise ReplayMiss(f"No recorded answer for {request.method} {request.url}", request=request)
+            self.archive.count('replayed')
+            return build_response(request, recorded, 'REPLAY')
+
+        response = self.inner.send(request, **kwargs)
+        if self.mode == 'record' and response.status_code < 500 and response.status_code not in _NOT_RECORDED:
+            try:
+                # Reads a streamed body to the end; the caller then iterates over the buffered content
+                self.archive.record(request.method, request.url, request.body, response.status_code,
+                                    response.headers.get('Content-Type', ''), response.content)
+            except sqlite3.Error as e:
+                print(f"Warning: Could not record response in replay archive '{self.archive.path}': {e}")
+        return response
+
+    def close(self):
+        self.inner.close()
+
+
+def install(session: requests.Session, archive: ReplayArchive, mode: str):
+    """Wrap every adapter mounted on session (mount any others first) in a ReplayAdapter"""
+    for prefix, adapter in list(session.adapters.items()):
+        session.mount(prefix, ReplayAdapter(archive, mode, adapter))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Local stub for the Snowstorm and Felleskatalogen upstreams
+Serves scripted responses (slow, failing, paged) so the mapper can be exercised offline
+"""
+
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Union
+from urllib.parse import parse_qs, urlparse
+
+
+@dataclass
+class StubResponse:
+    """One scripted response"""
+    status: int = 200
+    body: Union[str, bytes, Dict, List, None] = None
+    delay: float = 0.0
+    headers: Dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class StubRequest:
+    """What the stub saw for one incoming request"""
+    path: str
+    params: Dict[str, str]
+    headers: Dict[str, str]
+    multi_params: Dict[str, List[str]] = field(default_factory=dict)
+
+
+Handler = Callable[[StubRequest], StubResponse]
+
+
+class StubUpstream:
+    """Threaded local HTTP server with per-path response scripts"""
+
+    def __init__(self):
+        self._routes: Dict[str, Union[List[StubResponse], Handler]] = {}
+        self.hits: Dict[str, int] = {}
+        self.requests: List[StubRequest] = []
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def add(self, path: str, *responses: StubResponse):
+        """Script responses for a path; the last one repeats once the others are used up"""
+        with self._lock:
+            self._routes[path] = list(responses) or [StubResponse()]
+
+    def add_handler(self, path: str, handler: Handler):
+        """Route a path to a function computing the response from the request"""
+        with self._lock:
+            self._routes[path] = handler
+
+    def start(self) -> 'StubUpstream':
+        stub = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub._serve(self)
+
+            def do_POST(self):
+                stub._serve(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> 'StubUpstream':
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _next_response(self, request: StubRequest) -> StubResponse:
+        with self._lock:
+            self.hits[request.path] = self.hits.get(request.path, 0) + 1
+            self.requests.append(request)
+            route = self._routes.get(request.path)
+            if route is None:
+                return StubResponse(status=404, body='not found')
+            if callable(route):
+                handler = route
+            else:
+                return route.pop(0) if len(route) > 1 else route[0]
+        return handler(request)
+
+    def _serve(self, http: BaseHTTPRequestHandler):
+        parsed = urlparse(http.path)
+        multi_params = parse_qs(parsed.query)
+        params = {k: v[-1] for k, v in multi_params.items()}
+        length = int(http.headers.get('Content-Length') or 0)
+        if length:
+            params['_body'] = http.rfile.read(length).decode('utf-8')
+        request = StubRequest(path=parsed.path, params=params, headers=dict(http.headers.items()),
+                              multi_params=multi_params)
+        response = self._next_response(request)
+        if response.delay:
+            time.sleep(response.delay)
+        body: Any = response.body
+        headers = dict(response.headers)
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+            headers.setdefault('Content-Type', 'application/json')
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        body = body or b''
+        try:
+            http.send_response(response.status)
+            for name, value in headers.items():
+                http.send_header(name, value)
+            http.send_header('Content-Length', str(len(body)))
+            http.end_headers()
+            if http.command != 'HEAD' and response.status != 304:
+                http.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Hedged or abandoned requests may hang up early
+            pass
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+Local SNOMED CT terminology indexes for the medicinal product mapper
+Pre-built substance concept -> medicinal product ("only product") map, built by paging
+once through every medicinal product and its has-active-ingredient relationships, and
+kept current by incremental delta syncs keyed on effectiveTime and the branch head
+"""
+
+import json
+import os
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import quote
+
+from compact_catalogue import ProductCatalogue, SubstanceLinks
+from upstream_client import ResilientClient
+
+MEDICINAL_PRODUCT_ECL = "< 763158003 |Medicinal product| MINUS (* : 411116001 |Has manufactured dose form| = *)"
+HAS_ACTIVE_INGREDIENT = '127489000'
+DEFAULT_ONLY_PRODUCT_MAP = os.path.join('Indexes', 'only_product_map.json')
+CODE_SYSTEM = 'SNOMEDCT-NO'
+
+
+@dataclass
+class SyncReport:
+    """Outcome of one delta sync"""
+    up_to_date: bool
+    changed: int = 0
+    updated: int = 0
+    added: int = 0
+    removed: List[str] = field(default_factory=list)
+    skipped: int = 0
+    head_timestamp: Optional[int] = None
+    effective_time: Optional[str] = None
+    seconds: float = 0.0
+
+
+class OnlyProductIndex:
+    """Substance concept -> medicinal products map, held in memory and saved as compact JSON
+
+    Products are linked to the substances they directly have as active ingredient.
+    Substances missing from the map are unknown to it (not proof there is no product),
+    so callers fall back to the ECL query, which also covers descendant substances.
+    The same goes for substances with a descendant substance that is itself an indexed
+    ingredient (with_descendants): their direct products are not the whole answer.
+    """
+
+    FORMAT = 2
+
+    def __init__(self, products: Optional[Dict[str, Tuple[str, str, str, str]]] = None,
+                 by_substance: Optional[Dict[str, List[str]]] = None, branch: str = 'MAIN/SNOMEDCT-NO',
+                 built_at: Optional[str] = None, head_timestamp: Optional[int] = None,
+                 effective_time: Optional[str] = None, with_descendants: Optional[Iterable[str]] = None):
+        # conceptId -> (fsn, pt, definitionStatus, effectiveTime), held column-wise with integer ids
+        self.products = ProductCatalogue(products)
+        self.by_substance = SubstanceLinks(by_substance)
+        # Proper ancestors of the indexed ingredient substances
+        self.with_descendants: Set[str] = set(with_descendants or ())
+        self.branch = branch
+        self.built_at = built_at
+        # Sync point: branch head and latest published effectiveTime the map reflects
+        self.head_timestamp = head_timestamp
+        self.effective_time = effective_time
+
+    def __len__(self) -> int:
+        return len(self.by_substance)
+
+    def memory_usage(self) -> Dict[str, int]:
+        return {'entries': len(self.products), 'bytes': self.products.nbytes() + self.by_substance.nbytes()}
+
+    def products_for_substance(self, substance_concept_id: str) -> Optional[List[Dict[str, Any]]]:
+        """Product records for a substance concept, or None when the map cannot answer for it
+
+        That is when the substance is not indexed, or when products of its descendant
+        substances belong to the answer too.
+        """
+        if substance_concept_id in self.with_descendants:
+            return None
+        product_ids = self.by_substance.get(substance_concept_id)
+        if product_ids is None:
+            return None
+        records = []
+        for product_id in product_ids:
+            fsn, pt, definition_status, effective_time = self.products[product_id]
+            records.append({
+                'conceptId': product_id, 'fsn': fsn, 'pt': pt, 'active': True,
+                'definitionStatus': definition_status, 'effectiveTime': effective_time
+            })
+        return records
+
+    @classmethod
+    def build(cls, client: ResilientClient, base_url: str, branch: str = 'MAIN/SNOMEDCT-NO',
+              page_size: int = 1000, accept_language: str = 'nb-x-sct,en-x-sct') -> 'OnlyProductIndex':
+        """Page through the whole medicinal product set once and bulk-load its relationships"""
+        urls = _SnowstormUrls(base_url, branch)
+        concepts_url = urls.concepts
+        bulk_load_url = urls.bulk_load
+        index = cls(branch=branch)
+        # Record the sync point first, so changes made while paging are picked up by the next sync
+        index.head_timestamp = client.get_json(urls.branch).get('headTimestamp')
+        index.effective_time = _latest_version(client, urls)
+        search_after: Optional[str] = None
+        while True:
+            params = {
+                'activeFilter': 'true',
+                'ecl': MEDICINAL_PRODUCT_ECL,
+                'limit': page_size,
+                'acceptLanguage': accept_language
+            }
+            if search_after:
+                params['searchAfter'] = search_after
+            page = client.get_json(concepts_url, params=params)
+            items = page.get('items', [])
+            if not items:
+                break
+            for item in items:
+                index._add_product(item)
+            detailed = client.post_json(bulk_load_url, {'conceptIds': [item['conceptId'] for item in items]})
+            for concept in detailed:
+                index._set_ingredients(concept['conceptId'], _active_ingredients(concept))
+            search_after = page.get('searchAfter')
+            if not search_after or len(items) < page_size:
+                break
+        index.with_descendants = _substance_ancestors(client, urls, list(index.by_substance), page_size)
+        index.built_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        return index
+
+    def save(self, path: str = DEFAULT_ONLY_PRODUCT_MAP):
+        """Write the map atomically, so readers never see a half-written file"""
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        data = {
+            'format': self.FORMAT,
+            'branch': self.branch,
+            'built_at': self.built_at,
+            'head_timestamp': self.head_timestamp,
+            'effective_time': self.effective_time,
+            'products': dict(self.products.items()),
+            'by_substance': dict(self.by_substance.items()),
+            'with_descendants': sorted(self.with_descendants)
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_ONLY_PRODUCT_MAP) -> Optional['OnlyProductIndex']:
+        """Load a saved map, or None when there is none (or it has an unknown format)"""
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not load only-product map '{path}': {e}")
+            return None
+        if data.get('format') != cls.FORMAT:
+            print(f"Warning: Ignoring only-product map '{path}' with unknown format {data.get('format')}")
+            return None
+        return cls(data['products'], data['by_substance'], data.get('branch', 'MAIN/SNOMEDCT-NO'), data.get('built_at'),
+                   data.get('head_timestamp'), data.get('effective_time'), data.get('with_descendants'))
+
+    def sync(self, client: ResilientClient, base_url: str, page_size: int = 1000,
+             accept_language: str = 'nb-x-sct,en-x-sct') -> SyncReport:
+        """Apply only the concepts changed since the last sync point
+
+        Changed concepts are those with an effectiveTime (or a description or
+        has-active-ingredient relationship with an effectiveTime) in a code system
+        version published after the last synced one, plus unpublished daily-build
+        changes (null effectiveTime) to any of them. Only those in the product set or
+        already in the map are bulk-loaded for relationships, the rest are counted in
+        skipped; inactivated concepts, and concepts that left the product set, are
+        dropped and reported in removed so dependent caches can be invalidated.
+        Ancestors of substances that became ingredients are added to with_descendants.
+        """
+        start = time.monotonic()
+        urls = _SnowstormUrls(base_url, self.branch)
+        head = client.get_json(urls.branch).get('headTimestamp')
+        if head is not None and head == self.head_timestamp:
+            return SyncReport(up_to_date=True, head_timestamp=head, effective_time=self.effective_time,
+                              seconds=time.monotonic() - start)
+
+        versions = _published_versions(client, urls)
+        new_versions = [v for v in versions if not self.effective_time or v > self.effective_time]
+        changed: Set[str] = set()
+        for version in new_versions:
+            changed.update(_changed_concept_ids(client, urls, {'effectiveTime': int(version)}, page_size))
+            # FSN/PT and ingredient changes touch description and relationship rows, not the concept row
+            changed.update(_changed_description_concepts(client, urls, {'effectiveTime': version}, page_size))
+            changed.update(_changed_ingredient_sources(client, urls, {'effectiveTime': version}, page_size))
+        changed.update(_changed_concept_ids(client, urls, {'isNullEffectiveTime': True}, page_size))
+        changed.update(_changed_description_concepts(client, urls, {'isNullEffectiveTime': 'true'}, page_size))
+        changed.update(_changed_ingredient_sources(client, urls, {'isNullEffectiveTime': 'true'}, page_size))
+
+        report = SyncReport(up_to_date=False, changed=len(changed), head_timestamp=head)
+        known_substances = set(self.by_substance)
+        ingredients_of = self._ingredients_by_product()
+        ordered = sorted(changed)
+        for offset in range(0, len(ordered), page_size):
+            chunk = ordered[offset:offset + page_size]
+            # Membership in the active product set is decided by Snowstorm's ECL, not by us, and
+            # before anything is loaded: most changes in a release are outside the product hierarchy.
+            # The ids go in a POST body, a thousand of them would not fit in a URL
+            page = client.post_json(urls.concept_search, {
+                'activeFilter': True, 'ecl': MEDICINAL_PRODUCT_ECL, 'conceptIds': chunk, 'limit': len(chunk)
+            }, params={'acceptLanguage': accept_language})
+            members = {item['conceptId']: item for item in page.get('items', [])}
+            detailed = {}
+            if members:
+                loaded = client.post_json(urls.bulk_load, {'conceptIds': [cid for cid in chunk if cid in members]})
+                detailed = {c['conceptId']: c for c in loaded}
+            for cid in chunk:
+                if cid in members:
+                    if cid in self.products:
+                        report.updated += 1
+                    else:
+                        report.added += 1
+                    self._add_product(members[cid])
+                    self._replace_ingredients(cid, _active_ingredients(detailed.get(cid, {})), ingredients_of)
+                elif cid in self.products:
+                    self._remove_product(cid, ingredients_of)
+                    report.removed.append(cid)
+                else:
+                    report.skipped += 1
+
+        new_substances = sorted(set(self.by_substance) - known_substances)
+        if new_substances:
+            self.with_descendants.update(_substance_ancestors(client, urls, new_substances, page_size))
+
+        self.head_timestamp = head
+        if new_versions:
+            self.effective_time = max(new_versions)
+        report.effective_time = self.effective_time
+        report.seconds = time.monotonic() - start
+        return report
+
+    def _add_product(self, item: Dict[str, Any]):
+        self.products[item['conceptId']] = (
+            item.get('fsn', {}).get('term', ''),
+            item.get('pt', {}).get('term', ''),
+            item.get('definitionStatus', ''),
+            item.get('effectiveTime', '')
+        )
+
+    def _set_ingredients(self, product_id: str, substance_ids: List[str]):
+        for substance_id in substance_ids:
+            self.by_substance.link(substance_id, product_id)
+
+    def _ingredients_by_product(self) -> Dict[str, Set[str]]:
+        reverse: Dict[str, Set[str]] = {}
+        for substance_id, product_ids in self.by_substance.items():
+            for product_id in product_ids:
+                reverse.setdefault(product_id, set()).add(substance_id)
+        return reverse
+
+    def _unlink(self, product_id: str, substance_ids: Iterable[str]):
+        for substance_id in substance_ids:
+            self.by_substance.unlink(substance_id, product_id)
+
+    def _replace_ingredients(self, product_id: str, substance_ids: List[str], ingredients_of: Dict[str, Set[str]]):
+        self._unlink(product_id, ingredients_of.get(product_id, set()) - set(substance_ids))
+        self._set_ingredients(product_id, substance_ids)
+        ingredients_of[product_id] = set(substance_ids)
+
+    def _remove_product(self, product_id: str, ingredients_of: Dict[str, Set[str]]):
+        self._unlink(product_id, ingredients_of.pop(product_id, set()))
+        self.products.pop(product_id, None)
+
+
+class _SnowstormUrls:
+    """Snowstorm endpoints for one branch"""
+
+    def __init__(self, base_url: str, branch: str):
+        branch_path = quote(branch, safe='')
+        root = f"{base_url}/snowstorm/snomed-ct"
+        self.branch = f"{root}/branches/{branch_path}"
+        self.concepts = f"{root}/{branch_path}/concepts"
+        self.concept_search = f"{root}/{branch_path}/concepts/search"
+        self.bulk_load = f"{root}/browser/{branch_path}/concepts/bulk-load"
+        self.relationships = f"{root}/{branch_path}/relationships"
+        self.descriptions = f"{root}/{branch_path}/descriptions"
+        self.versions = f"{root}/codesystems/{CODE_SYSTEM}/versions"
+
+
+def _published_versions(client: ResilientClient, urls: _SnowstormUrls) -> List[str]:
+    """Effective dates (YYYYMMDD) of the code system's published versions, oldest first"""
+    items = client.get_json(urls.versions).get('items', [])
+    return sorted(str(item['effectiveDate']) for item in items if item.get('effectiveDate'))
+
+
+def _latest_version(client: ResilientClient, urls: _SnowstormUrls) -> Optional[str]:
+    versions = _published_versions(client, urls)
+    return versions[-1] if versions else None
+
+
+def _changed_concept_ids(client: ResilientClient, urls: _SnowstormUrls, criteria: Dict[str, Any],
+                         page_size: int) -> List[str]:
+    """Ids of concepts (active or not) matching search criteria (effectiveTime, ecl), paged with searchAfter"""
+    ids: List[str] = []
+    search_after: Optional[str] = None
+    while True:
+        body = dict(criteria, returnIdOnly=True, limit=page_size)
+        if search_after:
+            body['searchAfter'] = search_after
+        page = client.post_json(urls.concept_search, body)
+        items = page.get('items', [])
+        ids.extend(str(item) for item in items)
+        search_after = page.get('searchAfter')
+        if not items or not search_after or len(items) < page_size:
+            return ids
+
+
+def _substance_ancestors(client: ResilientClient, urls: _SnowstormUrls, substance_ids: List[str],
+                         page_size: int, chunk_size: int = 100) -> Set[str]:
+    """Active proper ancestors of the given substances, queried by ECL in chunks"""
+    ancestors: Set[str] = set()
+    for offset in range(0, len(substance_ids), chunk_size):
+        ecl = '> (' + ' OR '.join(substance_ids[offset:offset + chunk_size]) + ')'
+        ancestors.update(_changed_concept_ids(client, urls, {'ecl': ecl, 'activeFilter': True}, page_size))
+    return ancestors
+
+
+def _active_ingredients(concept: Dict[str, Any]) -> List[str]:
+    """Active has-active-ingredient targets of a browser-format concept"""
+    targets = []
+    for relationship in concept.get('relationships', []):
+        if not relationship.get('active', True) or relationship.get('typeId') != HAS_ACTIVE_INGREDIENT:
+            continue
+        target = relationship.get('destinationId') or relationship.get('target', {}).get('conceptId')
+        if target and target not in targets:
+            targets.append(target)
+    return targets
+
+
+def _changed_component_owners(client: ResilientClient, url: str, criteria: Dict[str, Any], page_size: int,
+                              owner: Callable[[Dict[str, Any]], Optional[str]]) -> List[str]:
+    """Concepts owning the components (relationships, descriptions) listed at url that changed in one
+    published version (criteria {'effectiveTime': version}) or are not yet published
+    ({'isNullEffectiveTime': 'true'}); owner gives the concept id of one item"""
+    owners: List[str] = []
+    offset = 0
+    while True:
+        page = client.get_json(url, params=dict(criteria, offset=offset, limit=page_size))
+        items = page.get('items', [])
+        owners.extend(owner(item) for item in items)
+        offset += len(items)
+        if not items or len(items) < page_size:
+            return [concept_id for concept_id in owners if concept_id]
+
+
+def _changed_ingredient_sources(client: ResilientClient, urls: _SnowstormUrls, criteria: Dict[str, Any],
+                                page_size: int) -> List[str]:
+    """Source concepts of changed has-active-ingredient relationships"""
+    return _changed_component_owners(
+        client, urls.relationships, dict(criteria, type=HAS_ACTIVE_INGREDIENT), page_size,
+        lambda item: item.get('sourceId') or item.get('source', {}).get('conceptId'))
+
+
+def _changed_description_concepts(client: ResilientClient, urls: _SnowstormUrls, criteria: Dict[str, Any],
+                                  page_size: int) -> List[str]:
+    """Concepts with a changed description (an FSN, PT or synonym edit)"""
+    return _changed_component_owners(client, urls.descriptions, criteria, page_size,
+                                     lambda item: item.get('conceptId'))
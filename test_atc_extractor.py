@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Tests for incremental ATC code extraction
+Run with: python -m pytest test_atc_extractor.py
+"""
+
+import requests
+
+from atc_extractor import AtcCodeExtractor, extract_atc_codes, stream_atc_codes
+from http_cache import CachingAdapter, DiskHttpCache
+from stub_upstream import StubResponse, StubUpstream
+
+# Entries for several preparations, far apart, then the end of the main content
+PAGE = ('<main><h1>Acetylsalisylsyre</h1><p>ATC-koder: B01A C06, N02B A01, B01A C06</p>' + '<p>tekst</p>' * 2000
+        + '<p>ATC-koder: N02B E51</p></MAIN>' + '<p>tekst</p>' * 20000)
+
+
+def test_codes_split_across_chunks_keep_page_order():
+    text = '<div>atc-KODER:  N02B A01,B01A C06 , N02B A01</div><p>ATC-koder: A11C C05</p>'
+    extractor = AtcCodeExtractor()
+    for i in range(0, len(text), 3):
+        extractor.feed(text[i:i + 3])
+    assert extractor.close() == ['N02B A01', 'B01A C06', 'A11C C05']
+    # A section end before the page does, with a marker split across chunks
+    extractor = AtcCodeExtractor(section_end='</main>')
+    assert not extractor.feed('<p>ATC-koder: N02B A01</p><p>ATC-koder: A11C C05</p></ma')
+    assert extractor.feed('in><p>tekst</p>')
+    assert extractor.close() == ['N02B A01', 'A11C C05']
+    assert extract_atc_codes('ATC-koder: J05A H01') == ['J05A H01']
+    assert extract_atc_codes('<p>Ingen koder her</p>') == []
+
+
+def test_stream_closes_connection_once_codes_are_found(tmp_path):
+    with StubUpstream() as stub:
+        stub.add('/page', StubResponse(body=PAGE, headers={'ETag': '"a1"'}))
+        response = requests.get(f"{stub.url}/page", stream=True)
+        early = stream_atc_codes(response, chunk_size=1024)
+        whole = stream_atc_codes(requests.get(f"{stub.url}/page", stream=True), section_end=None, chunk_size=1024)
+
+        # A page that is being cached is still read to the end, so the next request can revalidate it
+        session = requests.Session()
+        session.mount('http://', CachingAdapter(DiskHttpCache(str(tmp_path / 'http'))))
+        drained = stream_atc_codes(session.get(f"{stub.url}/page", stream=True),
+                                   drain=True, chunk_size=1024)
+        session.get(f"{stub.url}/page")
+        validator = stub.requests[-1].headers.get('If-None-Match')
+    # Every entry of the section is kept; the rest of the page is not read
+    assert early.codes == whole.codes == ['B01A C06', 'N02B A01', 'N02B E51']
+    assert early.closed_early and early.bytes_read < len(PAGE) // 5
+    assert not whole.closed_early and whole.bytes_read == len(PAGE)
+    assert drained.codes == early.codes and drained.bytes_read == len(PAGE)
+    assert validator == '"a1"'
+
+
+def test_register_search_requires_the_substance_name():
+    with StubUpstream() as stub:
+        stub.add('/register', StubResponse(body='<li>Abakavir</li><p>ATC-koder: J05A F06</p>'))
+        hit = stream_atc_codes(requests.get(f"{stub.url}/register", stream=True), section_end=None, term='abakavir')
+        miss = stream_atc_codes(requests.get(f"{stub.url}/register", stream=True), section_end=None, term='zanamivir')
+    assert (hit.term_found, hit.codes) == (True, ['J05A F06'])
+    assert (miss.term_found, miss.codes) == (False, ['J05A F06'])
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Tests for the prebuilt cache snapshot
+Run with: python -m pytest test_cache_snapshot.py
+"""
+
+import struct
+
+from cache_snapshot import MAGIC, CacheSnapshot, write_snapshot
+
+
+def test_round_trip_finds_every_key_by_binary_search(tmp_path):
+    path = str(tmp_path / 'snapshot.bin')
+    entries = [('atc', f"substance {i}", f"A{i:02d}") for i in range(200)]
+    entries.append(('snomed', 'paracetamol', {'product': None, 'confidence': None, 'candidates': []}))
+    entries.append(('atc', 'østrogen', 'G03C'))
+    assert write_snapshot(path, entries, metadata={'version': 'v1'}) == 202
+
+    snapshot = CacheSnapshot(path)
+    assert snapshot.snapshot()['loaded'] is False
+    for namespace, key, value in entries:
+        assert snapshot.get(namespace, key) == value
+    assert snapshot.get('snomed', 'substance 1') is None
+    assert snapshot.get('atc', 'substance 1000') is None
+    assert snapshot.get('atc', '') is None
+    assert snapshot.metadata['version'] == 'v1'
+    assert snapshot.snapshot()['hits'] == 202
+
+
+def test_missing_or_incompatible_snapshot_is_ignored(tmp_path, capsys):
+    assert CacheSnapshot(str(tmp_path / 'missing.bin')).get('atc', 'x') is None
+
+    path = tmp_path / 'future.bin'
+    path.write_bytes(struct.pack('<8sIII', MAGIC, 99, 2, 0) + b'{}')
+    snapshot = CacheSnapshot(str(path))
+    assert snapshot.get('atc', 'x') is None
+    assert len(snapshot) == 0
+    assert 'format 99' in capsys.readouterr().out
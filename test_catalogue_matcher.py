@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Tests for batch matching against a local product catalogue
+Run with: python -m pytest test_catalogue_matcher.py
+Benchmark: python test_catalogue_matcher.py benchmark [names] [substances]
+"""
+
+import json
+import random
+import sys
+import time
+
+import pytest
+
+import catalogue_matcher
+from catalogue_matcher import CatalogueMatcher, match_score
+
+PRODUCTS = {
+    '1': ('Product containing only zanamivir (medicinal product)', 'Zanamivir-containing product'),
+    '2': ('Product containing zanamivir (medicinal product)', 'Zanamivir-containing product'),
+    '3': ('Product containing only oseltamivir (medicinal product)', 'Oseltamivir-containing product'),
+    '4': ('Product containing only paracetamol (medicinal product)', 'Paracetamol-containing product'),
+    '5': ('Product containing codeine and paracetamol (medicinal product)', 'Codeine and paracetamol product'),
+    '6': ('Product containing only hydrocortisone (medicinal product)', 'Hydrocortisone-containing product'),
+    '7': ('Product containing only sodium chloride (medicinal product)', 'Sodium chloride-containing product'),
+}
+
+
+def synthetic_catalogue(substances: int, seed: int = 7):
+    """Made-up substance names with single-substance and combination products"""
+    rng = random.Random(seed)
+    syllables = ['ab', 'ak', 'al', 'am', 'ce', 'ci', 'dol', 'fen', 'hy', 'ka', 'lo', 'mab', 'mi', 'nol',
+                 'ok', 'pra', 'ril', 'sar', 'ta', 'tin', 'vir', 'xa', 'zo', 'zol']
+    names = sorted({''.join(rng.choice(syllables) for _ in range(rng.randint(3, 5))) for _ in range(substances)})
+    products = {}
+    for position, name in enumerate(names):
+        products[str(10 * position)] = (f"Product containing only {name} (medicinal product)",
+                                        f"{name.capitalize()}-containing product")
+        other = rng.choice(names)
+        products[str(10 * position + 1)] = (f"Product containing {name} and {other} (medicinal product)",
+                                            f"{name.capitalize()} and {other} product")
+    return names, products
+
+
+def measure_matching(names: int = 100000, substances: int = 20000, top_k: int = 5) -> dict:
+    """Time for matching names (misspelled and exact substance names) against a synthetic catalogue"""
+    substance_names, products = synthetic_catalogue(substances)
+    rng = random.Random(11)
+    queries = []
+    for _ in range(names):
+        name = rng.choice(substance_names)
+        if rng.random() < 0.3:
+            cut = rng.randrange(len(name))
+            name = name[:cut] + name[cut + 1:]
+        queries.append(name.capitalize())
+    start = time.perf_counter()
+    matcher = CatalogueMatcher(products)
+    built = time.perf_counter()
+    matches = matcher.match(queries, top_k=top_k)
+    done = time.perf_counter()
+    return {
+        'names': names, 'products': len(products), 'numpy': catalogue_matcher.np is not None,
+        'index_seconds': round(built - start, 2), 'match_seconds': round(done - built, 2),
+        'names_per_second': round(names / max(done - built, 1e-9)),
+        'matched_at_100': sum(1 for found in matches if found and found[0].score >= 100)
+    }
+
+
+def test_batch_matches_agree_with_exhaustive_scoring():
+    matcher = CatalogueMatcher(PRODUCTS)
+    names = ['Zanamivir', 'paracetamol', 'Hydrokortison', 'Natriumklorid', 'sodium  chloride', 'ZANAMIVIR']
+    results = matcher.match(names, top_k=2)
+    for name, matches in zip(names, results):
+        best = max(match_score(fsn, pt, name) for fsn, pt in PRODUCTS.values())
+        assert (matches[0].score if matches else 0) == best
+    assert [match.concept_id for match in results[0]] == ['1', '2']
+    assert results[0] == results[5]
+    assert results[1][0].concept_id == '4' and results[1][1].concept_id == '5'
+    # Not in the catalogue under this name: nearest spelling, below the mapper's acceptance score
+    assert results[2][0].concept_id == '6' and results[2][0].score < 50
+
+
+@pytest.mark.parametrize('sparse_ratio', [0, 10 ** 9])
+def test_vectorized_and_python_paths_agree(monkeypatch, sparse_ratio):
+    pytest.importorskip('numpy')
+    names, products = synthetic_catalogue(300)
+    queries = [name[:-1] for name in names[::7]] + names[::11]
+    # Dense blocks of a few queries each, or sparse counting throughout
+    monkeypatch.setattr(catalogue_matcher, '_DENSE_CELLS', 3 * 2 * len(products))
+    monkeypatch.setattr(catalogue_matcher, '_SPARSE_RATIO', sparse_ratio)
+    vectorized = CatalogueMatcher(products).match(queries, top_k=3, chunk_size=16)
+    monkeypatch.setattr(catalogue_matcher, 'np', None)
+    python = CatalogueMatcher(products).match(queries, top_k=3)
+    assert [[(m.concept_id, m.score) for m in found] for found in vectorized] == \
+        [[(m.concept_id, m.score) for m in found] for found in python]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != 'benchmark':
+        print("Usage: python test_catalogue_matcher.py benchmark [names] [substances]")
+        sys.exit(1)
+    print(json.dumps(measure_matching(*(int(arg) for arg in sys.argv[2:4])), indent=2))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Tests for the compact catalogue storage
+Run with: python -m pytest test_compact_catalogue.py
+Benchmark: python test_compact_catalogue.py benchmark [products]
+"""
+
+import dataclasses
+import json
+import random
+import sys
+import tracemalloc
+from dataclasses import asdict
+
+from compact_catalogue import ProductCatalogue, SubstanceLinks
+from improved_medicinal_product_mapper import MedicationData, MedicinalProduct
+from terminology_index import OnlyProductIndex
+
+
+def synthetic_index_json(products: int, seed: int = 3) -> str:
+    """A saved only-product map shaped like the Norwegian extract (one substance per three products)"""
+    rng = random.Random(seed)
+    syllables = ['ab', 'ce', 'dol', 'fen', 'hy', 'ka', 'lo', 'mab', 'nol', 'pra', 'ril', 'sar', 'tin', 'vir', 'zol']
+    data = {'format': OnlyProductIndex.FORMAT, 'branch': 'MAIN/SNOMEDCT-NO', 'products': {}, 'by_substance': {}}
+    for i in range(products):
+        name = ''.join(rng.choice(syllables) for _ in range(rng.randint(3, 6)))
+        concept_id = str(1000000000000 + 100 * i + 6)
+        data['products'][concept_id] = [f"Product containing only {name} (medicinal product)",
+                                        f"{name.capitalize()}-containing product",
+                                        rng.choice(['FULLY_DEFINED', 'PRIMITIVE']),
+                                        rng.choice(['20220131', '20230131', '20240131', '20250131'])]
+        data['by_substance'].setdefault(str(100000000 + i // 3 * 10 + 7), []).append(concept_id)
+    return json.dumps(data)
+
+
+@dataclasses.dataclass
+class _PlainProduct:
+    """MedicinalProduct as it was before: a dataclass with a per-instance __dict__"""
+    conceptId: str
+    fsn: str
+    pt: str
+    active: bool
+    definitionStatus: str
+    effectiveTime: str
+
+
+def _traced_bytes(build) -> int:
+    tracemalloc.start()
+    try:
+        kept = build()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del kept
+    return size
+
+
+def measure_catalogue_memory(products: int = 40000) -> dict:
+    """Bytes held by the only-product map and by product records, old layout against the compact one"""
+    text = synthetic_index_json(products)
+
+    def dict_layout():
+        data = json.loads(text)
+        return {cid: tuple(record) for cid, record in data['products'].items()}, data['by_substance']
+
+    def compact_layout():
+        data = json.loads(text)
+        return OnlyProductIndex(data['products'], data['by_substance'])
+
+    def records(cls):
+        data = json.loads(text)['products']
+        return lambda: [cls(cid, fsn, pt, True, status, effective)
+                        for cid, (fsn, pt, status, effective) in data.items()]
+
+    before, after = _traced_bytes(dict_layout), _traced_bytes(compact_layout)
+    plain, slotted = _traced_bytes(records(_PlainProduct)), _traced_bytes(records(MedicinalProduct))
+    return {
+        'products': products,
+        'index_bytes_before': before, 'index_bytes_after': after, 'index_ratio': round(after / before, 3),
+        'records_bytes_before': plain, 'records_bytes_after': slotted, 'records_ratio': round(slotted / plain, 3)
+    }
+
+
+def test_catalogue_behaves_like_the_dict_it_replaces():
+    reference = {str(500000 + i): (f"Product containing only s{i} (medicinal product)", f"S{i}-containing product",
+                                   'PRIMITIVE', '20240131') for i in range(3000)}
+    catalogue = ProductCatalogue(reversed(list(reference.items())))
+    # Sync-style edits: overwrite, add and remove enough to trigger merges and compaction
+    for i in range(0, 3000, 2):
+        reference[str(500000 + i)] = ('Product containing only x (clinical drug)', 'X', 'FULLY_DEFINED', '')
+        catalogue[str(500000 + i)] = reference[str(500000 + i)]
+    for i in range(1, 3000, 3):
+        del reference[str(500000 + i)]
+        del catalogue[str(500000 + i)]
+    # Missing values come back as empty strings
+    catalogue['42'] = ('Name without tag', '', None, None)
+    reference['42'] = ('Name without tag', '', '', '')
+    assert dict(catalogue.items()) == reference
+    assert list(catalogue) == sorted(reference, key=int)
+    assert '500001' not in catalogue and 'abc' not in catalogue and catalogue.get('0500000') is None
+    assert len(catalogue) == len(reference)
+    assert len(catalogue.pool) == 6
+
+
+def test_repeated_overwrites_are_compacted():
+    catalogue = ProductCatalogue({str(100 + i): ('Product containing only s (medicinal product)', 'S', '', '')
+                                  for i in range(10)})
+    # Repeated delta syncs overwrite the same products without deleting any
+    for sync in range(500):
+        for i in range(10):
+            catalogue[str(100 + i)] = (f"Product containing only s{sync} (medicinal product)", 'S', '', '')
+    # Rows left behind stay bounded: the columns are compacted once more than 1024 are dead
+    assert len(catalogue._offsets) <= 10 + 1025
+    assert catalogue['105'][0] == 'Product containing only s499 (medicinal product)'
+
+
+def test_substance_links_and_slotted_records():
+    links = SubstanceLinks({'111': ['201', '202']})
+    links.link('111', '202')
+    links.link('112', '203')
+    links.unlink('111', '201')
+    links.unlink('112', '203')
+    assert links == {'111': ['202']}
+
+    first = MedicinalProduct('201', 'Zanamivir (product)', 'Zanamivir', True, ''.join(['FULLY', '_DEFINED']), '20240101')
+    second = MedicinalProduct(**asdict(first))
+    assert not hasattr(first, '__dict__') and second == first
+    assert first.definitionStatus is second.definitionStatus
+    medication = MedicationData(sub_id='T-1', substance='Zanamivir', advice='a')
+    assert not hasattr(medication, '__dict__') and medication.ref_1_id is None
+
+
+def test_compact_index_holds_a_fraction_of_the_dict_layout():
+    report = measure_catalogue_memory(3000)
+    assert report['index_ratio'] < 0.5
+    assert report['records_ratio'] < 0.9
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != 'benchmark':
+        print("Usage: python test_compact_catalogue.py benchmark [products]")
+        sys.exit(1)
+    print(json.dumps(measure_catalogue_memory(*(int(arg) for arg in sys.argv[2:3])), indent=2))
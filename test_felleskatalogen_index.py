@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Tests for the Felleskatalogen negative index
+Run with: python -m pytest test_felleskatalogen_index.py
+"""
+
+import time
+
+from felleskatalogen_index import KnownMissIndex
+
+REGISTER = '''
+<ul>
+  <li><a href="/medisin/substansregister/abakavir">Abakavir</a></li>
+  <li><a href="/medisin/substansregister/abakavir%2Flamivudin">Abakavir/lamivudin</a></li>
+  <li><a href="/medisin/substansregister/acetylsalisylsyre">Acetylsalisylsyre</a></li>
+  <li><a href="/medisin/substansregister/vitamin%20d">Vitamin D (kolekalsiferol)</a></li>
+  <li><a href="/medisin/substansregister/natriumklorid">Natriumklorid &oslash;yedr&aring;per</a></li>
+</ul>
+<script>var related = ["betametason"];</script>
+'''
+
+
+def test_register_answers_only_the_register_search(tmp_path):
+    index = KnownMissIndex(str(tmp_path / 'misses.json'))
+    assert not index.register_lacks('Betablokkere')
+    index.update_register(REGISTER)
+    assert index.register_lacks('Betablokkere')
+    # Never a known miss on the register alone: the direct page may still exist
+    assert not index.is_known_miss('Betablokkere')
+    assert not index.register_lacks('Abakavir')
+    # Entry names, their bracketed parts and words, entities unescaped
+    assert not index.register_lacks('kolekalsiferol')
+    assert not index.register_lacks('Vitamin  D')
+    assert not index.register_lacks('Natriumklorid øyedråper')
+    assert not index.register_lacks('lamivudin')
+    # Only register entries count, not other text on the page
+    assert index.register_lacks('betametason')
+    assert len(index.register_names) < 20
+
+    index.save()
+    loaded = KnownMissIndex(index.path)
+    assert loaded.load_saved()
+    assert loaded.register_lacks('Betablokkere') and not loaded.register_lacks('abakavir')
+    assert loaded.register_names == index.register_names
+
+
+def test_miss_history_expires(tmp_path):
+    index = KnownMissIndex(str(tmp_path / 'misses.json'), max_age=0.05)
+    index.record_miss('Nyttstoff')
+    assert index.is_known_miss('nyttstoff')
+    time.sleep(0.1)
+    assert not index.is_known_miss('nyttstoff')
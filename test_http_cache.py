@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Tests for the on-disk HTTP cache against a local stub that serves validators
+Run with: python -m pytest test_http_cache.py
+"""
+
+import requests
+
+from http_cache import CachingAdapter, DiskHttpCache
+from stub_upstream import StubRequest, StubResponse, StubUpstream
+
+
+def etag_handler(pages: dict, cache_control: str = 'no-cache'):
+    """Serves pages['body'] with an ETag and answers a matching If-None-Match with 304"""
+    def handle(request: StubRequest) -> StubResponse:
+        etag = f'"v{pages["version"]}"'
+        if request.headers.get('If-None-Match') == etag:
+            return StubResponse(status=304, headers={'ETag': etag})
+        return StubResponse(body=pages['body'], headers={'ETag': etag, 'Cache-Control': cache_control})
+    return handle
+
+
+def cached_session(tmp_path) -> requests.Session:
+    session = requests.Session()
+    session.mount('http://', CachingAdapter(DiskHttpCache(str(tmp_path / 'http'))))
+    return session
+
+
+def test_unchanged_page_is_revalidated_with_304(tmp_path):
+    pages = {'version': 1, 'body': '<p>ATC-koder: J05A H01</p>'}
+    with StubUpstream() as stub:
+        stub.add_handler('/page', etag_handler(pages))
+        session = cached_session(tmp_path)
+        first = session.get(f"{stub.url}/page")
+        second = session.get(f"{stub.url}/page")
+        pages.update(version=2, body='<p>ATC-koder: J05A H02</p>')
+        third = session.get(f"{stub.url}/page")
+        conditional = [r.headers.get('If-None-Match') for r in stub.requests]
+    assert (first.headers['X-Cache'], second.headers['X-Cache'], third.headers['X-Cache']) == \
+        ('MISS', 'REVALIDATED', 'MISS')
+    assert second.text == first.text and second.headers['X-Body-Digest'] == first.headers['X-Body-Digest']
+    assert third.text.endswith('H02</p>') and third.headers['X-Body-Digest'] != first.headers['X-Body-Digest']
+    assert conditional == [None, '"v1"', '"v1"']
+
+
+def test_fresh_page_is_served_from_disk_and_no_store_is_not_kept(tmp_path):
+    pages = {'version': 1, 'body': 'cached'}
+    with StubUpstream() as stub:
+        stub.add_handler('/fresh', etag_handler(pages, cache_control='max-age=3600'))
+        stub.add('/private', StubResponse(body='secret', headers={'Cache-Control': 'no-store'}))
+        session = cached_session(tmp_path)
+        session.get(f"{stub.url}/fresh")
+        # A new session over the same directory: the cache survives restarts
+        again = cached_session(tmp_path).get(f"{stub.url}/fresh")
+        session.get(f"{stub.url}/private")
+        session.get(f"{stub.url}/private")
+        hits = dict(stub.hits)
+    assert again.headers['X-Cache'] == 'HIT' and again.text == 'cached'
+    assert hits == {'/fresh': 1, '/private': 2}
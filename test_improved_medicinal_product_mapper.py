@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""
+Tests for the medicinal product mapper against local Snowstorm and Felleskatalogen stubs
+Run with: python -m pytest test_improved_medicinal_product_mapper.py
+"""
+
+import sys
+import threading
+import time
+
+from cache_snapshot import write_snapshot
+from improved_medicinal_product_mapper import MedicinalProduct, XMLMedicinalProductMapper, expand_xml_inputs, map_xml_batch
+from mapping_journal import MappingJournal
+from previous_output import PreviousOutput
+from stub_upstream import StubRequest, StubResponse, StubUpstream
+from terminology_index import OnlyProductIndex
+from upstream_client import INTERACTIVE, TokenBucket, request_priority
+
+CONCEPTS_PATH = '/snowstorm/snomed-ct/MAIN%2FSNOMEDCT-NO/concepts'
+
+
+def concept(concept_id: str, fsn: str, pt: str) -> dict:
+    return {
+        'conceptId': concept_id, 'fsn': {'term': fsn}, 'pt': {'term': pt},
+        'active': True, 'definitionStatus': 'FULLY_DEFINED', 'effectiveTime': '20240101'
+    }
+
+
+def snowstorm_handler(delay: float = 0.0):
+    """Zanamivir substance and its 'Product containing only' concept"""
+    def handle(request: StubRequest) -> StubResponse:
+        ecl = request.params.get('ecl', '')
+        term = request.params.get('term', '').lower()
+        if ecl.startswith('<< 105590001'):
+            known = 'zanamivir' in term or 'relenza' in term
+            items = [concept('111', 'Zanamivir (substance)', 'zanamivir')] if known else []
+        elif '127489000' in ecl and '<< 111' in ecl:
+            items = [concept('222', 'Product containing only zanamivir (medicinal product)',
+                             'Zanamivir-containing product')]
+        else:
+            items = []
+        return StubResponse(body={'items': items, 'total': len(items)}, delay=delay)
+    return handle
+
+
+def make_mapper(stub: StubUpstream) -> XMLMedicinalProductMapper:
+    mapper = XMLMedicinalProductMapper(base_url=stub.url, felleskatalogen_url=f"{stub.url}/substansregister/")
+    mapper.felleskatalogen_rate = TokenBucket('test', rate=1000.0, burst=1000)
+    return mapper
+
+
+def test_map_substance_runs_snomed_and_atc_lookups_concurrently():
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, snowstorm_handler(delay=0.25))
+        stub.add('/substansregister/zanamivir',
+                 StubResponse(body='<p>ATC-koder: J05A H01</p>', delay=0.5))
+        mapper = make_mapper(stub)
+        start = time.monotonic()
+        result = mapper.map_substance('Zanamivir')
+        elapsed = time.monotonic() - start
+    assert result['found'] is True
+    assert result['conceptId'] == '222'
+    assert result['atc_codes'] == 'J05A H01'
+    assert result['candidates'][0]['conceptId'] == '222'
+    # Sequential lookups would take ~1.0s (two Snowstorm calls plus the page)
+    assert elapsed < 0.85
+
+
+def test_interactive_lookup_is_not_queued_behind_a_bulk_batch():
+    bulk_names = [f'bulkstoff-{i}' for i in range(24)]
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, snowstorm_handler(delay=0.05))
+        stub.add('/substansregister/zanamivir', StubResponse(body='<p>ATC-koder: J05A H01</p>', delay=0.2))
+        for name in bulk_names:
+            stub.add(f'/substansregister/{name}', StubResponse(body='<p>ATC-koder: A01A A01</p>', delay=0.2))
+        mapper = make_mapper(stub)
+        start = time.monotonic()
+        with request_priority(INTERACTIVE):
+            mapper.map_substance('Zanamivir')
+        alone = time.monotonic() - start
+        mapper.lookup_cache.clear()
+
+        batch = threading.Thread(target=mapper.map_substance_names, args=(bulk_names,))
+        batch.start()
+        # Let the batch fill the ATC, hedge and planner pools and the Felleskatalogen limiter
+        time.sleep(0.3)
+        start = time.monotonic()
+        with request_priority(INTERACTIVE):
+            result = mapper.map_substance('Zanamivir')
+        loaded = time.monotonic() - start
+        batch_running = batch.is_alive()
+        batch.join()
+    assert result['atc_codes'] == 'J05A H01'
+    assert batch_running
+    # At most one in-flight bulk page ahead of it; a FIFO pool would queue it behind the batch
+    assert loaded < alone + 0.4
+
+
+def test_batch_results_carry_atc_codes_into_xml_output():
+    xml = ('<XML-File><Medication><sub_id>T-1</sub_id><substance>Zanamivir</substance>'
+           '<advice>a</advice></Medication><Medication><sub_id>T-2</sub_id>'
+           '<substance>Zanamivir</substance><advice>b</advice></Medication></XML-File>')
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, snowstorm_handler())
+        stub.add('/substansregister/zanamivir', StubResponse(body='<p>ATC-koder: J05A H01</p>'))
+        mapper = make_mapper(stub)
+        medications, results = mapper.map_medications_from_xml(xml)
+        output = mapper.generate_xml_output(medications, results)
+        page_hits = stub.hits['/substansregister/zanamivir']
+    assert results['Zanamivir']['atc_codes'] == 'J05A H01'
+    assert output.count('<atc>J05A H01</atc>') == 2
+    assert page_hits == 1
+
+
+def test_parsed_client_text_is_shared_within_a_parse_but_not_interned():
+    advice = 'Brukes ved influensa ' + str(time.monotonic_ns())
+    xml = ''.join(f'<Medication><sub_id>T-{i}</sub_id><substance>Zanamivir</substance>'
+                  f'<advice>{advice}</advice></Medication>' for i in range(3))
+    with StubUpstream() as stub:
+        medications = make_mapper(stub).parse_xml_input(f'<XML><Medications>{xml}</Medications></XML>')
+    assert [m.sub_id for m in medications] == ['T-0', 'T-1', 'T-2']
+    assert medications[0].advice is medications[2].advice
+    assert sys.intern(advice) is not medications[0].advice
+
+
+def test_map_substance_names_looks_up_each_normalized_name_once():
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, snowstorm_handler())
+        stub.add('/substansregister/zanamivir', StubResponse(body='<p>ATC-koder: J05A H01</p>'))
+        mapper = make_mapper(stub)
+        results = mapper.map_substance_names(['Zanamivir', 'zanamivir', ' ZANAMIVIR ', '', 'zanamivir'])
+        page_hits = stub.hits['/substansregister/zanamivir']
+    # One result per input position, in input order, duplicates and empty names included
+    assert [name for name, _ in results] == ['Zanamivir', 'zanamivir', ' ZANAMIVIR ', '', 'zanamivir']
+    assert [result['found'] for _, result in results] == [True, True, True, False, True]
+    assert page_hits == 1
+    record = mapper.compact_result('zanamivir', results[1][1])
+    assert record == {'substance': 'zanamivir', 'snomed_ct': '222', 'atc_codes': 'J05A H01',
+                      'found': True, 'match_type': "Exact 'Product containing only' match"}
+
+
+def test_batch_plan_collapses_variants_and_shares_concept_queries():
+    rows = ['Zanamivir', 'zanamivir', ' ZANAMIVIR', 'Relenza', 'Zanamivir', 'Relenza']
+    xml = '<XML-File>' + ''.join(
+        f'<Medication><sub_id>T-{i}</sub_id><substance>{name}</substance><advice>a</advice></Medication>'
+        for i, name in enumerate(rows)) + '</XML-File>'
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, snowstorm_handler())
+        stub.add('/substansregister/zanamivir', StubResponse(body='<p>ATC-koder: J05A H01</p>'))
+        stub.add('/substansregister/relenza', StubResponse(status=404))
+        stub.add('/substansregister/', StubResponse(body='<p>register</p>'))
+        mapper = make_mapper(stub)
+        medications, results = mapper.map_medications_from_xml(xml)
+        product_queries = [r for r in stub.requests if '127489000' in r.params.get('ecl', '')]
+        page_hits = stub.hits['/substansregister/zanamivir']
+    assert len(medications) == 6
+    assert set(results) == {'Zanamivir', 'zanamivir', ' ZANAMIVIR', 'Relenza'}
+    assert all(result['conceptId'] == '222' for result in results.values())
+    assert results['Relenza']['atc_codes'] == 'ATC code not found'
+    # Three spellings of zanamivir share one lookup; Relenza shares its substance concept
+    assert page_hits == 1
+    assert len(product_queries) == 1
+
+
+def test_cache_snapshot_answers_cold_start_without_upstream_calls(tmp_path, monkeypatch):
+    path = str(tmp_path / 'cache_snapshot.bin')
+    monkeypatch.setenv('CACHE_SNAPSHOT', path)
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, snowstorm_handler())
+        stub.add('/substansregister/zanamivir', StubResponse(body='<p>ATC-koder: J05A H01</p>'))
+        report = make_mapper(stub).build_cache_snapshot(['Zanamivir', 'zanamivir '])
+        url = stub.url
+    assert (report['substances'], report['entries']) == (1, 2)
+
+    # The upstream is gone: a fresh mapper still answers from the snapshot
+    mapper = XMLMedicinalProductMapper(base_url=url, felleskatalogen_url=f"{url}/substansregister/")
+    result = mapper.map_substance('ZANAMIVIR')
+    assert result['conceptId'] == '222'
+    assert result['atc_codes'] == 'J05A H01'
+    assert result['degraded'] is False
+    assert mapper.snowstorm.metrics()['requests'] == 0
+    assert mapper.get_metrics()['cache_snapshot']['hits'] == 2
+
+
+def test_old_snapshot_holds_until_the_terminology_release_moves_on(tmp_path, monkeypatch):
+    snapshot_path = str(tmp_path / 'cache_snapshot.bin')
+    map_path = str(tmp_path / 'only_product_map.json')
+    monkeypatch.setenv('CACHE_SNAPSHOT', snapshot_path)
+    monkeypatch.setenv('ONLY_PRODUCT_MAP', map_path)
+    product = {'conceptId': '222', 'fsn': 'Product containing only zanamivir (medicinal product)',
+               'pt': 'Zanamivir-containing product', 'active': True, 'definitionStatus': 'FULLY_DEFINED',
+               'effectiveTime': '20240101'}
+    # Built two years ago, from the release the map is still on
+    write_snapshot(snapshot_path, [
+        ('snomed', 'zanamivir', {'product': product, 'confidence': 200, 'candidates': []}),
+        ('atc', 'zanamivir', 'J05A H01')
+    ], metadata={'built_at': '2024-01-15T00:00:00Z', 'effective_time': '20240101'})
+    OnlyProductIndex({}, {}, effective_time='20240101').save(map_path)
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, snowstorm_handler())
+        stub.add('/substansregister/zanamivir', StubResponse(body='<p>ATC-koder: J05A H02</p>'))
+        result = make_mapper(stub).map_substance('Zanamivir')
+        assert stub.hits == {}
+        assert result['conceptId'] == '222' and result['stale_seconds'] == {}
+
+        # The map has been synced to a newer release: served at once, then refreshed
+        OnlyProductIndex({}, {}, effective_time='20240415').save(map_path)
+        mapper = make_mapper(stub)
+        result = mapper.map_substance('Zanamivir')
+        assert result['atc_codes'] == 'J05A H01' and set(result['stale_seconds']) == {'snomed', 'atc'}
+        deadline = time.monotonic() + 5
+        while mapper.lookup_cache.get('atc', 'zanamivir') is None and time.monotonic() < deadline:
+            time.sleep(0.02)
+    assert mapper.lookup_cache.get('atc', 'zanamivir') == 'J05A H02'
+
+
+def test_stale_entries_are_served_at_once_and_refreshed_in_background():
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, snowstorm_handler(delay=0.3))
+        stub.add('/substansregister/zanamivir', StubResponse(body='<p>ATC-koder: J05A H01</p>', delay=0.3))
+        mapper = make_mapper(stub)
+        mapper.lookup_cache.ttl = 0.05
+        mapper.lookup_cache.put('atc', 'zanamivir', 'J05A H99')
+        mapper.lookup_cache.put('snomed', 'zanamivir', {'product': None, 'confidence': None, 'candidates': []})
+        time.sleep(0.1)
+
+        start = time.monotonic()
+        stale = mapper.map_substance('Zanamivir')
+        assert time.monotonic() - start < 0.2
+        assert (stale['found'], stale['atc_codes']) == (False, 'J05A H99')
+        assert set(stale['stale_seconds']) == {'snomed', 'atc'}
+
+        mapper.lookup_cache.ttl = 60
+        deadline = time.monotonic() + 5
+        while mapper._refreshing and time.monotonic() < deadline:
+            time.sleep(0.05)
+        fresh = mapper.map_substance('Zanamivir')
+    assert (fresh['conceptId'], fresh['atc_codes']) == ('222', 'J05A H01')
+    assert fresh['stale_seconds'] == {}
+
+
+def test_entries_past_max_staleness_block_for_a_fresh_lookup():
+    with StubUpstream() as stub:
+        stub.add('/substansregister/zanamivir', StubResponse(body='<p>ATC-koder: J05A H01</p>'))
+        mapper = make_mapper(stub)
+        mapper.lookup_cache.ttl = 0.01
+        mapper.lookup_cache.max_stale = 0.01
+        mapper.lookup_cache.put('atc', 'zanamivir', 'J05A H99')
+        time.sleep(0.05)
+        assert mapper.get_atc_codes_from_felleskatalogen('Zanamivir') == 'J05A H01'
+        assert stub.hits['/substansregister/zanamivir'] == 1
+
+
+def test_known_felleskatalogen_misses_skip_http(tmp_path, monkeypatch):
+    monkeypatch.setenv('FELLESKATALOGEN_MISS_INDEX', str(tmp_path / 'misses.json'))
+    with StubUpstream() as stub:
+        stub.add('/substansregister/', StubResponse(body='<a href="/medisin/substansregister/abakavir">Abakavir</a>'))
+        mapper = make_mapper(stub)
+        first = mapper.get_atc_codes_from_felleskatalogen('Betablokkere')
+        hits = dict(stub.hits)
+        mapper.lookup_cache.clear()
+        second = mapper.get_atc_codes_from_felleskatalogen('Betablokkere')
+        assert stub.hits == hits
+    assert first == second == 'ATC code not found'
+    assert hits == {'/substansregister/betablokkere': 1, '/substansregister/': 1}
+    assert mapper.get_metrics()['felleskatalogen_misses']['skipped_lookups'] == 1
+
+
+def test_saved_register_skips_only_the_register_search(tmp_path, monkeypatch):
+    monkeypatch.setenv('FELLESKATALOGEN_MISS_INDEX', str(tmp_path / 'misses.json'))
+    with StubUpstream() as stub:
+        stub.add('/substansregister/', StubResponse(body='<a href="/medisin/substansregister/abakavir">Abakavir</a>'))
+        # Not in the register, but it has a page of its own
+        stub.add('/substansregister/zanamivir', StubResponse(body='<p>ATC-koder: J05A H01</p>'))
+        mapper = make_mapper(stub)
+        mapper.refresh_felleskatalogen_index()
+        found = mapper.get_atc_codes_from_felleskatalogen('Zanamivir')
+        missing = mapper.get_atc_codes_from_felleskatalogen('Betablokkere')
+        hits = dict(stub.hits)
+    assert found == 'J05A H01' and missing == 'ATC code not found'
+    assert hits == {'/substansregister/': 1, '/substansregister/zanamivir': 1, '/substansregister/betablokkere': 1}
+
+
+def test_unchanged_felleskatalogen_page_is_not_parsed_again(tmp_path, monkeypatch):
+    monkeypatch.setenv('HTTP_CACHE_DIR', str(tmp_path / 'http'))
+    with StubUpstream() as stub:
+        stub.add('/substansregister/zanamivir', StubResponse(body='<p>ATC-koder: J05A H01</p>',
+                                                            headers={'ETag': '"z1"', 'Cache-Control': 'no-cache'}),
+                 StubResponse(status=304, headers={'ETag': '"z1"'}))
+        mapper = make_mapper(stub)
+        parsed = []
+        extract = mapper._extract_atc_codes_from_html
+        monkeypatch.setattr(mapper, '_extract_atc_codes_from_html',
+                            lambda html, name: parsed.append(name) or extract(html, name))
+        first = mapper.get_atc_codes_from_felleskatalogen('Zanamivir')
+        mapper.lookup_cache.clear()
+        second = mapper.get_atc_codes_from_felleskatalogen('Zanamivir')
+    assert first == second == 'J05A H01'
+    assert stub.requests[1].headers.get('If-None-Match') == '"z1"'
+    assert parsed == ['Zanamivir']
+    assert mapper.get_metrics()['http_cache']['revalidated'] == 1
+
+
+def test_xml_batch_maps_files_in_worker_processes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('RATE_LIMIT_STATE', str(tmp_path / 'ratelimit.sqlite'))
+    monkeypatch.setenv('FELLESKATALOGEN_RATE_PER_SEC', '1000')
+    exports = tmp_path / 'exports'
+    exports.mkdir()
+    for name, substances in (('night_a', ['Zanamivir', 'Ukjent']), ('night_b', ['zanamivir'])):
+        rows = ''.join(f"<Medication><sub_id>{name}-{i}</sub_id><substance>{substance}</substance>"
+                       f"<advice>-</advice></Medication>" for i, substance in enumerate(substances))
+        (exports / f"{name}.xml").write_text(f"<XML-File>{rows}</XML-File>", encoding='utf-8')
+    (exports / 'notes.txt').write_text('not xml', encoding='utf-8')
+
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, snowstorm_handler())
+        stub.add('/substansregister/zanamivir', StubResponse(body='<p>ATC-koder: J05A H01</p>'))
+        mapper = make_mapper(stub)
+        summaries = map_xml_batch(mapper, expand_xml_inputs([str(exports)]), workers=2)
+    assert [s['output'] for s in summaries] == ['Output/output_01_night_a.xml', 'Output/output_01_night_b.xml']
+    assert [(s['medications'], s['found']) for s in summaries] == [(2, 1), (1, 1)]
+    assert 'J05A H01' in (tmp_path / 'Output' / 'output_01_night_b.xml').read_text(encoding='utf-8')
+    # Workers shared their lookups through the persistent cache
+    assert (tmp_path / 'Output' / '.lookup_cache.sqlite').exists()
+
+
+def test_resumed_run_only_maps_rows_missing_from_the_journal(tmp_path):
+    def xml(rows):
+        return '<XML-File>' + ''.join(f"<Medication><sub_id>{sub_id}</sub_id><substance>{substance}</substance>"
+                                      f"<advice>-</advice></Medication>" for sub_id, substance in rows) + '</XML-File>'
+
+    journal_path = str(tmp_path / 'run.jsonl')
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, snowstorm_handler())
+        stub.add('/substansregister/zanamivir', StubResponse(body='<p>ATC-koder: J05A H01</p>'))
+        make_mapper(stub).map_medications_from_xml(xml([('T-1', 'Zanamivir')]), journal=MappingJournal(journal_path))
+    # A crash while writing the next record leaves a partial line behind
+    with open(journal_path, 'a', encoding='utf-8') as file:
+        file.write('{"sub_id": "T-2", "subst')
+
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, snowstorm_handler())
+        journal = MappingJournal(journal_path)
+        medications, results = make_mapper(stub).map_medications_from_xml(
+            xml([('T-1', 'Zanamivir'), ('T-2', 'Ukjent')]), journal=journal)
+        journal.close()
+        snowstorm_terms = [request.params.get('term') for request in stub.requests]
+    assert results['Zanamivir']['conceptId'] == '222'
+    assert results['Zanamivir']['atc_codes'] == 'J05A H01'
+    assert results['Ukjent']['found'] is False
+    assert 'Zanamivir' not in snowstorm_terms
+    assert journal.snapshot()['resumed'] == 1
+    assert set(MappingJournal(journal_path).load()) == {('T-1', 'Zanamivir'), ('T-2', 'Ukjent')}
+
+
+def test_incremental_run_reuses_unchanged_rows_from_previous_output():
+    def xml(rows):
+        return '<XML-File>' + ''.join(f"<Medication><sub_id>{sub_id}</sub_id><substance>{substance}</substance>"
+                                      f"<advice>-</advice></Medication>" for sub_id, substance in rows) + '</XML-File>'
+
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, snowstorm_handler())
+        stub.add('/substansregister/zanamivir', StubResponse(body='<p>ATC-koder: J05A H01</p>'))
+        mapper = make_mapper(stub)
+        medications, results = mapper.map_medications_from_xml(xml([('T-1', 'Zanamivir'), ('T-2', 'Relenza')]))
+        previous_xml = mapper.generate_xml_output(medications, results)
+    assert previous_xml.count('<Medication mapped_at="') == 2
+    # T-1 is unchanged, T-2 was mapped too long ago and T-3 is new
+    previous = PreviousOutput.parse(previous_xml, max_age=86400.0)
+    previous.rows[('T-2', 'Relenza')].mapped_at = 0.0
+
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, snowstorm_handler())
+        medications, results = make_mapper(stub).map_medications_from_xml(
+            xml([('T-1', 'Zanamivir'), ('T-2', 'Relenza'), ('T-3', 'Ukjent')]), previous=previous)
+        snowstorm_terms = [request.params.get('term') for request in stub.requests]
+    assert results['Zanamivir']['match_type'] == 'Reused from previous output'
+    assert results['Zanamivir']['conceptId'] == '222'
+    assert results['Zanamivir']['atc_codes'] == 'J05A H01'
+    assert results['Relenza']['match_type'] != 'Reused from previous output'
+    assert 'Zanamivir' not in snowstorm_terms and 'Relenza' in snowstorm_terms
+    assert previous.snapshot() == {'rows': 2, 'reused': 1, 'expired': 1, 'changed': 1}
+
+
+def test_replayed_archive_maps_without_upstreams(tmp_path, monkeypatch):
+    monkeypatch.setenv('REPLAY_ARCHIVE', str(tmp_path / 'replay.sqlite'))
+    monkeypatch.setenv('REPLAY_MODE', 'record')
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, snowstorm_handler())
+        stub.add('/substansregister/zanamivir', StubResponse(body='<p>ATC-koder: J05A H01</p>'))
+        recorded = make_mapper(stub).map_substance('Zanamivir')
+        url = stub.url
+
+    monkeypatch.setenv('REPLAY_MODE', 'replay')
+    mapper = XMLMedicinalProductMapper(base_url=url, felleskatalogen_url=f"{url}/substansregister/")
+    replayed = mapper.map_substance('Zanamivir')
+    assert (replayed['conceptId'], replayed['atc_codes']) == (recorded['conceptId'], recorded['atc_codes']) \
+        == ('222', 'J05A H01')
+    replay = mapper.get_metrics()['replay']
+    assert replay['replayed'] > 0 and replay['misses'] == 0
+
+
+def test_catalogue_matches_score_like_single_lookups():
+    products = {
+        '222': ('Product containing only zanamivir (medicinal product)', 'Zanamivir-containing product',
+                'FULLY_DEFINED', '20240101'),
+        '333': ('Product containing oseltamivir and zanamivir (medicinal product)', 'Oseltamivir and zanamivir',
+                'FULLY_DEFINED', '20240101')
+    }
+    with StubUpstream() as stub:
+        mapper = make_mapper(stub)
+        mapper.only_product_index = OnlyProductIndex(products=products, by_substance={'111': ['222', '333']})
+        matches = mapper.match_catalogue(['Zanamivir', 'Oseltamivir'], top_k=2)
+        assert stub.hits == {}
+    assert [match.concept_id for match in matches['Zanamivir']] == ['222', '333']
+    for name, found in matches.items():
+        for match in found:
+            product = MedicinalProduct(match.concept_id, match.fsn, match.pt, True, 'FULLY_DEFINED', '20240101')
+            assert match.score == mapper._calculate_match_score(product, name)
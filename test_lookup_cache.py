@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""
+Tests for the lookup cache and its persistent SQLite tier
+Run with: python -m pytest test_lookup_cache.py
+"""
+
+from lookup_cache import LookupCache, SqliteCacheStore
+
+
+def test_persistent_store_is_shared_between_caches(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    writer = LookupCache(store=SqliteCacheStore(path))
+    writer.put('atc', 'zanamivir', 'J05A H01')
+    writer.put('snomed', 'zanamivir', {'product': {'conceptId': '222'}, 'candidates': []})
+
+    # Another process (or a restart) sees the entries, with their original age
+    reader = LookupCache(store=SqliteCacheStore(path))
+    assert reader.get('atc', 'zanamivir') == 'J05A H01'
+    assert reader.get_entry('snomed', 'zanamivir')[1] < 5
+
+    removed = reader.invalidate_where(lambda namespace, key, value: namespace == 'snomed')
+    assert removed == 1
+    assert LookupCache(store=SqliteCacheStore(path)).get('snomed', 'zanamivir') is None
+    assert len(reader.store) == 1
@@ -5,8 +5,104 @@ Simple version without FastMCP dependency for testing
 """
 
 import json
+import os
+import subprocess
 import sys
-from improved_medicinal_product_mapper import XMLMedicinalProductMapper
+import time
+import json_codec
+from improved_medicinal_product_mapper import MedicationData, XMLMedicinalProductMapper
+
+# Import-to-ready budget for mcp_server, excluding the MCP framework itself
+STARTUP_BUDGET_MS = float(os.environ.get('STARTUP_BUDGET_MS', 150))
+
+_STARTUP_PROBE = """
+import json, sys, time
+try:
+    import fastmcp
+except ImportError:
+    pass
+start = time.perf_counter()
+import mcp_server
+ready = time.perf_counter()
+eager = [m for m in ('requests', 'improved_medicinal_product_mapper') if m in sys.modules]
+mcp_server.get_mapper()
+first_call = time.perf_counter()
+print(json.dumps({
+    'import_to_ready_ms': (ready - start) * 1000,
+    'first_call_setup_ms': (first_call - ready) * 1000,
+    'eager_modules': eager
+}))
+"""
+
+
+def measure_startup(runs: int = 5) -> dict:
+    """Import mcp_server in fresh interpreters and report the best import-to-ready time"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', _STARTUP_PROBE], cwd=here, check=True,
+                                capture_output=True, text=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    best = min(samples, key=lambda sample: sample['import_to_ready_ms'])
+    return {**best, 'runs': runs, 'budget_ms': STARTUP_BUDGET_MS}
+
+
+def _sample_mapping(count: int = 50):
+    """Synthetic XML mapping results shaped like real ones (no network)"""
+    medications, results = [], {}
+    for i in range(count):
+        name = f"Substans {i}"
+        medications.append(MedicationData(
+            sub_id=f"Gk-07-gravid-{i}", substance=name,
+            advice="Erfaring med bruk hos gravide er begrenset. Dyrestudier har vist reproduksjonstoksiske effekter. " * 4))
+        results[name] = {
+            'found': True, 'conceptId': str(700000000 + i), 'fsn': f"Product containing only {name} (medicinal product)",
+            'pt': f"{name}-containing product", 'status': 'FULLY_DEFINED', 'effectiveTime': '20240101',
+            'match_type': 'Exact match', 'confidence': 215, 'atc_codes': 'B01A C06, N02B A01', 'degraded': False,
+            'candidates': [{'conceptId': str(800000000 + i * 3 + k), 'fsn': f"Product containing {name} ({k})",
+                            'pt': f"{name} {k}", 'score': 200 - k} for k in range(3)]
+        }
+    return medications, results
+
+
+def measure_response_formats(count: int = 50, repeat: int = 20) -> dict:
+    """Size and serialization time of map_medications_from_xml responses per response_format"""
+    import mcp_server
+    mapper = XMLMedicinalProductMapper()
+    medications, results = _sample_mapping(count)
+    report = {'backend': json_codec.BACKEND, 'medications': count}
+    
+    def timed(serialize, data):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            text = serialize(data)
+        return len(text.encode('utf-8')), (time.perf_counter() - start) / repeat * 1000
+    
+    # Previous behaviour: everything included, indented with the standard library
+    full = mcp_server.build_xml_mapping_response(mapper, medications, results, 'full', True, True)
+    size, ms = timed(lambda data: json.dumps(data, indent=2), full)
+    report['baseline'] = {'bytes': size, 'ms': round(ms, 3)}
+    for response_format in mcp_server.RESPONSE_FORMATS:
+        data = mcp_server.build_xml_mapping_response(mapper, medications, results, response_format)
+        size, ms = timed(json_codec.dumps, data)
+        report[response_format] = {'bytes': size, 'ms': round(ms, 3)}
+    return report
+
+
+def test_compact_response_formats_are_smaller():
+    """Response size benchmark: every format beats the old indented full payload, compact most of all"""
+    report = measure_response_formats(repeat=3)
+    sizes = {name: report[name]['bytes'] for name in ('baseline', 'full', 'json', 'xml', 'compact')}
+    assert sizes['compact'] < sizes['json'] < sizes['full'] < sizes['baseline']
+    assert sizes['xml'] < sizes['full']
+    assert sizes['compact'] * 4 < sizes['baseline']
+
+
+def test_server_startup_within_budget():
+    """Startup benchmark: importing the server must not build the mapper or pull in the HTTP stack"""
+    result = measure_startup()
+    assert result['eager_modules'] == []
+    assert result['import_to_ready_ms'] < STARTUP_BUDGET_MS, result
 
 def test_map_medications_from_xml(xml_content: str) -> str:
     """Test function for mapping medications from XML"""
@@ -46,7 +142,7 @@ def test_map_medications_from_xml(xml_content: str) -> str:
                 "substance": substance_name,
                 "advice": medication.advice,
                 "snomed_ct": result.get('conceptId', 'SNOMED CT not found') if result.get('found') else 'SNOMED CT not found',
-                "atc_codes": mapper.get_atc_codes_from_felleskatalogen(substance_name),
+                "atc_codes": result['atc_codes'] if 'atc_codes' in result else mapper.get_atc_codes_from_felleskatalogen(substance_name),
                 "found": result.get('found', False),
                 "match_type": result.get('match_type', 'Not found')
             }
@@ -84,7 +180,7 @@ def test_get_atc_codes(substance_name: str) -> str:
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("Usage: python test_mcp_server.py <function> <args>")
-        print("Functions: map_medications_from_xml, get_atc_codes")
+        print("Functions: map_medications_from_xml, get_atc_codes, startup_benchmark, response_benchmark")
         sys.exit(1)
     
     function = sys.argv[1]
@@ -105,6 +201,12 @@ if __name__ == "__main__":
         result = test_get_atc_codes(substance_name)
         print(result)
     
+    elif function == "response_benchmark":
+        print(json.dumps(measure_response_formats(), indent=2))
+    
+    elif function == "startup_benchmark":
+        print(json.dumps(measure_startup(), indent=2))
+    
     else:
         print(f"Unknown function: {function}")
         sys.exit(1)
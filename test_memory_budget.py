@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Tests for memory accounting and the memory budget
+Run with: python -m pytest test_memory_budget.py
+"""
+
+from collections import OrderedDict
+
+from lookup_cache import LookupCache
+from memory_budget import MemoryBudget, MemoryTier, deep_sizeof
+
+
+def test_deep_sizeof_counts_nested_values_once():
+    shared = 'x' * 1000
+    assert deep_sizeof({'a': shared, 'b': shared}) < deep_sizeof({'a': shared, 'b': 'y' * 1000})
+    assert deep_sizeof({'product': {'fsn': 'z' * 500}}) > 500
+
+
+def test_budget_trims_evictable_tiers_in_priority_order():
+    memo = OrderedDict((('page', str(i)), f"J05A H{i:02d}") for i in range(100))
+
+    def evict_memo(count):
+        for _ in range(count):
+            memo.popitem(last=False)
+        return count
+
+    cache = LookupCache()
+    for i in range(500):
+        cache.put('snomed', f"substance {i}", {'product': {'conceptId': str(i), 'fsn': 'f' * 200}, 'candidates': []})
+    reference = {'entries': 1, 'bytes': 10 ** 6}
+    budget = MemoryBudget([
+        MemoryTier('memo', lambda: {'entries': len(memo), 'bytes': deep_sizeof(memo)}, evict_memo),
+        MemoryTier('lookup_cache', cache.memory_usage, cache.evict_oldest),
+        MemoryTier('index', lambda: reference)
+    ], limit_bytes=cache.memory_usage()['bytes'] // 2 + 10 ** 6)
+
+    evicted = budget.enforce()
+    assert evicted['memo'] == 100 and not memo
+    assert 0 < evicted['lookup_cache'] < 500
+    # The least recently used entries went first, and the report-only tier was left alone
+    assert cache.get('snomed', 'substance 0') is None
+    assert cache.get('snomed', 'substance 499') is not None
+    snapshot = budget.snapshot()
+    # The report-only tier counts towards the budget
+    assert snapshot['total_bytes'] <= budget.limit_bytes
+    assert snapshot['structures']['index'] == {'entries': 1, 'bytes': 10 ** 6, 'evicted': 0}
+    assert snapshot['structures']['lookup_cache']['evicted'] == evicted['lookup_cache']
+
+    # A growing index leaves less room for the caches
+    remaining = cache.memory_usage()['entries']
+    reference['bytes'] = budget.limit_bytes
+    assert budget.enforce()['lookup_cache'] == remaining
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Tests for the opt-in profiler
+Run with: python -m pytest test_profiling.py
+"""
+
+import contextvars
+import json
+import pstats
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import profiling
+from stub_upstream import StubResponse, StubUpstream
+from upstream_client import ResilientClient
+
+
+def test_profiled_call_saves_pstats_and_upstream_breakdown(tmp_path):
+    with StubUpstream() as stub:
+        stub.add('/concepts', StubResponse(body={'items': []}, delay=0.05))
+        client = ResilientClient(requests.Session(), name='stub', hedge=False)
+        with profiling.profiled('map single', str(tmp_path)) as profile:
+            client.get_json(f"{stub.url}/concepts")
+            client.get_json(f"{stub.url}/concepts")
+        host = stub.url.split('//', 1)[1]
+
+    assert profile.path.endswith('.prof')
+    assert pstats.Stats(profile.path).total_calls > 0
+    with open(profile.path[:-len('.prof')] + '.json', encoding='utf-8') as file:
+        summary = json.load(file)
+    assert summary['label'] == 'map single'
+    assert summary['upstream'][f"{host}/concepts"]['calls'] == 2
+    assert summary['upstream_seconds'] >= 0.1
+    assert summary['wall_seconds'] >= summary['upstream_seconds']
+    assert any('get_json' in entry['function'] for entry in summary['functions'])
+
+
+def _busy_work(n: int) -> int:
+    return sum(i * i for i in range(n))
+
+
+def _thread_cpu(func, *args) -> float:
+    start = time.thread_time()
+    func(*args)
+    return time.thread_time() - start
+
+
+def test_pool_tasks_are_merged_into_the_call_profile(tmp_path):
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        with profiling.profiled('batch', str(tmp_path)) as profile:
+            # Work of another call running at the same time is not charged to this one
+            unrelated = pool.submit(_thread_cpu, _busy_work, 6000000)
+            futures = [pool.submit(contextvars.copy_context().run, profiling.call_in_task, _busy_work, 200000)
+                       for _ in range(2)]
+            [future.result() for future in futures]
+            unrelated.result()
+    with open(profile.path[:-len('.prof')] + '.json', encoding='utf-8') as file:
+        summary = json.load(file)
+    stats = pstats.Stats(profile.path)
+    # The work ran only on pool threads, yet shows up in the call's stats and CPU time
+    assert any(function == '_busy_work' for _, _, function in stats.stats)
+    assert 0.01 < summary['cpu_seconds'] < unrelated.result()
+    if sys.version_info < (3, 12):
+        assert summary['profiled_tasks'] == 2
+
+
+def test_sampling_is_off_unless_configured(tmp_path, monkeypatch):
+    def tool():
+        return 'ok'
+
+    monkeypatch.delenv('PROFILE_SAMPLE_RATE', raising=False)
+    assert profiling.sampled(tool) is tool
+
+    monkeypatch.setenv('PROFILE_SAMPLE_RATE', '3')
+    monkeypatch.setenv('PROFILE_DIR', str(tmp_path))
+    wrapped = profiling.sampled(tool)
+    assert [wrapped() for _ in range(6)] == ['ok'] * 6
+    assert len(list(tmp_path.glob('*_tool_*.prof'))) == 2
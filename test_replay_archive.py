@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Tests for the record/replay transport against a local stub
+Run with: python -m pytest test_replay_archive.py
+"""
+
+import pytest
+import requests
+
+import replay_archive
+from replay_archive import ReplayArchive, ReplayMiss
+from stub_upstream import StubResponse, StubUpstream
+from upstream_client import CircuitBreaker, ResilientClient
+
+
+def archived_session(archive: ReplayArchive, mode: str) -> requests.Session:
+    session = requests.Session()
+    replay_archive.install(session, archive, mode)
+    return session
+
+
+def test_recorded_answers_are_replayed_without_network(tmp_path):
+    archive = ReplayArchive(str(tmp_path / 'replay.sqlite'))
+    with StubUpstream() as stub:
+        stub.add('/concepts', StubResponse(body={'items': [{'conceptId': '111'}]}))
+        stub.add('/missing', StubResponse(status=404, body='Not found'))
+        url = stub.url
+        recorder = archived_session(archive, 'record')
+        recorder.get(f"{url}/concepts", params={'term': 'zanamivir', 'limit': 5})
+        recorder.get(f"{url}/missing")
+    assert len(archive) == 2
+
+    replayer = archived_session(archive, 'replay')
+    concepts = replayer.get(f"{url}/concepts", params={'limit': 5, 'term': 'zanamivir'})
+    missing = replayer.get(f"{url}/missing")
+    assert concepts.json() == {'items': [{'conceptId': '111'}]}
+    assert concepts.headers['X-Replay'] == 'REPLAY'
+    assert missing.status_code == 404
+    with pytest.raises(ReplayMiss):
+        replayer.get(f"{url}/concepts", params={'term': 'oseltamivir'})
+    assert archive.snapshot()['replayed'] == 2 and archive.snapshot()['misses'] == 1
+
+
+def test_archive_answers_when_the_upstream_fails(tmp_path):
+    archive = ReplayArchive(str(tmp_path / 'replay.sqlite'))
+    with StubUpstream() as stub:
+        stub.add('/concepts', StubResponse(body={'items': []}), StubResponse(status=503))
+        recorder = archived_session(archive, 'record')
+        recorder.get(f"{stub.url}/concepts", params={'term': 'zanamivir'})
+        # A fresh client has no last-known-good answer of its own
+        client = ResilientClient(requests.Session(), max_retries=1, backoff_base=0.0, hedge=False,
+                                 breaker=CircuitBreaker(failure_threshold=1), archive=archive)
+        failed = client.get_json(f"{stub.url}/concepts", params={'term': 'zanamivir'})
+        hits = stub.hits['/concepts']
+        circuit_open = client.get_json(f"{stub.url}/concepts", params={'term': 'zanamivir'})
+        assert stub.hits['/concepts'] == hits
+    assert failed == circuit_open == {'items': []}
+    assert client.metrics()['served_from_archive'] == 2
+    assert client.metrics()['breaker_state'] == 'open'
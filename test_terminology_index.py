@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Tests for the local terminology indexes against a local Snowstorm stub
+Run with: python -m pytest test_terminology_index.py
+"""
+
+import json
+from typing import List
+
+import requests
+
+from cache_snapshot import write_snapshot
+from improved_medicinal_product_mapper import XMLMedicinalProductMapper
+from stub_upstream import StubRequest, StubResponse, StubUpstream
+from terminology_index import OnlyProductIndex
+from upstream_client import ResilientClient
+
+CONCEPTS_PATH = '/snowstorm/snomed-ct/MAIN%2FSNOMEDCT-NO/concepts'
+SEARCH_PATH = '/snowstorm/snomed-ct/MAIN%2FSNOMEDCT-NO/concepts/search'
+RELATIONSHIPS_PATH = '/snowstorm/snomed-ct/MAIN%2FSNOMEDCT-NO/relationships'
+DESCRIPTIONS_PATH = '/snowstorm/snomed-ct/MAIN%2FSNOMEDCT-NO/descriptions'
+BULK_LOAD_PATH = '/snowstorm/snomed-ct/browser/MAIN%2FSNOMEDCT-NO/concepts/bulk-load'
+BRANCH_PATH = '/snowstorm/snomed-ct/branches/MAIN%2FSNOMEDCT-NO'
+VERSIONS_PATH = '/snowstorm/snomed-ct/codesystems/SNOMEDCT-NO/versions'
+
+PRODUCTS = [
+    ('201', 'Product containing only zanamivir (medicinal product)', '111'),
+    ('202', 'Product containing only verapamil (medicinal product)', '112'),
+    ('203', 'Product containing verapamil and trandolapril (medicinal product)', '112'),
+]
+
+
+def product_pages(request: StubRequest) -> StubResponse:
+    """Two pages of medicinal products, continued with searchAfter"""
+    start = int(request.params.get('searchAfter', 0))
+    limit = int(request.params['limit'])
+    page = PRODUCTS[start:start + limit]
+    items = [{'conceptId': cid, 'fsn': {'term': fsn}, 'pt': {'term': fsn.split(' (')[0]},
+              'active': True, 'definitionStatus': 'FULLY_DEFINED', 'effectiveTime': '20240101'}
+             for cid, fsn, _ in page]
+    body = {'items': items, 'total': len(PRODUCTS)}
+    if start + limit < len(PRODUCTS):
+        body['searchAfter'] = str(start + limit)
+    return StubResponse(body=body)
+
+
+def bulk_load(request: StubRequest) -> StubResponse:
+    wanted = json.loads(request.params['_body'])['conceptIds']
+    concepts = []
+    for cid, _, substance in PRODUCTS:
+        if cid in wanted:
+            relationships = [
+                {'active': True, 'typeId': '127489000', 'destinationId': substance},
+                {'active': False, 'typeId': '127489000', 'destinationId': '999'},
+                {'active': True, 'typeId': '116680003', 'destinationId': '763158003'},
+            ]
+            concepts.append({'conceptId': cid, 'relationships': relationships})
+    return StubResponse(body=concepts)
+
+
+def ancestors(request: StubRequest) -> StubResponse:
+    """112 is a parent of 111 in this stub's substance hierarchy"""
+    ecl = json.loads(request.params['_body'])['ecl']
+    return StubResponse(body={'items': ['112', '100'] if '111' in ecl else []})
+
+
+def test_build_pages_through_products_and_round_trips(tmp_path):
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, product_pages)
+        stub.add_handler(BULK_LOAD_PATH, bulk_load)
+        stub.add_handler(SEARCH_PATH, ancestors)
+        stub.add(BRANCH_PATH, StubResponse(body={'path': 'MAIN/SNOMEDCT-NO', 'headTimestamp': 1700}))
+        stub.add(VERSIONS_PATH, StubResponse(body={'items': [{'effectiveDate': 20231015},
+                                                             {'effectiveDate': 20240415}]}))
+        client = ResilientClient(requests.Session(), name='stub', hedge=False)
+        index = OnlyProductIndex.build(client, stub.url, page_size=2)
+        assert stub.hits[CONCEPTS_PATH] == 2
+        assert stub.hits[BULK_LOAD_PATH] == 2
+    assert index.by_substance == {'111': ['201'], '112': ['202', '203']}
+    assert index.products_for_substance('999') is None
+    # 112 has an indexed descendant substance, so only the ECL query (<< 112) gives all its products
+    assert index.with_descendants == {'112', '100'}
+    assert index.products_for_substance('112') is None
+    assert (index.head_timestamp, index.effective_time) == (1700, '20240415')
+
+    path = str(tmp_path / 'only_product_map.json')
+    index.save(path)
+    loaded = OnlyProductIndex.load(path)
+    assert loaded.by_substance == index.by_substance
+    assert loaded.with_descendants == index.with_descendants
+    assert loaded.head_timestamp == 1700
+    assert loaded.products_for_substance('111')[0]['fsn'] == PRODUCTS[0][1]
+
+
+def test_mapper_uses_loaded_map_instead_of_ecl_query(tmp_path, monkeypatch):
+    path = str(tmp_path / 'only_product_map.json')
+    OnlyProductIndex({'201': (PRODUCTS[0][1], 'Zanamivir-containing product', 'FULLY_DEFINED', '20240101')},
+                     {'111': ['201']}).save(path)
+    monkeypatch.setenv('ONLY_PRODUCT_MAP', path)
+    with StubUpstream() as stub:
+        stub.add(CONCEPTS_PATH, StubResponse(status=500))
+        mapper = XMLMedicinalProductMapper(base_url=stub.url)
+        products = mapper._find_only_product_for_substance('111')
+        assert stub.hits.get(CONCEPTS_PATH, 0) == 0
+    assert [p.conceptId for p in products] == ['201']
+    assert products[0].fsn == PRODUCTS[0][1]
+
+
+def delta_stub(stub: StubUpstream, head: int):
+    """Branch moved on: 202 inactivated in 20240415, 203 gained an ingredient, 204 is new and unpublished,
+    201 has an unpublished ingredient relationship edit, 205 was renamed in 20240415; substance 900 got a
+    new synonym and finding 901 changed, both outside the product hierarchy"""
+    def search(request: StubRequest) -> StubResponse:
+        body = json.loads(request.params['_body'])
+        if 'conceptIds' in body:
+            return members(body['conceptIds'])
+        if body.get('effectiveTime') == 20240415:
+            return StubResponse(body={'items': ['202']})
+        if body.get('isNullEffectiveTime'):
+            return StubResponse(body={'items': ['204', '901']})
+        if body.get('ecl') == '> (113 OR 114)':
+            return StubResponse(body={'items': ['111']})
+        return StubResponse(body={'items': []})
+
+    def relationships(request: StubRequest) -> StubResponse:
+        items = [{'sourceId': '203'}] if request.params.get('effectiveTime') == '20240415' else []
+        if request.params.get('isNullEffectiveTime') == 'true':
+            items = [{'sourceId': '201'}]
+        return StubResponse(body={'items': items})
+
+    def descriptions(request: StubRequest) -> StubResponse:
+        items = [{'conceptId': '205'}] if request.params.get('effectiveTime') == '20240415' else []
+        if request.params.get('isNullEffectiveTime') == 'true':
+            items = [{'conceptId': '900'}]
+        return StubResponse(body={'items': items})
+
+    def load(request: StubRequest) -> StubResponse:
+        ingredients = {'201': ['111'], '203': ['112', '113'], '204': ['114'], '205': ['115']}
+        concepts = [{'conceptId': '202', 'active': False, 'relationships': []}]
+        for cid, substances in ingredients.items():
+            concepts.append({'conceptId': cid, 'active': True, 'relationships': [
+                {'active': True, 'typeId': '127489000', 'destinationId': sid} for sid in substances]})
+        wanted = json.loads(request.params['_body'])['conceptIds']
+        return StubResponse(body=[c for c in concepts if c['conceptId'] in wanted])
+
+    def members(wanted: List[str]) -> StubResponse:
+        names = {'201': PRODUCTS[0][1],
+                 '203': 'Product containing verapamil and trandolapril and other (medicinal product)',
+                 '204': 'Product containing only newsubstance (medicinal product)',
+                 '205': 'Product containing only oseltamivir phosphate (medicinal product)'}
+        items = [{'conceptId': cid, 'fsn': {'term': names[cid]}, 'pt': {'term': names[cid]},
+                  'definitionStatus': 'FULLY_DEFINED', 'effectiveTime': ''} for cid in wanted if cid in names]
+        return StubResponse(body={'items': items})
+
+    stub.add(BRANCH_PATH, StubResponse(body={'headTimestamp': head}))
+    stub.add(VERSIONS_PATH, StubResponse(body={'items': [{'effectiveDate': 20240101},
+                                                         {'effectiveDate': 20240415}]}))
+    stub.add_handler(SEARCH_PATH, search)
+    stub.add_handler(RELATIONSHIPS_PATH, relationships)
+    stub.add_handler(DESCRIPTIONS_PATH, descriptions)
+    stub.add_handler(BULK_LOAD_PATH, load)
+
+
+def synced_index() -> OnlyProductIndex:
+    products = {cid: (fsn, fsn, 'FULLY_DEFINED', '20240101') for cid, fsn, _ in PRODUCTS}
+    products['205'] = ('Product containing only oseltamivir (medicinal product)',
+                       'Oseltamivir-containing product', 'FULLY_DEFINED', '20240101')
+    return OnlyProductIndex(products, {'111': ['201'], '112': ['202', '203'], '115': ['205']},
+                            head_timestamp=1000, effective_time='20240101')
+
+
+def test_sync_applies_only_changed_concepts():
+    index = synced_index()
+    with StubUpstream() as stub:
+        delta_stub(stub, head=2000)
+        client = ResilientClient(requests.Session(), name='stub', hedge=False)
+        report = index.sync(client, stub.url)
+        again = index.sync(client, stub.url)
+        searches = stub.hits[SEARCH_PATH]
+        loaded = [cid for r in stub.requests if r.path == BULK_LOAD_PATH
+                  for cid in json.loads(r.params['_body'])['conceptIds']]
+    # 201 only had an unpublished ingredient relationship change, 205 only a description change
+    assert (report.changed, report.updated, report.added, report.removed) == (7, 3, 1, ['202'])
+    assert index.by_substance == {'111': ['201'], '112': ['203'], '113': ['203'], '114': ['204'], '115': ['205']}
+    assert '202' not in index.products
+    assert index.products['205'][0] == 'Product containing only oseltamivir phosphate (medicinal product)'
+    # Changes outside the product hierarchy and the map are never loaded
+    assert report.skipped == 2 and sorted(loaded) == ['201', '203', '204', '205']
+    # 111 gained a descendant ingredient (113 or 114): its lookups go to the ECL query now
+    assert index.with_descendants == {'111'} and index.products_for_substance('111') is None
+    assert (index.head_timestamp, index.effective_time) == (2000, '20240415')
+    # Unchanged branch head: nothing is fetched
+    assert again.up_to_date and searches == 4
+    # Membership was checked in one POST search, with no ids in a query string
+    assert stub.hits.get(CONCEPTS_PATH, 0) == 0
+
+
+def test_mapper_sync_invalidates_cached_mappings_to_inactivated_concepts(tmp_path, monkeypatch):
+    path = str(tmp_path / 'only_product_map.json')
+    synced_index().save(path)
+    monkeypatch.setenv('ONLY_PRODUCT_MAP', path)
+    snapshot_path = str(tmp_path / 'snapshot.bin')
+    write_snapshot(snapshot_path, [('snomed', 'verapamil', {
+        'product': {'conceptId': '202', 'fsn': PRODUCTS[1][1], 'pt': 'Verapamil', 'active': True,
+                    'definitionStatus': 'FULLY_DEFINED', 'effectiveTime': '20240101'},
+        'confidence': 200, 'candidates': []})], metadata={'version': '20240101000000'})
+    monkeypatch.setenv('CACHE_SNAPSHOT', snapshot_path)
+    with StubUpstream() as stub:
+        delta_stub(stub, head=2000)
+        mapper = XMLMedicinalProductMapper(base_url=stub.url)
+        mapper.lookup_cache.put('snomed', 'verapamil', {
+            'product': {'conceptId': '202', 'fsn': PRODUCTS[1][1], 'pt': 'Verapamil', 'active': True,
+                        'definitionStatus': 'FULLY_DEFINED', 'effectiveTime': '20240101'},
+            'confidence': 200, 'candidates': []})
+        mapper.lookup_cache.put('snomed', 'zanamivir', {'product': None, 'confidence': None, 'candidates': []})
+        summary = mapper.sync_terminology()
+    assert summary['removed'] == 1 and summary['invalidated_mappings'] == 1
+    assert mapper.lookup_cache.get('snomed', 'verapamil') is None
+    assert mapper.lookup_cache.get('snomed', 'zanamivir') is not None
+    assert OnlyProductIndex.load(path).head_timestamp == 2000
+    # After a restart the snapshot answer pointing at the retired concept is still not served
+    restarted = XMLMedicinalProductMapper(base_url='http://127.0.0.1:9')
+    assert restarted._cached('snomed', 'verapamil', 'Verapamil') == (None, None)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Tests for tracing spans around lookups and upstream requests
+Run with: python -m pytest test_tracing.py
+"""
+
+import json
+
+import pytest
+
+import tracing
+from stub_upstream import StubResponse, StubUpstream
+from test_improved_medicinal_product_mapper import CONCEPTS_PATH, make_mapper, snowstorm_handler
+
+
+class MemoryExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, record):
+        self.spans.append(record)
+
+    def named(self, name):
+        return [span for span in self.spans if span['name'] == name]
+
+
+@pytest.fixture
+def exporter():
+    memory = MemoryExporter()
+    tracing.configure(memory)
+    yield memory
+    tracing.configure(None)
+
+
+def test_lookup_spans_nest_under_the_caller(exporter):
+    with StubUpstream() as stub:
+        stub.add_handler(CONCEPTS_PATH, snowstorm_handler())
+        stub.add('/substansregister/zanamivir', StubResponse(body='<p>ATC-koder: J05A H01</p>'))
+        mapper = make_mapper(stub)
+        with tracing.span('test.map'):
+            mapper.map_substance('Zanamivir')
+
+    root = exporter.named('test.map')[0]
+    assert {span['traceId'] for span in exporter.spans} == {root['traceId']}
+    find = exporter.named('mapper.find_medicinal_product')[0]
+    assert find['parentSpanId'] == root['spanId']
+    assert find['attributes'] == {'substance': 'Zanamivir', 'found': True, 'concept_id': '222', 'degraded': False}
+    concepts = exporter.named('snowstorm.find_substance_concepts')[0]
+    assert concepts['parentSpanId'] == find['spanId']
+    assert concepts['attributes']['ecl.shape'] == '<< 105590001 |Substance|'
+    assert concepts['attributes']['result.count'] == 1
+    requests = [span for span in exporter.named('upstream.request') if span['parentSpanId'] == concepts['spanId']]
+    assert requests and all(span['attributes']['http.status_code'] == 200 for span in requests)
+    assert {span['attributes']['cache.status'] for span in exporter.named('cache.lookup')} == {'miss'}
+    # The ATC lookup ran on another thread and still belongs to the same trace
+    fetch = exporter.named('felleskatalogen.fetch_atc')[0]
+    assert fetch['attributes']['atc_codes'] == 'J05A H01'
+    assert exporter.named('felleskatalogen.request')[0]['parentSpanId'] == fetch['spanId']
+
+
+def test_file_exporter_writes_json_lines_and_off_means_no_op(tmp_path):
+    path = tmp_path / 'traces.jsonl'
+    tracing.configure(tracing.FileExporter(str(path)))
+    try:
+        with pytest.raises(ValueError):
+            with tracing.span('outer', substance='Zanamivir'):
+                with tracing.span('inner') as inner:
+                    inner.set_attribute('result.count', 3)
+                raise ValueError('boom')
+    finally:
+        tracing.configure(None)
+    inner, outer = [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+    assert inner['parentSpanId'] == outer['spanId']
+    assert inner['attributes'] == {'result.count': 3}
+    assert outer['status'] == {'code': 'ERROR', 'message': 'ValueError: boom'}
+    assert tracing.span('off') is tracing.span('also off')
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Tests for the resilient upstream client against a local stub
+Run with: python -m pytest test_upstream_client.py
+"""
+
+import threading
+import time
+
+import pytest
+import requests
+
+import replay_archive
+from replay_archive import ReplayArchive
+from stub_upstream import StubResponse, StubUpstream
+from upstream_client import (BULK, INTERACTIVE, AdaptiveConcurrencyLimiter, CircuitBreaker, ConcurrencyLimiters,
+                             PriorityExecutor, ResilientClient, TokenBucket, UpstreamUnavailable, request_priority,
+                             route_of)
+
+
+def make_client(**kwargs) -> ResilientClient:
+    options = dict(timeout=5.0, backoff_base=0.01, backoff_max=0.02, hedge_default_delay=0.1)
+    options.update(kwargs)
+    return ResilientClient(requests.Session(), name='stub', **options)
+
+
+def test_hedged_request_beats_slow_primary():
+    with StubUpstream() as stub:
+        stub.add('/concepts', StubResponse(body={'items': ['slow']}, delay=2.0),
+                 StubResponse(body={'items': ['fast']}))
+        client = make_client()
+        start = time.monotonic()
+        data = client.get_json(f"{stub.url}/concepts")
+        elapsed = time.monotonic() - start
+    assert data == {'items': ['fast']}
+    assert elapsed < 1.5
+    assert client.metrics()['hedges'] == 1
+
+
+def test_requests_queued_for_a_token_are_not_hedged():
+    with StubUpstream() as stub:
+        stub.add('/concepts', StubResponse(body={'items': []}))
+        bucket = TokenBucket('stub', rate=4.0, burst=1)
+        bucket.acquire()
+        client = make_client(rate_limit=bucket)
+        start = time.monotonic()
+        client.get_json(f"{stub.url}/concepts")
+        waited = time.monotonic() - start
+        hits = stub.hits['/concepts']
+    # Waited longer than the hedge delay for its token, then answered at once
+    assert waited > 0.2
+    assert hits == 1 and client.metrics()['hedges'] == 0
+
+
+def test_retries_transient_failures():
+    with StubUpstream() as stub:
+        stub.add('/concepts', StubResponse(status=503), StubResponse(status=502),
+                 StubResponse(body={'items': []}))
+        client = make_client(hedge=False)
+        data = client.get_json(f"{stub.url}/concepts")
+    assert data == {'items': []}
+    assert client.metrics()['retries'] == 2
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_client_errors_are_not_retried():
+    with StubUpstream() as stub:
+        stub.add('/concepts', StubResponse(status=400, body='bad ecl'))
+        client = make_client(hedge=False)
+        with pytest.raises(requests.HTTPError):
+            client.get_json(f"{stub.url}/concepts")
+        assert stub.hits['/concepts'] == 1
+
+
+def test_open_breaker_fails_fast_without_cache():
+    with StubUpstream() as stub:
+        stub.add('/concepts', StubResponse(status=503))
+        client = make_client(hedge=False, max_retries=1,
+                             breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+        with pytest.raises(UpstreamUnavailable):
+            client.get_json(f"{stub.url}/concepts")
+        hits = stub.hits['/concepts']
+        start = time.monotonic()
+        with pytest.raises(UpstreamUnavailable):
+            client.get_json(f"{stub.url}/concepts")
+        assert time.monotonic() - start < 0.1
+        assert stub.hits['/concepts'] == hits
+    assert client.breaker.state == CircuitBreaker.OPEN
+    assert client.metrics()['degraded'] == 2
+
+
+def test_open_breaker_answers_from_cache():
+    with StubUpstream() as stub:
+        stub.add('/concepts', StubResponse(body={'items': [1]}), StubResponse(status=500))
+        client = make_client(hedge=False, max_retries=0,
+                             breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60))
+        assert client.get_json(f"{stub.url}/concepts", {'term': 'x'}) == {'items': [1]}
+        assert client.get_json(f"{stub.url}/concepts", {'term': 'x'}) == {'items': [1]}
+        assert client.breaker.state == CircuitBreaker.OPEN
+        assert client.get_json(f"{stub.url}/concepts", {'term': 'x'}) == {'items': [1]}
+    assert client.metrics()['served_from_cache'] == 2
+
+
+def test_half_open_probe_closes_breaker():
+    with StubUpstream() as stub:
+        stub.add('/concepts', StubResponse(status=503), StubResponse(body={'items': []}))
+        client = make_client(hedge=False, max_retries=0,
+                             breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.05))
+        with pytest.raises(UpstreamUnavailable):
+            client.get_json(f"{stub.url}/concepts")
+        time.sleep(0.1)
+        assert client.get_json(f"{stub.url}/concepts") == {'items': []}
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_replay_miss_while_half_open_releases_the_probe(tmp_path):
+    with StubUpstream() as stub:
+        stub.add('/concepts', StubResponse(status=503))
+        client = make_client(hedge=False, max_retries=0,
+                             breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.05))
+        with pytest.raises(UpstreamUnavailable):
+            client.get_json(f"{stub.url}/concepts")
+        time.sleep(0.1)
+        # Replaying from an archive that has no answer: the probe never reaches the upstream
+        replay_archive.install(client.session, ReplayArchive(str(tmp_path / 'replay.sqlite')), 'replay')
+        with pytest.raises(UpstreamUnavailable):
+            client.get_json(f"{stub.url}/concepts")
+    assert client.breaker.state == CircuitBreaker.HALF_OPEN
+    assert client.breaker.allow_request()
+
+
+def test_limiter_grows_while_latency_is_stable():
+    limiter = AdaptiveConcurrencyLimiter('stub', initial_limit=2, max_limit=16)
+
+    def worker():
+        for _ in range(40):
+            with limiter.slot() as outcome:
+                time.sleep(0.002)
+                outcome['status'] = 200
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert limiter.limit > 2
+    assert limiter.snapshot()['in_flight'] == 0
+
+
+def test_limiter_backs_off_on_overload_status_and_latency():
+    limiter = AdaptiveConcurrencyLimiter('stub', initial_limit=8)
+    limiter.acquire()
+    limiter.release(0.01, status=200)
+    limiter.acquire()
+    limiter.release(0.01, status=429)
+    assert limiter.limit == 4
+    # A burst of concurrent failures within one round trip only counts once
+    limiter.acquire()
+    limiter.release(0.01, status=503)
+    assert limiter.limit == 4
+
+    limiter = AdaptiveConcurrencyLimiter('stub', initial_limit=8)
+    limiter.acquire()
+    limiter.release(0.01, status=200)
+    limiter.acquire()
+    limiter.release(0.5, status=200)
+    assert limiter.limit == 4
+
+
+def test_limiter_keeps_latency_baselines_per_route():
+    limiter = AdaptiveConcurrencyLimiter('stub', initial_limit=8)
+    concepts = route_of('https://stub/MAIN/concepts/123')
+    register = route_of('https://stub/medisin/substansregister/paracetamol')
+    assert concepts == '/MAIN/concepts/*' and register == '/medisin/substansregister/*'
+    for _ in range(3):
+        with limiter.slot(route=concepts) as outcome:
+            outcome['status'] = 200
+    # A large page is slow on its own route; that is not congestion on the concept route
+    limiter.acquire()
+    limiter.release(0.5, status=200, route=register)
+    assert limiter.limit == 8
+    limiter.acquire()
+    limiter.release(0.5, status=200, route=concepts)
+    assert limiter.limit == 4
+    assert set(limiter.snapshot()['baseline_latency_ms']) == {'/MAIN/concepts/* 2xx', '/medisin/substansregister/* 2xx'}
+
+
+def test_limiter_blocks_beyond_limit():
+    limiter = AdaptiveConcurrencyLimiter('stub', initial_limit=1, max_limit=1)
+    limiter.acquire()
+    acquired = threading.Event()
+
+    def second():
+        limiter.acquire()
+        acquired.set()
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not acquired.wait(0.1)
+    limiter.release(0.01, status=200)
+    assert acquired.wait(1.0)
+    thread.join()
+
+
+def test_limiter_serves_interactive_first_with_a_bulk_minimum_share():
+    limiter = AdaptiveConcurrencyLimiter('stub', initial_limit=1, max_limit=1, bulk_min_share=0.2)
+    limiter.acquire()
+    order = []
+
+    def request(name: str, priority: int):
+        with request_priority(priority):
+            with limiter.slot():
+                order.append(name)
+
+    threads = []
+    for name in [f"b{i}" for i in range(6)] + [f"i{i}" for i in range(6)]:
+        threads.append(threading.Thread(target=request, args=(name, BULK if name[0] == 'b' else INTERACTIVE)))
+        threads[-1].start()
+        # Queue them in a known order
+        while sum(limiter.snapshot()['waiting'].values()) < len(threads):
+            time.sleep(0.001)
+    limiter.release(0.01, status=200)
+    for thread in threads:
+        thread.join()
+    # One slot in five goes to bulk work while interactive requests keep arriving
+    assert order == ['i0', 'i1', 'i2', 'i3', 'b0', 'i4', 'i5', 'b1', 'b2', 'b3', 'b4', 'b5']
+    assert limiter.snapshot()['granted'] == {'interactive': 6, 'bulk': 7}
+
+
+def test_priority_executor_keeps_threads_for_interactive_tasks():
+    release = threading.Event()
+    order = []
+    pool = PriorityExecutor(max_workers=2, interactive_workers=1)
+    bulk = [pool.submit(lambda i=i: (release.wait(5), order.append(f'bulk-{i}'))) for i in range(4)]
+    time.sleep(0.05)
+    with request_priority(INTERACTIVE):
+        # Both bulk threads are busy, yet this starts at once on the reserved thread
+        assert pool.submit(lambda: 'interactive').result(timeout=1) == 'interactive'
+        late = pool.submit(order.append, 'interactive')
+    release.set()
+    late.result(timeout=1)
+    [future.result(timeout=1) for future in bulk]
+    pool.shutdown()
+    # The waiting interactive task went ahead of the two queued bulk tasks
+    assert order.index('interactive') < order.index('bulk-3')
+    assert len(pool._threads) == 3
+
+
+def test_client_reports_per_host_limits():
+    with StubUpstream() as stub:
+        stub.add('/concepts', StubResponse(body={'items': []}))
+        limiters = ConcurrencyLimiters()
+        client = make_client(hedge=False, limiters=limiters)
+        client.get_json(f"{stub.url}/concepts")
+        snapshot = limiters.snapshot()
+        host = stub.url.split('//', 1)[1]
+    assert snapshot[host]['acquired'] == 1
+    assert snapshot[host]['in_flight'] == 0
+
+
+def test_token_bucket_allows_burst_then_queues_at_rate():
+    bucket = TokenBucket('stub', rate=20.0, burst=3)
+    start = time.monotonic()
+    waits = [bucket.acquire() for _ in range(5)]
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert 0.03 < waits[3] <= 0.06
+    assert time.monotonic() - start >= 0.09
+
+
+def test_token_bucket_paces_threads():
+    bucket = TokenBucket('stub', rate=50.0, burst=1)
+    start = time.monotonic()
+    threads = [threading.Thread(target=bucket.acquire) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.monotonic() - start >= 0.17
+    assert bucket.snapshot()['acquired'] == 10
+
+
+def test_token_bucket_state_is_shared_through_sqlite(tmp_path):
+    state = str(tmp_path / 'ratelimit.sqlite')
+    first = TokenBucket('felleskatalogen', rate=10.0, burst=2, state_path=state)
+    second = TokenBucket('felleskatalogen', rate=10.0, burst=2, state_path=state)
+    assert first.acquire() == 0.0
+    assert first.acquire() == 0.0
+    # Another worker sees the drained bucket and queues behind it
+    assert second.acquire() > 0.05
+    other = TokenBucket('snowstorm', rate=10.0, burst=2, state_path=state)
+    assert other.acquire() == 0.0
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Tracing spans for lookups and upstream requests
+Spans follow the OpenTelemetry model (trace and span ids, parent links, attributes, status)
+and are exported as one JSON object per span with OTLP field names:
+
+    TRACE_EXPORTER=console   spans to stderr
+    TRACE_EXPORTER=file      spans appended to TRACE_FILE (default Output/traces.jsonl)
+    TRACE_EXPORTER=otel      spans handed to the OpenTelemetry API (pip install opentelemetry-sdk
+                             and configure a tracer provider and exporter in the host application)
+
+With no exporter, span() returns a shared no-op span. Parent links follow contextvars, so
+work submitted to thread pools with contextvars.copy_context().run stays in its trace.
+"""
+
+import contextvars
+import functools
+import os
+import secrets
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import json_codec
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+DEFAULT_TRACE_FILE = os.path.join('Output', 'traces.jsonl')
+
+_current: contextvars.ContextVar = contextvars.ContextVar('trace_span', default=None)
+
+
+def _attribute(value: Any) -> Any:
+    """Attribute values are kept to the types OpenTelemetry accepts"""
+    return value if isinstance(value, (str, bool, int, float)) else str(value)
+
+
+class Span:
+    """One timed operation; use as a context manager"""
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start_ns', 'end_ns', 'attributes',
+                 'status', '_exporter', '_token')
+
+    def __init__(self, name: str, attributes: Dict[str, Any], exporter):
+        parent = _current.get()
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.start_ns = 0
+        self.end_ns = 0
+        self.attributes: Dict[str, Any] = {}
+        self.status: Optional[str] = None
+        self._exporter = exporter
+        self._token = None
+        self.set_attributes(**attributes)
+
+    def set_attribute(self, key: str, value: Any):
+        if value is not None:
+            self.attributes[key] = _attribute(value)
+
+    def set_attributes(self, **attributes):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def __enter__(self) -> 'Span':
+        self._token = _current.set(self)
+        self.start_ns = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.end_ns = time.time_ns()
+        _current.reset(self._token)
+        if exc is not None:
+            self.status = f"{exc_type.__name__}: {exc}"
+        try:
+            self._exporter.export(self.to_dict())
+        except Exception as e:
+            print(f"Warning: Could not export span '{self.name}': {e}")
+        return False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id or '',
+            'name': self.name,
+            'startTimeUnixNano': self.start_ns,
+            'endTimeUnixNano': self.end_ns,
+            'durationMs': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'attributes': self.attributes,
+            'status': {'code': 'ERROR', 'message': self.status} if self.status else {'code': 'OK'}
+        }
+
+
+class _NoopSpan:
+    """Stand-in when tracing is off"""
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+    def __enter__(self) -> '_NoopSpan':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class _OtelSpan:
+    """Span recorded through the OpenTelemetry API"""
+
+    def __init__(self, tracer, name: str, attributes: Dict[str, Any]):
+        self._manager = tracer.start_as_current_span(
+            name, attributes={key: _attribute(value) for key, value in attributes.items() if value is not None})
+        self._span = None
+
+    def set_attribute(self, key: str, value: Any):
+        if value is not None:
+            self._span.set_attribute(key, _attribute(value))
+
+    def set_attributes(self, **attributes):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def __enter__(self) -> '_OtelSpan':
+        self._span = self._manager.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return bool(self._manager.__exit__(exc_type, exc, tb))
+
+
+class _OtelCurrent(_OtelSpan):
+    """The current OpenTelemetry span"""
+
+    def __init__(self):
+        self._span = otel_trace.get_current_span()
+
+
+class ConsoleExporter:
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+        self._lock = threading.Lock()
+
+    def export(self, record: Dict[str, Any]):
+        line = json_codec.dumps(record)
+        with self._lock:
+            print(line, file=self.stream, flush=True)
+
+
+class FileExporter:
+    """Appends spans to a JSON Lines file"""
+
+    def __init__(self, path: str = DEFAULT_TRACE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def export(self, record: Dict[str, Any]):
+        line = json_codec.dumps(record) + '\n'
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_exporter = None
+_tracer = None
+
+
+def configure(exporter=None):
+    """Export spans to exporter (any object with export(record)); None turns tracing off"""
+    global _exporter, _tracer
+    _exporter = exporter
+    _tracer = None
+
+
+def configure_from_env():
+    """Set up the exporter named by TRACE_EXPORTER"""
+    global _tracer
+    name = (os.environ.get('TRACE_EXPORTER') or '').lower()
+    if name == 'console':
+        configure(ConsoleExporter())
+    elif name == 'file':
+        configure(FileExporter(os.environ.get('TRACE_FILE') or DEFAULT_TRACE_FILE))
+    elif name == 'otel':
+        if otel_trace is None:
+            print("Warning: TRACE_EXPORTER=otel needs the opentelemetry packages; tracing is off")
+            configure(None)
+        else:
+            configure(None)
+            _tracer = otel_trace.get_tracer('medicinal-product-mapper')
+    else:
+        if name:
+            print(f"Warning: Unknown TRACE_EXPORTER '{name}'; use console, file or otel")
+        configure(None)
+
+
+def enabled() -> bool:
+    return _exporter is not None or _tracer is not None
+
+
+def span(name: str, **attributes):
+    """Start a span as a child of the current one (use with `with`)"""
+    if _exporter is not None:
+        return Span(name, attributes, _exporter)
+    if _tracer is not None:
+        return _OtelSpan(_tracer, name, attributes)
+    return _NOOP
+
+
+def current():
+    """The span this code runs in (a no-op span when there is none), to add attributes to it"""
+    if _exporter is not None:
+        return _current.get() or _NOOP
+    if _tracer is not None:
+        return _OtelCurrent()
+    return _NOOP
+
+
+def traced(func: Callable) -> Callable:
+    """One span per call of an MCP tool (mcp.<tool>); returns func itself when tracing is off"""
+    if not enabled():
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(f"mcp.{func.__name__}", tool=func.__name__, substance=kwargs.get('substance_name')):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+configure_from_env()
@@ -0,0 +1,755 @@
+#!/usr/bin/env python3
+"""
+Resilient upstream client for the Snowstorm terminology server
+Hedged requests, retries with exponential backoff and jitter, a circuit breaker,
+adaptive (AIMD) concurrency limits per upstream host with priority classes, and
+token-bucket rate limits shared across threads and worker processes
+"""
+
+import contextvars
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+
+import json_codec
+from memory_budget import estimate_entries_size
+import profiling
+from replay_archive import ReplayArchive, ReplayMiss
+import tracing
+
+
+class UpstreamUnavailable(Exception):
+    """Raised when an upstream is unhealthy and no cached answer exists (degraded mode)"""
+
+
+# Priority classes for upstream requests; waiting interactive requests get free slots first
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+_priority: contextvars.ContextVar = contextvars.ContextVar('upstream_priority', default=BULK)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+@contextmanager
+def request_priority(priority: int) -> Iterator[None]:
+    """Make upstream requests in this context at the given priority (bulk unless set)
+
+    Work handed to thread pools keeps the priority only when submitted through
+    contextvars.copy_context().run.
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class PriorityExecutor(Executor):
+    """Thread pool that starts waiting interactive tasks before bulk ones
+
+    A task takes the priority of the context it is submitted from (request_priority). Bulk
+    tasks run on at most max_workers threads; interactive_workers more threads are kept for
+    interactive tasks, so an interactive lookup does not queue behind a saturating batch.
+    """
+
+    def __init__(self, max_workers: int, interactive_workers: Optional[int] = None,
+                 thread_name_prefix: str = 'priority-pool'):
+        self.max_workers = max_workers
+        self.interactive_workers = max(1, max_workers // 2) if interactive_workers is None else interactive_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._queues: Dict[int, Deque[Tuple]] = {priority: deque() for priority in PRIORITY_NAMES}
+        self._threads: List[threading.Thread] = []
+        self._idle = 0
+        self._bulk_running = 0
+        self._shutdown = False
+        self._cond = threading.Condition()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        priority = current_priority()
+        future: Future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            self._queues[priority].append((future, fn, args, kwargs))
+            startable = len(self._queues[INTERACTIVE]) + min(len(self._queues[BULK]),
+                                                             self.max_workers - self._bulk_running)
+            if startable > self._idle and len(self._threads) < self.max_workers + self.interactive_workers:
+                # Daemon threads: pools held for the process lifetime must not block its exit
+                thread = threading.Thread(target=self._work, daemon=True,
+                                          name=f"{self.thread_name_prefix}_{len(self._threads)}")
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify_all()
+        return future
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        with self._cond:
+            self._shutdown = True
+            if cancel_futures:
+                for queue in self._queues.values():
+                    while queue:
+                        queue.popleft()[0].cancel()
+            self._cond.notify_all()
+            threads = list(self._threads)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _next_priority(self) -> Optional[int]:
+        if self._queues[INTERACTIVE]:
+            return INTERACTIVE
+        if self._queues[BULK] and self._bulk_running < self.max_workers:
+            return BULK
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._idle += 1
+                priority = self._next_priority()
+                while priority is None:
+                    if self._shutdown and not any(self._queues.values()):
+                        self._idle -= 1
+                        return
+                    self._cond.wait()
+                    priority = self._next_priority()
+                self._idle -= 1
+                future, fn, args, kwargs = self._queues[priority].popleft()
+                if priority == BULK:
+                    self._bulk_running += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        result = fn(*args, **kwargs)
+                    except BaseException as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(result)
+            finally:
+                if priority == BULK:
+                    with self._cond:
+                        self._bulk_running -= 1
+                        self._cond.notify_all()
+
+
+class LatencyTracker:
+    """Rolling window of request latencies, used to derive the hedge delay"""
+
+    def __init__(self, window: int = 200):
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """Return the given latency percentile in seconds, or None without samples"""
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        index = int(round(pct / 100.0 * (len(ordered) - 1)))
+        return ordered[min(index, len(ordered) - 1)]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a single half-open probe"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def allow_request(self) -> bool:
+        """Whether a request may go upstream; lets one probe through after the reset timeout"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        """Give back a half-open probe that never reached the upstream, so the next request probes instead"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD limit on in-flight requests to one upstream host
+
+    The limit grows by one per window of successful requests while latency stays
+    near its baseline, and is cut multiplicatively when latency rises or the host
+    answers 429/503. Baselines are kept per route and status class, so a large page
+    is not compared with small concept pages or fast 404s.
+
+    Waiting requests are served by priority class, then in arrival order. Bulk work
+    still gets at least bulk_min_share of the slots handed out while both classes wait.
+    """
+
+    OVERLOAD_STATUS = {429, 503}
+    MAX_ROUTES = 64
+
+    def __init__(self, host: str, initial_limit: int = 4, min_limit: int = 1, max_limit: int = 64,
+                 decrease_ratio: float = 0.5, latency_tolerance: float = 2.0, latency_slack: float = 0.05,
+                 bulk_min_share: float = 0.2):
+        self.host = host
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_ratio = decrease_ratio
+        self.latency_tolerance = latency_tolerance
+        self.latency_slack = latency_slack
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        # (route, status class) -> latency baseline
+        self._baselines: 'OrderedDict[Tuple[Optional[str], Optional[int]], float]' = OrderedDict()
+        self._last_decrease = 0.0
+        # One bulk grant in every _bulk_every while interactive requests are also waiting
+        self._bulk_every = max(1, round(1.0 / bulk_min_share)) if bulk_min_share > 0 else None
+        self._bulk_passed = 0
+        self._queues: Dict[int, Deque[object]] = {priority: deque() for priority in PRIORITY_NAMES}
+        self._counters = {'acquired': 0, 'waited': 0, 'increases': 0, 'decreases': 0}
+        self._granted = {name: 0 for name in PRIORITY_NAMES.values()}
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_limit, int(self._limit))
+
+    def acquire(self, priority: Optional[int] = None):
+        """Block until a slot is free under the current limit and no request ahead of this one waits
+
+        The priority defaults to the one set with request_priority.
+        """
+        priority = current_priority() if priority is None else priority
+        ticket = object()
+        with self._cond:
+            queue = self._queues[priority]
+            queue.append(ticket)
+            if not self._grantable(ticket, priority):
+                self._counters['waited'] += 1
+                while not self._grantable(ticket, priority):
+                    self._cond.wait()
+            queue.popleft()
+            if priority == BULK:
+                self._bulk_passed = 0
+            elif self._queues[BULK]:
+                self._bulk_passed += 1
+            self._in_flight += 1
+            self._counters['acquired'] += 1
+            self._granted[PRIORITY_NAMES[priority]] += 1
+            # A raised limit can leave room for the next in line as well
+            self._cond.notify_all()
+
+    def _grantable(self, ticket: object, priority: int) -> bool:
+        return (self._in_flight < self.limit and self._queues[priority][0] is ticket
+                and self._next_priority() == priority)
+
+    def _next_priority(self) -> Optional[int]:
+        """Class the next free slot goes to"""
+        bulk_due = (self._queues[BULK] and self._bulk_every is not None
+                    and self._bulk_passed >= self._bulk_every - 1)
+        if self._queues[INTERACTIVE] and not bulk_due:
+            return INTERACTIVE
+        return BULK if self._queues[BULK] else None
+
+    def release(self, latency: float, status: Optional[int] = None, error: bool = False,
+                route: Optional[str] = None):
+        """Free a slot and adjust the limit from the observed outcome"""
+        with self._cond:
+            saturated = self._in_flight * 2 >= self.limit
+            self._in_flight -= 1
+            key = (route, status // 100 if status else None)
+            baseline = self._baselines.get(key)
+            if baseline is None or latency < baseline:
+                baseline = latency
+            else:
+                # Drift slowly towards the observed latency so permanent shifts are learned
+                baseline += (latency - baseline) * 0.01
+            self._baselines[key] = baseline
+            self._baselines.move_to_end(key)
+            while len(self._baselines) > self.MAX_ROUTES:
+                self._baselines.popitem(last=False)
+            threshold = max(baseline * self.latency_tolerance, baseline + self.latency_slack)
+            if error or status in self.OVERLOAD_STATUS or latency > threshold:
+                now = time.monotonic()
+                # One decrease per round trip, not one per concurrent failure
+                if now - self._last_decrease >= max(latency, 0.1):
+                    self._limit = max(float(self.min_limit), self._limit * self.decrease_ratio)
+                    self._last_decrease = now
+                    self._counters['decreases'] += 1
+            elif saturated and self._limit < self.max_limit:
+                # Only grow when at least half the current limit is in use
+                self._limit = min(float(self.max_limit), self._limit + 1.0 / self._limit)
+                self._counters['increases'] += 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority: Optional[int] = None, route: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Hold a slot for one request; set outcome['status'] to report the HTTP status
+
+        route (see route_of) selects the latency baseline the request is compared with.
+
+        A caller that waits for something else inside the slot (a rate-limit token) resets
+        outcome['started'] afterwards, so only the request itself counts as latency.
+        """
+        self.acquire(priority)
+        outcome: Dict[str, Any] = {'status': None, 'error': False, 'started': time.monotonic()}
+        try:
+            yield outcome
+        except Exception:
+            outcome['error'] = True
+            raise
+        finally:
+            self.release(time.monotonic() - outcome['started'], outcome['status'], outcome['error'], route)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'limit': self.limit,
+                'in_flight': self._in_flight,
+                'baseline_latency_ms': {f"{route or '*'} {status or 'error'}xx": round(baseline * 1000, 1)
+                                        for (route, status), baseline in self._baselines.items()},
+                'waiting': {name: len(self._queues[priority]) for priority, name in PRIORITY_NAMES.items()},
+                'granted': dict(self._granted),
+                **self._counters
+            }
+
+
+def route_of(url: str) -> str:
+    """Latency class of a URL: its path with the last segment (a name or a sub-resource) generalized"""
+    path = urlparse(url).path
+    head, _, last = path.rpartition('/')
+    return f"{head}/*" if last else path
+
+
+class ConcurrencyLimiters:
+    """One adaptive limiter per upstream host, created on first use"""
+
+    def __init__(self, host_overrides: Optional[Dict[str, Dict[str, Any]]] = None, **defaults):
+        self._defaults = defaults
+        self._overrides = host_overrides or {}
+        self._limiters: Dict[str, AdaptiveConcurrencyLimiter] = {}
+        self._lock = threading.Lock()
+
+    def for_url(self, url: str) -> AdaptiveConcurrencyLimiter:
+        host = urlparse(url).netloc
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                options = dict(self._defaults)
+                options.update(self._overrides.get(host, {}))
+                limiter = self._limiters[host] = AdaptiveConcurrencyLimiter(host, **options)
+            return limiter
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {host: limiter.snapshot() for host, limiter in limiters.items()}
+
+
+class TokenBucket:
+    """Token-bucket rate limiter shared by all threads, and by processes through a SQLite state file
+
+    Callers reserve a token up front and sleep until their reservation comes due, so
+    requests queue in arrival order instead of failing when the bucket is empty.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float, state_path: Optional[str] = None):
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst at least 1")
+        self.name = name
+        self.rate = rate
+        self.burst = float(burst)
+        self.state_path = state_path
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+        self._counters = {'acquired': 0, 'delayed': 0}
+        self._waited = 0.0
+
+    @classmethod
+    def from_env(cls, name: str, default_rate: float, default_burst: float) -> 'TokenBucket':
+        """Build a bucket from <NAME>_RATE_PER_SEC, <NAME>_BURST and RATE_LIMIT_STATE
+
+        RATE_LIMIT_STATE is the SQLite file through which processes share the budget.
+        Sharing is opt-in: without it each bucket limits its own process only (batch
+        directory mode points its workers at a common file).
+        """
+        prefix = name.upper()
+        rate = float(os.environ.get(f"{prefix}_RATE_PER_SEC", default_rate))
+        burst = float(os.environ.get(f"{prefix}_BURST", default_burst))
+        return cls(name, rate, burst, os.environ.get('RATE_LIMIT_STATE') or None)
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """Take tokens, sleeping until they are available; returns the time waited"""
+        wait_for = self._reserve(tokens)
+        with self._lock:
+            self._counters['acquired'] += 1
+            if wait_for > 0:
+                self._counters['delayed'] += 1
+                self._waited += wait_for
+        if wait_for > 0:
+            time.sleep(wait_for)
+        return wait_for
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'rate_per_sec': self.rate,
+                'burst': self.burst,
+                'shared_state': self.state_path,
+                'total_wait_seconds': round(self._waited, 3),
+                **self._counters
+            }
+
+    def _reserve(self, tokens: float) -> float:
+        with self._lock:
+            if self.state_path:
+                try:
+                    return self._reserve_shared(tokens)
+                except sqlite3.Error as e:
+                    print(f"Warning: shared rate limit state unavailable ({e}); limiting per process")
+                    self.state_path = None
+            now = time.time()
+            self._tokens, wait_for = self._take(self._tokens, self._updated, now, tokens)
+            self._updated = now
+            return wait_for
+
+    def _take(self, available: float, updated: float, now: float, tokens: float) -> Tuple[float, float]:
+        """Refill, then reserve; a negative balance is the queue of outstanding reservations"""
+        available = min(self.burst, available + max(0.0, now - updated) * self.rate) - tokens
+        return available, max(0.0, -available / self.rate)
+
+    def _reserve_shared(self, tokens: float) -> float:
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE name = ?', (self.name,)).fetchone()
+            now = time.time()
+            available, updated = row if row else (self.burst, now)
+            available, wait_for = self._take(available, updated, now, tokens)
+            conn.execute('INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)',
+                         (self.name, available, now))
+            conn.execute('COMMIT')
+            return wait_for
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not cross a fork, so reopen in each worker process
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.state_path, timeout=30, isolation_level=None,
+                                         check_same_thread=False)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS buckets '
+                               '(name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            self._conn_pid = os.getpid()
+        return self._conn
+
+
+class ResilientClient:
+    """JSON GET client with hedging, retries, a circuit breaker and a last-known-good cache"""
+
+    RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, session: requests.Session, name: str = 'upstream', timeout: float = 10.0,
+                 max_retries: int = 2, backoff_base: float = 0.25, backoff_max: float = 4.0,
+                 hedge: bool = True, hedge_percentile: float = 95.0, hedge_min_samples: int = 20,
+                 hedge_default_delay: float = 1.0, hedge_min_delay: float = 0.05,
+                 breaker: Optional[CircuitBreaker] = None, cache_size: int = 2048, max_workers: int = 8,
+                 limiters: Optional[ConcurrencyLimiters] = None, rate_limit: Optional[TokenBucket] = None,
+                 archive: Optional[ReplayArchive] = None):
+        self.session = session
+        self.name = name
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = LatencyTracker()
+        self.limiters = limiters
+        # Request budget shared with other workers (hedges and retries included)
+        self.rate_limit = rate_limit
+        self.cache_size = cache_size
+        self._cache: 'OrderedDict[Tuple, Any]' = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # Recorded answers, served when neither the upstream nor the last-known-good cache has one
+        self.archive = archive
+        self._max_workers = max_workers
+        self._executor: Optional[PriorityExecutor] = None
+        self._executor_lock = threading.Lock()
+        self._counters: Dict[str, int] = {
+            'requests': 0, 'hedges': 0, 'retries': 0, 'failures': 0,
+            'served_from_cache': 0, 'served_from_archive': 0, 'degraded': 0
+        }
+        self._counter_lock = threading.Lock()
+
+    def get_json(self, url: str, params: Optional[Dict[str, Any]] = None) -> Any:
+        """GET a JSON document, falling back to the last good answer while the upstream is unhealthy"""
+        return self._request_json('GET', url, params, None)
+
+    def post_json(self, url: str, payload: Any, params: Optional[Dict[str, Any]] = None) -> Any:
+        """POST a read-only query (e.g. a bulk load) with the same retries and breaker, without hedging"""
+        return self._request_json('POST', url, params, payload)
+
+    def _request_json(self, method: str, url: str, params: Optional[Dict[str, Any]], payload: Any) -> Any:
+        key = self._cache_key(url, params, payload)
+        last_error: Optional[Exception] = None
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow_request():
+                break
+            if attempt:
+                self._count('retries')
+                time.sleep(self._backoff(attempt))
+            try:
+                response = self._send(method, url, params, payload)
+            except ReplayMiss as e:
+                # Replaying: asking again cannot help, and the upstream is not at fault
+                self.breaker.release_probe()
+                last_error = e
+                break
+            except requests.RequestException as e:
+                self.breaker.record_failure()
+                last_error = e
+                continue
+            if response.status_code in self.RETRYABLE_STATUS:
+                self.breaker.record_failure()
+                last_error = requests.HTTPError(f"{response.status_code} from {self.name}", response=response)
+                continue
+            # Any other answer means the upstream is alive; 4xx errors are not retried
+            self.breaker.record_success()
+            response.raise_for_status()
+            data = json_codec.loads(response.content)
+            self._cache_put(key, data)
+            return data
+        self._count('failures')
+        return self._cached_or_raise(key, last_error, method, url, params, payload)
+
+    def invalidate_cached(self, predicate: Callable[[Any], bool]) -> int:
+        """Drop last-known-good answers for which predicate(data) is true; returns the count"""
+        with self._cache_lock:
+            doomed = [key for key, data in self._cache.items() if predicate(data)]
+            for key in doomed:
+                del self._cache[key]
+        return len(doomed)
+
+    def hedge_delay(self) -> float:
+        """Delay before a duplicate request is sent: the latency percentile once warmed up"""
+        if len(self.latency) < self.hedge_min_samples:
+            return self.hedge_default_delay
+        delay = self.latency.percentile(self.hedge_percentile) or self.hedge_default_delay
+        return max(delay, self.hedge_min_delay)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Snapshot of breaker state, latency and counters"""
+        p95 = self.latency.percentile(95.0)
+        with self._counter_lock:
+            counters = dict(self._counters)
+        with self._cache_lock:
+            cached = len(self._cache)
+        return {
+            'name': self.name,
+            'breaker_state': self.breaker.state,
+            'latency_p95_ms': round(p95 * 1000, 1) if p95 is not None else None,
+            'hedge_delay_ms': round(self.hedge_delay() * 1000, 1),
+            'cached_responses': cached,
+            **counters
+        }
+
+    def _send(self, method: str, url: str, params: Optional[Dict[str, Any]], payload: Any) -> requests.Response:
+        if not self.hedge or method != 'GET':
+            return self._timed_request(method, url, params, payload)
+        executor = self._get_executor()
+        # Hedges run on pool threads; copying the context keeps the caller's priority
+        sent = threading.Event()
+        primary = executor.submit(contextvars.copy_context().run, profiling.call_in_task, self._timed_request,
+                                  method, url, params, payload, sent)
+        primary.add_done_callback(lambda _: sent.set())
+        # The hedge clock starts when the request goes out: time spent queueing for a
+        # limiter slot or a rate-limit token is not upstream latency
+        sent.wait()
+        done, _ = wait([primary], timeout=self.hedge_delay())
+        if done:
+            return primary.result()
+        # Slow primary: race a duplicate request and take whichever answers first
+        self._count('hedges')
+        pending = {primary, executor.submit(contextvars.copy_context().run, profiling.call_in_task,
+                                            self._timed_request, method, url, params, payload)}
+        error: Optional[Exception] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except requests.RequestException as e:
+                    error = e
+        raise error
+
+    def _timed_request(self, method: str, url: str, params: Optional[Dict[str, Any]], payload: Any,
+                       sent: Optional[threading.Event] = None) -> requests.Response:
+        with tracing.span('upstream.request', upstream=self.name, **{
+                'http.method': method, 'http.url': url, 'http.query.term': (params or {}).get('term')}) as span:
+            response = self._limited_request(method, url, params, payload, sent)
+            span.set_attribute('http.status_code', response.status_code)
+            return response
+
+    def _limited_request(self, method: str, url: str, params: Optional[Dict[str, Any]], payload: Any,
+                         sent: Optional[threading.Event] = None) -> requests.Response:
+        """Send once a limiter slot and a rate-limit token are held; sent is set just before sending"""
+        self._count('requests')
+        if self.limiters is None:
+            if self.rate_limit is not None:
+                self.rate_limit.acquire()
+            if sent is not None:
+                sent.set()
+            start = time.monotonic()
+            response = self.session.request(method, url, params=params, json=payload, timeout=self.timeout)
+            self.latency.record(time.monotonic() - start)
+            profiling.record_upstream(url, time.monotonic() - start)
+            return response
+        with self.limiters.for_url(url).slot(route=route_of(url)) as outcome:
+            # Tokens are taken once the slot is held, so requests queue by priority in the limiter
+            # rather than in arrival order in the bucket
+            if self.rate_limit is not None:
+                self.rate_limit.acquire()
+            if sent is not None:
+                sent.set()
+            start = outcome['started'] = time.monotonic()
+            response = self.session.request(method, url, params=params, json=payload, timeout=self.timeout)
+            self.latency.record(time.monotonic() - start)
+            profiling.record_upstream(url, time.monotonic() - start)
+            outcome['status'] = response.status_code
+        return response
+
+    def _backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _cached_or_raise(self, key: Tuple, error: Optional[Exception], method: str, url: str,
+                         params: Optional[Dict[str, Any]], payload: Any) -> Any:
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                data = self._cache[key]
+            else:
+                data = None
+        if data is not None:
+            self._count('served_from_cache')
+            return data
+        data = self._archived(method, url, params, payload)
+        if data is not None:
+            self._count('served_from_archive')
+            return data
+        self._count('degraded')
+        reason = f": {error}" if error else " (circuit open)"
+        raise UpstreamUnavailable(f"{self.name} unavailable{reason}")
+
+    def _archived(self, method: str, url: str, params: Optional[Dict[str, Any]], payload: Any) -> Any:
+        if self.archive is None:
+            return None
+        try:
+            recorded = self.archive.lookup_request(method, url, params, payload)
+            if recorded is None or recorded.status >= 400:
+                return None
+            self.archive.count('fallbacks')
+            return json_codec.loads(recorded.body)
+        except (sqlite3.Error, ValueError) as e:
+            print(f"Warning: Replay archive '{self.archive.path}' unavailable: {e}")
+            return None
+
+    def _cache_put(self, key: Tuple, data: Any):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = data
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def evict_cached(self, count: int) -> int:
+        """Drop up to count least recently used last-known-good responses"""
+        with self._cache_lock:
+            count = min(count, len(self._cache))
+            for _ in range(count):
+                self._cache.popitem(last=False)
+        return count
+
+    def cache_memory_usage(self) -> Dict[str, int]:
+        with self._cache_lock:
+            return {'entries': len(self._cache),
+                    'bytes': estimate_entries_size(self._cache, self._cache.items(), len(self._cache))}
+
+    def _cache_key(self, url: str, params: Optional[Dict[str, Any]], payload: Any = None) -> Tuple:
+        body = json.dumps(payload, sort_keys=True) if payload is not None else None
+        return (url, tuple(sorted((k, str(v)) for k, v in (params or {}).items())), body)
+
+    def _get_executor(self) -> PriorityExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                # Bulk hedges waiting for a limiter slot must not hold every thread an interactive hedge needs
+                self._executor = PriorityExecutor(max_workers=self._max_workers,
+                                                  thread_name_prefix=f"{self.name}-hedge")
+            return self._executor
+
+    def _count(self, counter: str):
+        with self._counter_lock:
+            self._counters[counter] += 1